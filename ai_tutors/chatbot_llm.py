@@ -1,10 +1,71 @@
 import os
+import time
+import logging
+import threading
+from collections import deque
 from llama_index.core.llms import ChatMessage
 from llama_index.llms.openai import OpenAI
 
+logger = logging.getLogger(__name__)
+
 def load_text_file(file_path):
     return open(file_path, 'r').read()
 
+# Opening message from the AI tutor
+GREETING = """
+Hi! I'm here to help you with your science questions. 
+
+I won't do the work for you, but I'll guide you through each step so you can understand and feel more confident.
+
+To start, **what grade are you in and what do you need help with?**
+        """
+
+# Opening messages (system prompt and greeting) of each tutor, built once and shared by every session in the process.
+# Sessions start from a copy of the template, so the messages in it are never modified.
+history_templates = {}
+
+# Latencies (time to the first token and to the complete response, in seconds) of the first student message
+# of recent sessions, which include any cold-start cost (e.g. a whole class logging in at once)
+first_turn_latencies = deque(maxlen=1000)
+first_turn_lock = threading.Lock()
+first_turn_count = 0
+
+# The first-turn latency summary is written to the server log every this many first turns
+FIRST_TURN_REPORT_EVERY = 50
+
+def record_first_turn(time_to_first_token, total):
+    """
+    Records the latency of a session's first student message. The time to the first token is None 
+    when the response wasn't streamed. Responses served from the cache should not be recorded.
+    """
+    global first_turn_count
+    with first_turn_lock:
+        first_turn_latencies.append((time_to_first_token, total))
+        first_turn_count += 1
+        report = first_turn_count % FIRST_TURN_REPORT_EVERY == 0
+    if report:
+        logger.info("First turn latency: %s", first_turn_stats())
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else None
+
+def first_turn_stats():
+    """
+    Summarises the latency of the first student message of recent sessions.
+
+    Returns:
+        dict: The number of first turns ("count"), and the median and 95th percentile (in seconds) 
+              of the time to the first token ("time_to_first_token") and to the complete response ("total").
+    """
+    with first_turn_lock:
+        latencies = list(first_turn_latencies)
+    stats = {"count": len(latencies)}
+    for i, name in enumerate(("time_to_first_token", "total")):
+        values = [latency[i] for latency in latencies if latency[i] is not None]
+        stats[name] = {"median": percentile(values, 0.5), "p95": percentile(values, 0.95)}
+    return stats
+
 class AITutor:
     """
     A class that facilitates a back-and-forth conversation between a student and an AI tutor.
@@ -20,39 +81,57 @@ class AITutor:
     Methods:
         initiate_conversation(grade, topic): Initiates the tutoring session by asking the student for more details.
         get_response(student_input): Handles student input and provides a response using the LLM.
+        aget_response(student_input): Async version of `get_response`.
         get_message_history(): Returns the history of messages in the conversation.
     """
 
-    def __init__(self, llm_model, instructions, display_system=False):
+    def __init__(self, llm_model, instructions, display_system=False, system_prompt=None, greeting=GREETING):
         self.llm = llm_model
-        self.message_history = []
 
-        # Add these as a "system prompt"
+        # Initialize the conversation with copies of the system prompt and initial request from the AI tutor, 
+        # so changes to this session's messages don't affect the shared template
+        self.message_history = [message.model_copy() for message in self.history_template(instructions, system_prompt, greeting)]
+        if display_system:
+            print(self.message_history[0].content)
+
+        # The first student message is timed separately
+        self.first_turn = True
+
+    @classmethod
+    def history_template(cls, instructions, system_prompt=None, greeting=GREETING):
+        """
+        Returns the opening messages (system prompt and greeting) of the tutor's sessions, 
+        which are only built once per process.
+
+        Args:
+            instructions (str): The tutor's instructions.
+            system_prompt (str, optional): The system prompt, if it was prepared ahead of time.
+            greeting (str): The tutor's opening message.
+        Returns:
+            tuple: The system and greeting ChatMessages.
+        """
+        key = (instructions, system_prompt, greeting)
+        if key not in history_templates:
+            if system_prompt is None:
+                system_prompt = cls.build_system_prompt(instructions)
+            history_templates[key] = (ChatMessage(role="system", content=system_prompt),
+                                      ChatMessage(role="assistant", content=greeting))
+        return history_templates[key]
+
+    @staticmethod
+    def build_system_prompt(instructions):
+        """Builds the system prompt from the tutor's instructions."""
         system_prompt = f"{instructions}\n\n"
         system_prompt += "## Your Task\n\n"
         system_prompt += "You are a helpful tutor/assistant. "
         system_prompt += "Following the instructions above, provide supportive assistance to the student user."
-        if display_system:
-            print(system_prompt)
-        
-        # Initialize the conversation with the system prompt
-        self.message_history.append(ChatMessage(role="system", content=system_prompt))
-        
-        # Append initial request from AI tutor
-        self.initiate_conversation()
+        return system_prompt
 
-    def initiate_conversation(self):
+    def initiate_conversation(self, greeting=GREETING):
         """
         Initiates the conversation with the student, asking for the grade level and topic they are working on.
         """
-        init_message = f"""
-Hi! I'm here to help you with your science questions. 
-
-I won't do the work for you, but I'll guide you through each step so you can understand and feel more confident.
-
-To start, **what grade are you in and what do you need help with?**
-        """
-        self.message_history.append(ChatMessage(role="assistant", content=init_message))
+        self.message_history.append(ChatMessage(role="assistant", content=greeting))
 
     def get_response(self, student_input):
         """
@@ -63,9 +142,92 @@ To start, **what grade are you in and what do you need help with?**
         self.message_history.append(ChatMessage(role="user", content=student_input))
         
         # Get the response from the LLM
-        response = self.llm.chat(self.message_history).message.content
+        start = time.perf_counter()
+        chat_response = self.llm.chat(self.message_history)
+        response = chat_response.message.content
+        if self.first_turn:
+            # The response wasn't streamed, so there is no time to the first token
+            if not chat_response.additional_kwargs.get("cached"):
+                record_first_turn(None, time.perf_counter() - start)
+            self.first_turn = False
         
         # Add the AI's response to the history
         self.message_history.append(ChatMessage(role="assistant", content=response))
         
-        return response
\ No newline at end of file
+        return response
+
+    def stream_response(self, student_input):
+        """
+        Streaming version of `get_response` that yields the response text as it is generated.
+        If the stream is closed early, the partial response is added to the history.
+        """
+        # Add the student's message to the history
+        self.message_history.append(ChatMessage(role="user", content=student_input))
+
+        response = ""
+        start = time.perf_counter()
+        time_to_first_token = None
+        cached = False
+        try:
+            for chunk in self.llm.stream_chat(self.message_history):
+                if time_to_first_token is None:
+                    time_to_first_token = time.perf_counter() - start
+                    cached = chunk.additional_kwargs.get("cached", False)
+                response += chunk.delta or ""
+                yield chunk.delta or ""
+        finally:
+            if self.first_turn:
+                if not cached:
+                    record_first_turn(time_to_first_token, time.perf_counter() - start)
+                self.first_turn = False
+            # Add the AI's (possibly partial) response to the history
+            self.message_history.append(ChatMessage(role="assistant", content=response))
+
+    async def aget_response(self, student_input):
+        """
+        Async version of `get_response`, which does not hold a thread while waiting for the LLM.
+        """
+        # Add the student's message to the history
+        self.message_history.append(ChatMessage(role="user", content=student_input))
+
+        # Get the response from the LLM
+        start = time.perf_counter()
+        chat_response = await self.llm.achat(self.message_history)
+        response = chat_response.message.content
+        if self.first_turn:
+            # The response wasn't streamed, so there is no time to the first token
+            if not chat_response.additional_kwargs.get("cached"):
+                record_first_turn(None, time.perf_counter() - start)
+            self.first_turn = False
+
+        # Add the AI's response to the history
+        self.message_history.append(ChatMessage(role="assistant", content=response))
+
+        return response
+
+    async def astream_response(self, student_input):
+        """
+        Async version of `stream_response`, an async generator of the response text.
+        If the stream is closed early, the partial response is added to the history.
+        """
+        # Add the student's message to the history
+        self.message_history.append(ChatMessage(role="user", content=student_input))
+
+        response = ""
+        start = time.perf_counter()
+        time_to_first_token = None
+        cached = False
+        try:
+            async for chunk in await self.llm.astream_chat(self.message_history):
+                if time_to_first_token is None:
+                    time_to_first_token = time.perf_counter() - start
+                    cached = chunk.additional_kwargs.get("cached", False)
+                response += chunk.delta or ""
+                yield chunk.delta or ""
+        finally:
+            if self.first_turn:
+                if not cached:
+                    record_first_turn(time_to_first_token, time.perf_counter() - start)
+                self.first_turn = False
+            # Add the AI's (possibly partial) response to the history
+            self.message_history.append(ChatMessage(role="assistant", content=response))
@@ -1,23 +1,31 @@
 import streamlit as st
 import pandas as pd
-from tutor_data import read_csv, select_instructions
+from tutor_data import get_registry
+from resources import get_llm
 
 st.session_state["ai_tutors_data_fn"] = 'ai-tutors/tutor_info.csv'
 
 st.set_page_config(page_title="AI Tutors", page_icon="https://raw.githubusercontent.com/teaghan/educational-prompt-engineering/main/images/science_tutor_favicon_small.png", layout="wide")
 
+# Create the shared LLM client on the first page load, so its connection is open before the first student message
+get_llm(model='gpt-4o-mini', temperature=0.4)
+
 st.markdown("<h1 style='text-align: center; color: grey;'>Build an AI Tutor</h1>", unsafe_allow_html=True)
 
-df_tutors = read_csv(st.session_state["ai_tutors_data_fn"])
+tutor_registry = get_registry(st.session_state["ai_tutors_data_fn"])
 
 switch_page = st.button("Load Tutor")
 if switch_page:
     # Switch to the selected page
     tool_name = 'AI Science Tutor'
-    st.session_state["instructions"], st.session_state["guidelines"] = select_instructions(df_tutors, 
-                                                                                           tool_name=tool_name)
-    st.session_state["tool name"] = tool_name
-    st.switch_page('pages/tutor_main.py')
+    try:
+        st.session_state["instructions"], st.session_state["guidelines"] = tutor_registry.get_instructions(tool_name)
+        st.session_state["tutor_bundle"] = tutor_registry.get_bundle(tool_name)
+    except KeyError:
+        st.error(f'The tutor "{tool_name}" could not be found.')
+    else:
+        st.session_state["tool name"] = tool_name
+        st.switch_page('pages/tutor_main.py')
 
 create_tutor = st.button("Build an AI Tutor")
 if create_tutor:
@@ -1,6 +1,5 @@
 import streamlit as st
-import pandas as pd
-from tutor_data import read_csv, write_csv, select_instructions
+from tutor_data import get_registry, TutorExistsError
 
 # Page configuration
 st.set_page_config(page_title="AI Tutors", page_icon="https://raw.githubusercontent.com/teaghan/educational-prompt-engineering/main/images/science_tutor_favicon_small.png", layout="wide")
@@ -14,10 +13,14 @@ if "model_loaded" not in st.session_state:
     st.session_state.model_loaded = False
 
 # Load existing tutor data
-df_tutors = read_csv(st.session_state["ai_tutors_data_fn"])
+tutor_registry = get_registry(st.session_state["ai_tutors_data_fn"])
 
 # Example tool
-example_instructions, example_guidelines = select_instructions(df_tutors, tool_name='AI Science Tutor')
+try:
+    example_instructions, example_guidelines = tutor_registry.get_instructions('AI Science Tutor')
+except KeyError:
+    # e.g. a new database that could not be seeded from the CSV file
+    example_instructions = example_guidelines = "No example available."
 
 # User inputs with examples provided
 st.header('Tool Name')
@@ -52,22 +55,23 @@ with col2:
         if new_name and new_instr and new_guide:
             print(new_name)
             # Check if name exists
-            if new_name in df_tutors['Name'].values:
+            if tutor_registry.exists(new_name):
                 st.session_state["banner"] = 'name exists'
                 st.error("This tool name already exists, please choose another one")
 
             else:
-                # Create a new row as a DataFrame
-                new_row = pd.DataFrame({"Name": [new_name], "Instructions": [new_instr], "Guidelines": [new_guide]})
-                # Concatenate the new row to the DataFrame
-                df_tutors = pd.concat([df_tutors, new_row], ignore_index=True)
-                write_csv(st.session_state["ai_tutors_data_fn"], df_tutors)
+                try:
+                    # Store the new tutor (the name is checked again as part of the write)
+                    tutor_registry.save_tutor(new_name, new_instr, new_guide)
 
-                # Display button to load
-                st.session_state["instructions"], st.session_state["guidelines"] = select_instructions(df_tutors, 
-                                                                                           tool_name=new_name)
-                st.session_state["tool name"] = new_name
-                st.session_state["banner"] = 'success'
+                    # Display button to load
+                    st.session_state["instructions"], st.session_state["guidelines"] = new_instr, new_guide
+                    st.session_state["tutor_bundle"] = tutor_registry.get_bundle(new_name)
+                    st.session_state["tool name"] = new_name
+                    st.session_state["banner"] = 'success'
+                except TutorExistsError:
+                    # Another tutor with this name was created at the same time
+                    st.session_state["banner"] = 'name exists'
                 
         else:
             st.session_state["banner"] = 'missing info'
@@ -5,10 +5,14 @@ cur_dir = os.path.dirname(__file__)
 parent_dir = os.path.abspath(os.path.join(cur_dir, '../'))
 sys.path.append(parent_dir)
 from tutor_llm import TutorChain
+from resources import get_llm
 
 # Streamlit
 st.set_page_config(page_title=st.session_state["tool name"], page_icon="https://raw.githubusercontent.com/teaghan/educational-prompt-engineering/main/images/science_tutor_favicon_small.png", layout="wide")
 
+# Create the shared LLM client on the first page load, so its connection is open before the first student message
+get_llm(model='gpt-4o-mini', temperature=0.4)
+
 # Avatar images
 avatar = {"user": "https://raw.githubusercontent.com/teaghan/educational-prompt-engineering/main/images/science_student_avatar.png",
           "assistant": "https://raw.githubusercontent.com/teaghan/educational-prompt-engineering/main/images/science_tutor_avatar.png"}
@@ -94,6 +98,11 @@ if st.session_state.drop_file:
             else:  # if it is not zip, the return is a string (here we concatenate the strings)
                 prompt_f = prompt_f + extract + "\n\n"
 
+# Moderate each paragraph of the response while the rest is being generated
+pipelined = st.sidebar.toggle("Moderate while responding", value=True, 
+                              help="Check the response paragraph by paragraph as it is written, "
+                                   "so an inappropriate response is stopped and corrected sooner.")
+
 # Display conversation
 if len(st.session_state.messages)>0:
     for msg in st.session_state.messages:
@@ -103,9 +112,12 @@ if len(st.session_state.messages)>0:
 # Load model
 if not st.session_state.model_loaded:
     with st.spinner('Loading...'):
-        # Construct pipiline
-        st.session_state['tutor_llm'] = TutorChain(st.session_state["instructions"],
-                                                   st.session_state["guidelines"])
+        # Construct pipiline (from the tutor's compiled bundle when it is available)
+        if st.session_state.get("tutor_bundle") is not None:
+            st.session_state['tutor_llm'] = TutorChain.from_bundle(st.session_state["tutor_bundle"])
+        else:
+            st.session_state['tutor_llm'] = TutorChain(st.session_state["instructions"],
+                                                       st.session_state["guidelines"])
         st.session_state.model_loads +=1
 
         init_request = st.session_state.tutor_llm.init_request        
@@ -127,6 +139,7 @@ if prompt := st.chat_input():
 
     # Use a spinner to indicate processing and display the assistant's response after processing
     #with st.spinner('Thinking...'):
+    st.session_state.tutor_llm.pipelined = pipelined
     response = st.session_state.tutor_llm.get_response(prompt_full)
     st.session_state.messages.append({"role": "assistant", "content": rf"{response}"})    
     
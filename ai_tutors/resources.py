@@ -0,0 +1,52 @@
+import os
+import logging
+import sys
+import threading
+import streamlit as st
+from llama_index.llms.openai import OpenAI
+# The LLM cache and the async LLM layer are shared by every app
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared'))
+from llm_cache import CachedLLM, get_disk_cache
+from async_llm import http_client, run
+
+logger = logging.getLogger(__name__)
+
+# Sent (for a single token) to open the connections to the LLM API
+WARM_UP_PROMPT = "Hi"
+
+# Resources that are expensive to create are built once per process and shared by every Streamlit session.
+# Per-session state (st.session_state) should only hold the message history.
+
+def open_connection(llm):
+    """
+    Opens the LLM clients' connections to the API (TCP and TLS handshakes) in a background thread,
+    with a one-token completion. The clients keep the connections in their pools, so the first student 
+    message does not wait for them. Both the sync client and the async client (whose connections belong 
+    to the shared event loop) are warmed up.
+
+    Returns:
+        threading.Thread: The background thread.
+    """
+    def request():
+        # If a request fails, the connection is opened by the first student message instead
+        try:
+            llm.complete(WARM_UP_PROMPT, max_tokens=1)
+        except Exception:
+            logger.warning("Could not open the sync client's connection to the LLM API", exc_info=True)
+        try:
+            run(llm.acomplete(WARM_UP_PROMPT, max_tokens=1), timeout=30)
+        except Exception:
+            logger.warning("Could not open the async client's connection to the LLM API", exc_info=True)
+    thread = threading.Thread(target=request, daemon=True)
+    thread.start()
+    return thread
+
+@st.cache_resource
+def get_llm(model='gpt-4o-mini', temperature=0.4):
+    """Returns the (cached) LLM client for the given model and temperature, with its connection pre-opened."""
+    openai_api_key = os.environ["OPENAI_API_KEY"]
+    # Async calls share the process's connection-pooled HTTP client
+    llm = OpenAI(model=model, temperature=temperature, api_key=openai_api_key, async_http_client=http_client)
+    open_connection(llm)
+    # Deterministic calls (e.g. moderation at temperature 0) are cached on disk, shared by every process
+    return CachedLLM(llm, cache=get_disk_cache())
@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+# The app's modules are imported by path, like the app does when it is run from its directory
+app_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, app_dir)
+sys.path.insert(0, os.path.join(app_dir, '..', 'shared'))
+
+# The API keys are read on import, but no requests are sent by the tests
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("GEMINI_API_KEY", "test")
+
+@pytest.fixture(autouse=True)
+def disk_cache(tmp_path, monkeypatch):
+    """Keeps the on-disk LLM cache of each test in its own temporary directory."""
+    import llm_cache
+    monkeypatch.setenv("LLM_CACHE_PATH", str(tmp_path / "llm_cache.sqlite"))
+    monkeypatch.setattr(llm_cache, "disk_cache", None)
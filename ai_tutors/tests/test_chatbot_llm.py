@@ -0,0 +1,23 @@
+import logging
+from collections import deque
+
+import chatbot_llm
+from chatbot_llm import first_turn_stats, record_first_turn
+
+def test_first_turn_latency_is_logged_periodically(monkeypatch, caplog):
+    monkeypatch.setattr(chatbot_llm, "first_turn_latencies", deque(maxlen=1000))
+    monkeypatch.setattr(chatbot_llm, "first_turn_count", 0)
+    monkeypatch.setattr(chatbot_llm, "FIRST_TURN_REPORT_EVERY", 3)
+    with caplog.at_level(logging.INFO, logger="chatbot_llm"):
+        for total in (1.0, 2.0, 3.0, 4.0):
+            record_first_turn(total / 10, total)
+    assert len(caplog.records) == 1
+    assert "First turn latency" in caplog.text
+
+def test_first_turn_stats(monkeypatch):
+    monkeypatch.setattr(chatbot_llm, "first_turn_latencies", deque([(0.1, 1.0), (None, 2.0), (0.3, 3.0)]))
+    stats = first_turn_stats()
+    assert stats["count"] == 3
+    # Responses that were not streamed have no time to the first token
+    assert stats["time_to_first_token"] == {"median": 0.3, "p95": 0.3}
+    assert stats["total"] == {"median": 2.0, "p95": 3.0}
@@ -0,0 +1,66 @@
+import pytest
+
+from moderation_prefilter import ModerationPrefilter, compile_rules, deserialize_rules, serialize_rules
+
+GUIDELINES = """
+- Avoid discouraging phrases like "You're wrong". Instead, say "Let's look at this again".
+- NEVER USE `\\(` for math.
+- Guide the student towards the answer instead of giving it away.
+"""
+
+@pytest.fixture
+def prefilter():
+    return ModerationPrefilter(GUIDELINES)
+
+def test_greetings_are_approved(prefilter):
+    feedback, is_appropriate = prefilter.check("Hi there! How can I help you today?")
+    assert is_appropriate
+    assert feedback.endswith("The response is appropriate.")
+
+@pytest.mark.parametrize("ai_response", ["", "   ", "\n\t"])
+def test_empty_responses_are_rejected(prefilter, ai_response):
+    feedback, is_appropriate = prefilter.check(ai_response)
+    assert not is_appropriate
+    assert "empty" in feedback
+
+@pytest.mark.parametrize("ai_response", ["You're wrong, try again.",
+                                         "The area is \\(\\pi r^2\\).",
+                                         "Good try. The answer is 12.",
+                                         "Solving the equation gives x = 4."])
+def test_rule_hits_are_rejected_without_the_llm(prefilter, ai_response):
+    feedback, is_appropriate = prefilter.check(ai_response)
+    assert not is_appropriate
+    assert feedback.endswith("The response is inappropriate.")
+
+@pytest.mark.parametrize("ai_response", ["What do you think the answer is?",
+                                         "Let's look at this again. What is 2 + 3 = 5 telling us?",
+                                         "Great question! Which formula relates force and mass?"])
+def test_other_responses_are_escalated(prefilter, ai_response):
+    assert prefilter.check(ai_response) is None
+
+def test_allowed_alternatives_are_not_rules():
+    phrases = [pattern.pattern for pattern, _ in compile_rules(GUIDELINES)]
+    assert any("You're\\ wrong" in phrase for phrase in phrases)
+    assert not any("Let's" in phrase for phrase in phrases)
+
+def test_classifier_rejects_or_flags_by_threshold():
+    scores = {"bad": 0.95, "doubtful": 0.6, "fine": 0.1}
+    prefilter = ModerationPrefilter("", classifier=scores.get)
+    assert prefilter.check("bad")[1] is False
+    assert prefilter.check("doubtful") is None
+    assert prefilter.hints("doubtful") == ["A local classifier flagged this response."]
+    assert prefilter.check("fine") is None
+    assert prefilter.hints("fine") == []
+
+def test_hit_rates_count_each_tier(prefilter):
+    prefilter.check("Hello!")
+    prefilter.check("You're wrong.")
+    prefilter.check("What do you think?")
+    prefilter.record("llm")
+    assert prefilter.hit_rates() == {"rules": 2 / 3, "llm": 1 / 3}
+
+def test_rules_survive_serialization():
+    rules = compile_rules(GUIDELINES)
+    restored = deserialize_rules(serialize_rules(rules))
+    assert [(pattern.pattern, pattern.flags, reason) for pattern, reason in restored] == \
+           [(pattern.pattern, pattern.flags, reason) for pattern, reason in rules]
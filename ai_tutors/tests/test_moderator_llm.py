@@ -0,0 +1,66 @@
+import pytest
+from llama_index.core.llms import ChatMessage, ChatResponse
+
+import moderator_llm
+from llm_cache import MemoryCache
+from moderator_llm import ContentModerator
+
+GUIDELINES = "Guide the student with questions instead of giving the answer."
+
+class FakeModeratorLLM:
+    """Gives the same verdict on every response, and records the queries it was sent."""
+    def __init__(self, verdict="Yes. The response is appropriate."):
+        self.verdict = verdict
+        self.queries = []
+
+    def chat(self, messages, **kwargs):
+        self.queries.append(messages[-1].content)
+        return ChatResponse(message=ChatMessage(role="assistant", content=f"Checked each guideline.\n\n{self.verdict}"))
+
+@pytest.fixture
+def moderator(monkeypatch):
+    # Each test starts with an empty verdict cache
+    monkeypatch.setattr(moderator_llm, "verdict_cache", MemoryCache())
+    return ContentModerator(GUIDELINES, FakeModeratorLLM(), context_turns=2)
+
+def conversation(*contents):
+    roles = ["user", "assistant"]
+    return [ChatMessage(role=roles[i % 2], content=content) for i, content in enumerate(contents)]
+
+def test_verdict_key_ignores_trivial_differences(moderator):
+    history = conversation("What is a force?")
+    assert (moderator.verdict_key(history, "Think about pushes and pulls.") == 
+            moderator.verdict_key(conversation("what is a  force?"), '"think about pushes and pulls."'))
+
+def test_verdict_key_depends_on_the_recent_conversation(moderator):
+    key = moderator.verdict_key(conversation("Hi", "Hello!", "What is a force?"), "Think about pushes.")
+    # Only the last `context_turns` messages are part of the key
+    assert key == moderator.verdict_key(conversation("Hey", "Hello!", "What is a force?"), "Think about pushes.")
+    assert key != moderator.verdict_key(conversation("Hi", "Hello!", "What is mass?"), "Think about pushes.")
+    assert key != moderator.verdict_key(conversation("Hi", "Hello!", "What is a force?"), "Think about pushes.", partial=True)
+    other = ContentModerator(GUIDELINES + " Never use jargon.", moderator.llm, context_turns=2)
+    assert key != other.verdict_key(conversation("Hi", "Hello!", "What is a force?"), "Think about pushes.")
+
+def test_identical_responses_are_only_moderated_once(moderator):
+    history = conversation("What is a force?")
+    first = moderator.cached_moderate_response(history, "What do pushes and pulls have in common?")
+    second = moderator.cached_moderate_response(history, "What do pushes and pulls have in common?")
+    assert first == second
+    assert first[1] is True
+    assert len(moderator.llm.queries) == 1
+    assert moderator.prefilter.stats == {"llm": 1, "cache": 1}
+
+def test_prefilter_verdicts_are_not_sent_to_the_llm(moderator):
+    feedback, is_appropriate = moderator.cached_moderate_response(conversation("Hi"), "Hello! How can I help you today?")
+    assert is_appropriate
+    assert moderator.llm.queries == []
+    assert moderator.prefilter.stats == {"rules": 1}
+
+@pytest.mark.parametrize("result, is_appropriate", [("Looks fine.\nYes. The response is appropriate.", True),
+                                                    ("Gives the answer.\nNo. The response is not appropriate.", False)])
+def test_parse_verdict(result, is_appropriate):
+    assert ContentModerator.parse_verdict(result) == (result, is_appropriate)
+
+def test_partial_responses_are_moderated_as_partial(moderator):
+    moderator.cached_moderate_response(conversation("What is a force?"), "Let's think about", partial=True)
+    assert moderator_llm.PARTIAL_RESPONSE_NOTE in moderator.llm.queries[0]
@@ -0,0 +1,46 @@
+import logging
+
+import resources
+
+class FailingLLM:
+    model = "gpt-4o-mini"
+
+    def complete(self, prompt, **kwargs):
+        raise ConnectionError("No network")
+
+    async def acomplete(self, prompt, **kwargs):
+        raise ConnectionError("No network")
+
+class WarmedLLM:
+    model = "gpt-4o-mini"
+
+    def __init__(self):
+        self.requests = []
+
+    def complete(self, prompt, **kwargs):
+        self.requests.append(("complete", kwargs))
+
+    async def acomplete(self, prompt, **kwargs):
+        self.requests.append(("acomplete", kwargs))
+
+def test_both_clients_are_warmed_up_with_a_single_token():
+    llm = WarmedLLM()
+    resources.open_connection(llm).join(timeout=5)
+    assert llm.requests == [("complete", {"max_tokens": 1}), ("acomplete", {"max_tokens": 1})]
+
+def test_failed_warm_ups_are_logged(caplog):
+    with caplog.at_level(logging.WARNING, logger="resources"):
+        resources.open_connection(FailingLLM()).join(timeout=5)
+    assert "sync client" in caplog.text
+    assert "async client" in caplog.text
+    assert "No network" in caplog.text
+
+def test_llm_clients_are_shared_by_every_tutor(monkeypatch):
+    from tutor_llm import TutorChain
+    # The connections are not opened in the tests
+    monkeypatch.setattr(resources, "open_connection", lambda llm: None)
+    first = TutorChain("Be kind.", "Never give the answer.")
+    second = TutorChain("Be strict.", "Never give the answer.")
+    assert first.tutor_llm.llm is second.tutor_llm.llm
+    assert first.moderator_llm.llm is first.tutor_llm.llm
+    assert resources.get_llm(model='gpt-4o-mini', temperature=0) is not first.tutor_llm.llm
@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+import tutor_bundle
+from chatbot_llm import AITutor
+from moderator_llm import ContentModerator
+from moderation_prefilter import compile_rules
+from tutor_bundle import compile_bundle, is_current, load_rules
+
+INSTRUCTIONS = "You are a patient physics tutor."
+GUIDELINES = 'Avoid discouraging phrases like "You\'re wrong". Guide the student towards the answer.'
+
+@pytest.fixture(autouse=True)
+def compiled_rules(monkeypatch):
+    monkeypatch.setattr(tutor_bundle, "compiled_rules", {})
+    return tutor_bundle.compiled_rules
+
+def test_bundles_hold_the_prepared_prompts():
+    bundle = compile_bundle("Physics", INSTRUCTIONS, GUIDELINES)
+    assert bundle["system_prompt"] == AITutor.build_system_prompt(INSTRUCTIONS)
+    assert bundle["moderation_prompt"] == ContentModerator.build_moderation_prompt(GUIDELINES)
+    assert bundle["correction_prompt"] == ContentModerator.build_correction_prompt(GUIDELINES)
+    assert set(bundle["token_counts"]) == {"system_prompt", "moderation_prompt", "correction_prompt", "greeting"}
+    assert all(count > 0 for count in bundle["token_counts"].values())
+
+def test_bundles_survive_a_json_round_trip():
+    bundle = compile_bundle("Physics", INSTRUCTIONS, GUIDELINES)
+    assert json.loads(json.dumps(bundle)) == bundle
+
+def test_bundle_versions_depend_on_the_content():
+    bundle = compile_bundle("Physics", INSTRUCTIONS, GUIDELINES)
+    assert compile_bundle("Physics", INSTRUCTIONS, GUIDELINES)["version"] == bundle["version"]
+    assert compile_bundle("Physics", INSTRUCTIONS + " Be brief.", GUIDELINES)["version"] != bundle["version"]
+    assert compile_bundle("Physics", INSTRUCTIONS, GUIDELINES, greeting="Hello!")["version"] != bundle["version"]
+
+def test_is_current():
+    bundle = compile_bundle("Physics", INSTRUCTIONS, GUIDELINES)
+    assert is_current(bundle, INSTRUCTIONS, GUIDELINES)
+    assert not is_current(bundle, INSTRUCTIONS, GUIDELINES + " Be kind.")
+    assert not is_current(None, INSTRUCTIONS, GUIDELINES)
+    # Bundles compiled in an older format are recompiled
+    assert not is_current({**bundle, "format": tutor_bundle.BUNDLE_FORMAT - 1}, INSTRUCTIONS, GUIDELINES)
+    # Bundles with a custom greeting are checked against their own greeting
+    assert is_current(compile_bundle("Physics", INSTRUCTIONS, GUIDELINES, greeting="Hello!"), INSTRUCTIONS, GUIDELINES)
+
+def test_rules_are_compiled_once_per_version(compiled_rules):
+    bundle = json.loads(json.dumps(compile_bundle("Physics", INSTRUCTIONS, GUIDELINES)))
+    rules = load_rules(bundle)
+    assert [(pattern.pattern, pattern.flags, reason) for pattern, reason in rules] == \
+        [(pattern.pattern, pattern.flags, reason) for pattern, reason in compile_rules(GUIDELINES)]
+    assert load_rules(dict(bundle)) is rules
+    assert list(compiled_rules) == [bundle["version"]]
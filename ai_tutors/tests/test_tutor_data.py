@@ -0,0 +1,260 @@
+import io
+import hashlib
+from collections import Counter
+
+import pytest
+
+import tutor_data
+from tutor_data import (ObjectStoreBackend, SQLiteBackend, TutorExistsError, TutorRegistry, 
+                        VersionConflictError, import_csv)
+
+class FakeFile(io.BytesIO):
+    def __init__(self, data, etag):
+        super().__init__(data)
+        self.details = {"ETag": etag}
+
+class FakeFS:
+    """An in-memory fsspec filesystem with S3's ETags and conditional writes, which counts each request."""
+    def __init__(self):
+        self.files = {}
+        self.requests = Counter()
+
+    def etag(self, path):
+        return hashlib.md5(self.files[path]).hexdigest()
+
+    def invalidate_cache(self, path=None):
+        pass
+
+    def pipe_file(self, path, data, IfNoneMatch=None, IfMatch=None):
+        self.requests["put"] += 1
+        if IfNoneMatch == "*" and path in self.files:
+            raise OSError("Precondition failed")
+        if IfMatch is not None and (path not in self.files or self.etag(path) != IfMatch):
+            raise OSError("Precondition failed")
+        self.files[path] = data
+
+    def info(self, path):
+        self.requests["head"] += 1
+        if path not in self.files:
+            raise FileNotFoundError(path)
+        return {"name": path, "ETag": self.etag(path)}
+
+    def exists(self, path):
+        self.requests["head"] += 1
+        return path in self.files or any(name.startswith(path + "/") for name in self.files)
+
+    def ls(self, path, detail=True):
+        self.requests["list"] += 1
+        return [{"name": name, "ETag": self.etag(name)} for name in self.files if name.rsplit("/", 1)[0] == path]
+
+    def open(self, path, mode="rb"):
+        self.requests["get"] += 1
+        if path not in self.files:
+            raise FileNotFoundError(path)
+        return FakeFile(self.files[path], self.etag(path))
+
+class FakeCSVBackend:
+    """The legacy CSV file, already parsed."""
+    def __init__(self, *names):
+        self.records = {name: {"Name": name, "Instructions": f"{name} instructions", "Guidelines": f"{name} guidelines"} 
+                        for name in names}
+
+    def version(self):
+        return "1"
+
+    def list_names(self, version):
+        return list(self.records)
+
+    def load_record(self, name, version):
+        return self.records.get(name)
+
+@pytest.fixture(autouse=True)
+def no_bundles(monkeypatch):
+    """Bundles are tested on their own, so the registry stores a placeholder."""
+    monkeypatch.setattr(tutor_data, "compile_bundle", lambda name, instructions, guidelines: {"name": name})
+
+@pytest.fixture
+def sqlite_backend(tmp_path):
+    return SQLiteBackend(str(tmp_path / "tutors.sqlite"))
+
+@pytest.fixture
+def object_store(monkeypatch):
+    monkeypatch.setattr(tutor_data, "check_conditional_writes", lambda: None)
+    return ObjectStoreBackend(FakeFS(), "bucket/tutors")
+
+@pytest.fixture(params=["sqlite_backend", "object_store"])
+def backend(request):
+    return request.getfixturevalue(request.param)
+
+def test_names_are_unique(backend):
+    registry = TutorRegistry(backend, refresh_interval=0)
+    registry.save_tutor("Physics", "Be kind.", "No answers.")
+    with pytest.raises(TutorExistsError):
+        registry.save_tutor("Physics", "Be strict.", "No answers.")
+    assert registry.get_instructions("Physics") == ("Be kind.", "No answers.")
+
+def test_overwrite_updates_the_tutor(backend):
+    registry = TutorRegistry(backend, refresh_interval=0)
+    registry.save_tutor("Physics", "Be kind.", "No answers.")
+    registry.get("Physics")
+    registry.save_tutor("Physics", "Be strict.", "No answers.", overwrite=True)
+    assert registry.get_instructions("Physics") == ("Be strict.", "No answers.")
+    assert registry.names() == ["Physics"]
+
+def test_updates_are_retried_after_a_conflict(backend, monkeypatch):
+    registry = TutorRegistry(backend, refresh_interval=0)
+    registry.save_tutor("Physics", "Be kind.", "No answers.")
+    update = backend.update
+    conflicts = []
+
+    def concurrent_update(record, expected_version):
+        # Someone else saves the tutor between our read and our write
+        if not conflicts:
+            conflicts.append(record["Name"])
+            update(dict(backend.load_record(record["Name"], None), Instructions="Theirs."), expected_version)
+        update(record, expected_version)
+
+    monkeypatch.setattr(backend, "update", concurrent_update)
+    registry.save_tutor("Physics", "Ours.", "No answers.", overwrite=True)
+    assert conflicts == ["Physics"]
+    assert registry.get_instructions("Physics") == ("Ours.", "No answers.")
+
+def test_updates_give_up_after_max_retries(backend, monkeypatch):
+    registry = TutorRegistry(backend, refresh_interval=0)
+    registry.save_tutor("Physics", "Be kind.", "No answers.")
+
+    def conflicting_update(record, expected_version):
+        raise VersionConflictError(record["Name"])
+
+    monkeypatch.setattr(backend, "update", conflicting_update)
+    with pytest.raises(VersionConflictError):
+        registry.save_tutor("Physics", "Ours.", "No answers.", overwrite=True, max_retries=2)
+
+def test_stale_updates_conflict(backend):
+    backend.create({"Name": "Physics", "Instructions": "Be kind.", "Guidelines": "No answers."})
+    record = backend.load_record("Physics", None)
+    backend.update(dict(record, Instructions="First."), record["Version"])
+    with pytest.raises(VersionConflictError):
+        backend.update(dict(record, Instructions="Second."), record["Version"])
+
+def test_missing_tutors(backend):
+    registry = TutorRegistry(backend, refresh_interval=0)
+    assert registry.get("Chemistry") is None
+    assert not registry.exists("Chemistry")
+    with pytest.raises(KeyError):
+        registry.get_instructions("Chemistry")
+
+def test_records_are_loaded_lazily_and_cached(sqlite_backend, monkeypatch):
+    registry = TutorRegistry(sqlite_backend, refresh_interval=0)
+    registry.save_tutor("Physics", "Be kind.", "No answers.")
+    registry.save_tutor("Chemistry", "Be kind.", "No answers.")
+    loads = []
+    load_record = sqlite_backend.load_record
+    monkeypatch.setattr(sqlite_backend, "load_record", lambda name, version: loads.append(name) or load_record(name, version))
+    registry.get("Physics")
+    registry.get("Physics")
+    assert loads == ["Physics"]
+
+def test_unchanged_object_store_is_checked_with_one_request(object_store):
+    registry = TutorRegistry(object_store, refresh_interval=0)
+    registry.save_tutor("Physics", "Be kind.", "No answers.")
+    assert registry.names() == ["Physics"]
+    fs = object_store.fs
+    fs.requests.clear()
+    registry.names()
+    registry.names()
+    assert fs.requests == {"head": 2}
+    # Another process adds a tutor, so the directory is listed once
+    ObjectStoreBackend(fs, "bucket/tutors").create({"Name": "Chemistry", "Instructions": "", "Guidelines": ""})
+    fs.requests.clear()
+    assert sorted(registry.names()) == ["Chemistry", "Physics"]
+    assert fs.requests["list"] == 1
+
+def test_object_store_without_a_version_object(object_store):
+    # Tutors stored before the version object was added
+    object_store.fs.files["bucket/tutors/Physics.json"] = b'{"Name": "Physics", "Instructions": "", "Guidelines": ""}'
+    registry = TutorRegistry(object_store, refresh_interval=0)
+    assert registry.names() == ["Physics"]
+
+def test_csv_import_runs_once(backend):
+    import_csv(FakeCSVBackend("AI Science Tutor", "Physics"), backend)
+    assert backend.imported()
+    import_csv(FakeCSVBackend("Chemistry"), backend)
+    registry = TutorRegistry(backend, refresh_interval=0)
+    assert sorted(registry.names()) == ["AI Science Tutor", "Physics"]
+    assert registry.get_instructions("AI Science Tutor") == ("AI Science Tutor instructions", "AI Science Tutor guidelines")
+
+class CountingBackend(FakeCSVBackend):
+    """A backend whose version can be bumped, which counts the version checks and listings."""
+    def __init__(self, *names):
+        super().__init__(*names)
+        self.current_version = 1
+        self.calls = Counter()
+
+    def version(self):
+        self.calls["version"] += 1
+        return str(self.current_version)
+
+    def list_names(self, version):
+        self.calls["list_names"] += 1
+        return super().list_names(version)
+
+    def load_record(self, name, version):
+        self.calls["load_record"] += 1
+        return super().load_record(name, version)
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(tutor_data.time, "time", lambda: now[0])
+    return now
+
+def test_the_version_is_checked_at_most_once_per_interval(clock):
+    backend = CountingBackend("Physics")
+    registry = TutorRegistry(backend, refresh_interval=30)
+    registry.names()
+    backend.records["Chemistry"] = {"Name": "Chemistry", "Instructions": "", "Guidelines": ""}
+    backend.current_version = 2
+    clock[0] += 10
+    assert registry.names() == ["Physics"]
+    assert backend.calls["version"] == 1
+    clock[0] += 20
+    assert registry.names() == ["Physics", "Chemistry"]
+    assert backend.calls == {"version": 2, "list_names": 2}
+
+def test_the_index_is_only_reloaded_when_the_version_changes(clock):
+    backend = CountingBackend("Physics")
+    registry = TutorRegistry(backend, refresh_interval=30)
+    for _ in range(3):
+        registry.names()
+        clock[0] += 30
+    assert backend.calls == {"version": 3, "list_names": 1}
+
+def test_forced_refreshes_ignore_the_interval(clock):
+    backend = CountingBackend("Physics")
+    registry = TutorRegistry(backend, refresh_interval=30)
+    registry.names()
+    backend.records["Chemistry"] = {"Name": "Chemistry", "Instructions": "", "Guidelines": ""}
+    backend.current_version = 2
+    registry.refresh(force=True)
+    assert registry.names() == ["Physics", "Chemistry"]
+
+def test_records_are_reloaded_when_the_version_changes(clock):
+    backend = CountingBackend("Physics")
+    registry = TutorRegistry(backend, refresh_interval=0)
+    assert backend.calls["load_record"] == 0
+    registry.get("Physics")
+    registry.get("Physics")
+    assert backend.calls["load_record"] == 1
+    backend.records["Physics"] = {"Name": "Physics", "Instructions": "Be strict.", "Guidelines": ""}
+    backend.current_version = 2
+    assert registry.get_instructions("Physics") == ("Be strict.", "")
+    assert backend.calls["load_record"] == 2
+
+def test_exists_asks_the_backend_about_names_missing_from_the_index(sqlite_backend, clock):
+    registry = TutorRegistry(sqlite_backend, refresh_interval=30)
+    assert registry.names() == []
+    # Created by another process since the last refresh
+    sqlite_backend.create({"Name": "Physics", "Instructions": "", "Guidelines": ""})
+    assert registry.exists("Physics")
+    assert not registry.exists("Chemistry")
@@ -0,0 +1,140 @@
+import time
+import logging
+from concurrent import futures
+
+from llama_index.core.llms import ChatMessage
+
+from tutor_llm import CORRECTION_DIRECTIONS, FALLBACK_RESPONSE, TutorChain
+
+class FakeTutor:
+    """Streams the given deltas, and adds the (possibly partial) response to the history like `AITutor`."""
+    def __init__(self, *deltas):
+        self.deltas = deltas
+        self.message_history = [ChatMessage(role="assistant", content="Hi! How can I help you today?")]
+
+    def stream_response(self, student_prompt):
+        self.message_history.append(ChatMessage(role="user", content=student_prompt))
+        response = ""
+        try:
+            for delta in self.deltas:
+                response += delta
+                yield delta
+        finally:
+            self.message_history.append(ChatMessage(role="assistant", content=response))
+
+class FakeModerator:
+    """Approves the responses for which `approve(ai_response, partial)` is true, and records every check."""
+    def __init__(self, approve=lambda ai_response, partial: True):
+        self.approve = approve
+        self.checks = []
+
+    async def acached_moderate_response(self, chat_history, ai_response, partial=False):
+        self.checks.append((ai_response, partial))
+        return "Feedback.", self.approve(ai_response, partial)
+
+    async def acorrect_response(self, chat_history, ai_response, moderator_feedback, direction=None):
+        return f"Corrected ({direction})"
+
+    def format_conversation(self, chat_history):
+        return ""
+
+def make_chain(tutor, moderator, **settings):
+    chain = TutorChain.__new__(TutorChain)
+    chain.tutor_llm = tutor
+    chain.moderator_llm = moderator
+    chain.max_corrections = 2
+    chain.deadline = 5
+    chain.n_candidates = 2
+    chain.segment_by = "paragraph"
+    chain.min_segment_length = 1
+    for name, value in settings.items():
+        setattr(chain, name, value)
+    return chain
+
+def test_approved_responses_are_returned():
+    moderator = FakeModerator()
+    chain = make_chain(FakeTutor("Think about ", "the forces.\n\n", "What acts on the ball?"), moderator)
+    assert chain.get_pipelined_response("Help") == "Think about the forces.\n\nWhat acts on the ball?"
+    assert ("Think about the forces.", True) in moderator.checks
+    assert ("Think about the forces.\n\nWhat acts on the ball?", False) in moderator.checks
+
+def test_the_full_response_is_checked_when_it_ends_on_a_segment_boundary():
+    moderator = FakeModerator(lambda ai_response, partial: partial or ai_response.startswith("Corrected"))
+    chain = make_chain(FakeTutor("The answer is 4.\n\n"), moderator)
+    assert chain.get_pipelined_response("Help").startswith("Corrected")
+    assert ("The answer is 4.", True) in moderator.checks
+    assert ("The answer is 4.", False) in moderator.checks
+
+def test_rejected_segments_are_corrected():
+    moderator = FakeModerator(lambda ai_response, partial: "answer" not in ai_response)
+    chain = make_chain(FakeTutor("The answer is 4.\n\n", "Well done!"), moderator)
+    response = chain.get_pipelined_response("Help")
+    assert response.startswith("Corrected")
+    assert chain.tutor_llm.message_history[-1].content == response
+
+def test_failed_checks_return_the_fallback_response(caplog):
+    def approve(ai_response, partial):
+        raise RuntimeError("The moderator is down")
+    chain = make_chain(FakeTutor("Think about the forces."), FakeModerator(approve))
+    with caplog.at_level(logging.ERROR, logger="tutor_llm"):
+        assert chain.get_pipelined_response("Help") == FALLBACK_RESPONSE
+    assert "A moderation check failed" in caplog.text
+    assert "The moderator is down" in caplog.text
+
+def test_first_rejection():
+    approved, rejected = futures.Future(), futures.Future()
+    approved.set_result(("Fine.", True))
+    rejected.set_result(("Gives the answer.", False))
+    assert TutorChain.first_rejection([approved]) is None
+    assert TutorChain.first_rejection([approved, rejected]) == ("Gives the answer.", False)
+
+def test_unfinished_checks_are_logged(caplog):
+    running, cancelled = futures.Future(), futures.Future()
+    cancelled.cancel()
+    with caplog.at_level(logging.WARNING, logger="tutor_llm"):
+        assert TutorChain.first_rejection([running]) == (None, False)
+        assert TutorChain.first_rejection([cancelled]) == (None, False)
+    assert "did not finish before the deadline" in caplog.text
+    assert "was cancelled" in caplog.text
+
+class FlakyModerator(FakeModerator):
+    """Fails to write the corrections with the given directions."""
+    def __init__(self, failing_directions, approve=lambda ai_response, partial: True):
+        super().__init__(approve)
+        self.failing_directions = failing_directions
+
+    async def acorrect_response(self, chat_history, ai_response, moderator_feedback, direction=None):
+        if direction in self.failing_directions:
+            raise RuntimeError(f"The correction with direction {direction!r} failed")
+        return await super().acorrect_response(chat_history, ai_response, moderator_feedback, direction)
+
+def correct(chain):
+    return chain.correct([], "The answer is 4.", "Gives the answer.", deadline=time.monotonic() + 5)
+
+def test_failed_candidates_are_skipped(caplog):
+    moderator = FlakyModerator(failing_directions=[None])
+    with caplog.at_level(logging.ERROR, logger="tutor_llm"):
+        assert correct(make_chain(FakeTutor(), moderator)) == f"Corrected ({CORRECTION_DIRECTIONS[1]})"
+    assert "A correction candidate failed" in caplog.text
+
+def test_fallback_response_when_every_candidate_fails(caplog):
+    moderator = FlakyModerator(failing_directions=CORRECTION_DIRECTIONS)
+    with caplog.at_level(logging.ERROR, logger="tutor_llm"):
+        assert correct(make_chain(FakeTutor(), moderator)) == FALLBACK_RESPONSE
+    assert caplog.text.count("A correction candidate failed") == 2
+
+def test_rejected_candidates_are_corrected_again():
+    # Only the second round of corrections is approved
+    moderator = FakeModerator(lambda ai_response, partial: ai_response.startswith("Corrected: Corrected"))
+
+    async def acorrect_response(chat_history, ai_response, moderator_feedback, direction=None):
+        return f"Corrected: {ai_response}"
+
+    moderator.acorrect_response = acorrect_response
+    assert correct(make_chain(FakeTutor(), moderator)) == "Corrected: Corrected: The answer is 4."
+
+def test_fallback_response_after_max_corrections():
+    moderator = FakeModerator(lambda ai_response, partial: False)
+    assert correct(make_chain(FakeTutor(), moderator, max_corrections=2)) == FALLBACK_RESPONSE
+    # Each round moderates one candidate per direction
+    assert len(moderator.checks) == 4
@@ -0,0 +1,65 @@
+import time
+import json
+import hashlib
+import tiktoken
+from chatbot_llm import AITutor, GREETING
+from moderator_llm import ContentModerator
+from moderation_prefilter import compile_rules, serialize_rules, deserialize_rules
+
+# Increase when the contents of the bundles change, so older bundles are recompiled
+BUNDLE_FORMAT = 2
+
+def bundle_version(instructions, guidelines, greeting=GREETING):
+    """Content hash of everything a bundle is compiled from."""
+    source = json.dumps([BUNDLE_FORMAT, instructions, guidelines, greeting])
+    return hashlib.sha256(source.encode()).hexdigest()[:16]
+
+def compile_bundle(name, instructions, guidelines, greeting=GREETING, model='gpt-4o-mini'):
+    """
+    Prepares everything a tutor needs ahead of time, so that loading the tutor does not rebuild it.
+
+    Args:
+        name (str): The name of the tutor.
+        instructions (str): The tutor's instructions.
+        guidelines (str): The moderation guidelines.
+        greeting (str): The tutor's opening message.
+        model (str): The model used to count tokens.
+
+    Returns:
+        dict: The versioned bundle, with the prepared system, moderation and correction prompts,
+              the compiled prefilter rules, the greeting and the token counts of each.
+    """
+    try:
+        tokenizer = tiktoken.encoding_for_model(model)
+    except KeyError:
+        tokenizer = tiktoken.get_encoding('cl100k_base')
+
+    bundle = {"format": BUNDLE_FORMAT,
+              "version": bundle_version(instructions, guidelines, greeting),
+              "compiled_at": time.time(),
+              "name": name,
+              "instructions": instructions,
+              "guidelines": guidelines,
+              "system_prompt": AITutor.build_system_prompt(instructions),
+              "moderation_prompt": ContentModerator.build_moderation_prompt(guidelines),
+              "correction_prompt": ContentModerator.build_correction_prompt(guidelines),
+              "greeting": greeting,
+              "rules": serialize_rules(compile_rules(guidelines))}
+    bundle["token_counts"] = {key: len(tokenizer.encode(bundle[key]))
+                              for key in ("system_prompt", "moderation_prompt", "correction_prompt", "greeting")}
+    return bundle
+
+def is_current(bundle, instructions, guidelines):
+    """Checks whether a bundle was compiled from the given instructions and guidelines in the current format."""
+    return (bundle is not None and
+            bundle.get("format") == BUNDLE_FORMAT and
+            bundle.get("version") == bundle_version(instructions, guidelines, bundle.get("greeting", GREETING)))
+
+# Compiled prefilter rules of each bundle version, shared by every session in the process
+compiled_rules = {}
+
+def load_rules(bundle):
+    """Returns the bundle's compiled prefilter rules."""
+    if bundle["version"] not in compiled_rules:
+        compiled_rules[bundle["version"]] = deserialize_rules(bundle["rules"])
+    return compiled_rules[bundle["version"]]
@@ -1,27 +1,395 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from urllib.parse import quote, unquote
 import streamlit as st
 import pandas as pd
 from st_files_connection import FilesConnection
+from tutor_bundle import compile_bundle, is_current
 
-def read_csv(fn):
-    # Create connection object and retrieve file contents.
-    conn = st.connection('s3', type=FilesConnection, ttl=0)
-    # Return pandas dataframe
-    return conn.read(fn, input_format="csv", ttl=0) 
+### Tutor Registry
+
+class TutorExistsError(Exception):
+    """Raised when creating a tutor with a name that is already taken."""
+
+class VersionConflictError(Exception):
+    """Raised when a tutor was changed by someone else since it was read."""
+
+class CSVBackend:
+    """
+    Reads the tutors from a CSV file (with Name, Instructions and Guidelines columns) on any 
+    fsspec filesystem, such as the S3 filesystem of the `FilesConnection` or the local filesystem.
+    The file is only downloaded again when its ETag (or modification time) has changed.
+    """
+    def __init__(self, fs, path):
+        self.fs = fs
+        self.path = path
+        self.snapshot_version = None
+        self.records = {}
+
+    def version(self):
+        """Returns the ETag or modification time of the file, which only needs a metadata request."""
+        self.fs.invalidate_cache(self.path)
+        info = self.fs.info(self.path)
+        return str(info.get("ETag") or info.get("LastModified") or info.get("mtime"))
+
+    def load(self, version):
+        # Download and parse the file once per version
+        if version != self.snapshot_version:
+            with self.fs.open(self.path, "rt") as f:
+                df = pd.read_csv(f)
+            self.records = {row["Name"]: {"Name": row["Name"], 
+                                          "Instructions": row["Instructions"], 
+                                          "Guidelines": row["Guidelines"]} 
+                            for row in df.to_dict("records")}
+            self.snapshot_version = version
+
+    def list_names(self, version):
+        self.load(version)
+        return list(self.records)
+
+    def load_record(self, name, version):
+        self.load(version)
+        return self.records.get(name)
+
+def check_conditional_writes():
+    """
+    Raises an error if the installed botocore can't send conditional writes (If-None-Match and 
+    If-Match on PutObject), which older versions silently drop, so tutors could be overwritten.
+    """
+    import botocore.session
+    put_object = botocore.session.get_session().get_service_model("s3").operation_model("PutObject")
+    missing = {"IfNoneMatch", "IfMatch"} - set(put_object.input_shape.members)
+    if missing:
+        raise RuntimeError(f"botocore {botocore.__version__} does not support conditional writes "
+                           f"({', '.join(sorted(missing))}); upgrade s3fs and botocore (see requirements.txt).")
+
+class ObjectStoreBackend:
+    """
+    Stores one JSON object per tutor in a directory of an fsspec filesystem (e.g. S3), keyed by the 
+    tutor's name. Creating a tutor is a single conditional write (If-None-Match), so two teachers
+    can never create a tutor with the same name, and updates only succeed if the tutor has not 
+    changed since it was read (If-Match on its ETag). Neither needs to read the other tutors.
+    Every write also replaces a small version object, so checking for changes only needs its ETag
+    and the directory is only listed when something has changed.
+
+    **Note:** Conditional writes require S3 (or an S3-compatible store that supports them) and
+    a version of botocore that sends them (see `check_conditional_writes`).
+    """
+    def __init__(self, fs, directory):
+        check_conditional_writes()
+        self.fs = fs
+        self.directory = directory.rstrip("/")
+
+    def key(self, name):
+        return f"{self.directory}/{quote(name, safe='')}.json"
+
+    def list_entries(self):
+        self.fs.invalidate_cache(self.directory)
+        if not self.fs.exists(self.directory):
+            return []
+        return [entry for entry in self.fs.ls(self.directory, detail=True) if entry["name"].endswith(".json")]
+
+    def version(self):
+        """The ETag of the version object (a single metadata request, without listing the tutors)."""
+        path = self.version_key()
+        self.fs.invalidate_cache(path)
+        try:
+            info = self.fs.info(path)
+        except FileNotFoundError:
+            # Tutors stored before the version object was added
+            self.touch()
+            info = self.fs.info(path)
+        return str(info.get("ETag") or info.get("LastModified") or info.get("mtime"))
+
+    def touch(self):
+        """Replaces the version object, so that every registry reloads its index."""
+        self.fs.pipe_file(self.version_key(), uuid.uuid4().hex.encode())
+
+    def version_key(self):
+        # Not a .json file, so it is not listed as a tutor
+        return f"{self.directory}/.version"
+
+    def list_names(self, version):
+        return [unquote(os.path.basename(entry["name"])[:-len(".json")]) for entry in self.list_entries()]
+
+    def load_record(self, name, version):
+        try:
+            with self.fs.open(self.key(name), "rb") as f:
+                record = json.loads(f.read())
+                record["Version"] = f.details.get("ETag")
+        except FileNotFoundError:
+            return None
+        return record
+
+    def exists(self, name):
+        self.fs.invalidate_cache(self.key(name))
+        return self.fs.exists(self.key(name))
+
+    def imported(self):
+        """Checks whether the tutors have been imported from the legacy CSV file (see `import_csv`)."""
+        self.fs.invalidate_cache(self.marker_key())
+        return self.fs.exists(self.marker_key())
+
+    def mark_imported(self):
+        self.fs.pipe_file(self.marker_key(), b"")
+
+    def marker_key(self):
+        # Not a .json file, so it is not listed as a tutor
+        return f"{self.directory}/.csv-imported"
+
+    def create(self, record):
+        """Stores a new tutor, raising TutorExistsError if the name is taken."""
+        path = self.key(record["Name"])
+        try:
+            self.fs.pipe_file(path, json.dumps(record).encode(), IfNoneMatch="*")
+        except OSError:
+            if self.exists(record["Name"]):
+                raise TutorExistsError(record["Name"])
+            raise
+        self.touch()
+
+    def update(self, record, expected_version):
+        """Overwrites a tutor, raising VersionConflictError if it has changed since `expected_version`."""
+        path = self.key(record["Name"])
+        data = {key: value for key, value in record.items() if key != "Version"}
+        try:
+            self.fs.pipe_file(path, json.dumps(data).encode(), IfMatch=expected_version)
+        except OSError:
+            self.fs.invalidate_cache(path)
+            if self.fs.info(path).get("ETag") != expected_version:
+                raise VersionConflictError(record["Name"])
+            raise
+        self.touch()
+
+class SQLiteBackend:
+    """
+    Stores one row per tutor in a local SQLite database, so single tutors can be read without reading
+    the others. Can stand in for S3 when developing or testing.
+    """
+    def __init__(self, path="tutors.sqlite"):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS tutors (
+                                name TEXT PRIMARY KEY,
+                                instructions TEXT,
+                                guidelines TEXT,
+                                bundle TEXT,
+                                version INTEGER DEFAULT 1)""")
+        # Bumped on every write, so readers can cheaply check for changes
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)")
+        self.conn.execute("INSERT OR IGNORE INTO meta VALUES ('version', 0)")
+        self.conn.commit()
+        self.lock = threading.Lock()
+
+    def version(self):
+        with self.lock:
+            return str(self.conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0])
+
+    def list_names(self, version):
+        with self.lock:
+            return [name for name, in self.conn.execute("SELECT name FROM tutors")]
+
+    def load_record(self, name, version):
+        with self.lock:
+            row = self.conn.execute("SELECT name, instructions, guidelines, bundle, version FROM tutors WHERE name = ?",
+                                    (name,)).fetchone()
+        if row is None:
+            return None
+        record = dict(zip(["Name", "Instructions", "Guidelines", "Bundle", "Version"], row))
+        record["Bundle"] = json.loads(record["Bundle"]) if record["Bundle"] else None
+        return record
+
+    def exists(self, name):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM tutors WHERE name = ?", (name,)).fetchone() is not None
+
+    def imported(self):
+        """Checks whether the tutors have been imported from the legacy CSV file (see `import_csv`)."""
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM meta WHERE key = 'csv_imported'").fetchone() is not None
+
+    def mark_imported(self):
+        with self.lock:
+            with self.conn:
+                self.conn.execute("INSERT OR IGNORE INTO meta VALUES ('csv_imported', 1)")
+
+    def create(self, record):
+        """Stores a new tutor, raising TutorExistsError if the name is taken."""
+        with self.lock:
+            try:
+                with self.conn:
+                    self.conn.execute("INSERT INTO tutors (name, instructions, guidelines, bundle) VALUES (?, ?, ?, ?)",
+                                      (record["Name"], record["Instructions"], record["Guidelines"], 
+                                       json.dumps(record.get("Bundle"))))
+                    self.conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+            except sqlite3.IntegrityError:
+                raise TutorExistsError(record["Name"])
+
+    def update(self, record, expected_version):
+        """Overwrites a tutor, raising VersionConflictError if it has changed since `expected_version`."""
+        with self.lock:
+            with self.conn:
+                cursor = self.conn.execute("""UPDATE tutors SET instructions = ?, guidelines = ?, bundle = ?, 
+                                              version = version + 1 WHERE name = ? AND version = ?""",
+                                           (record["Instructions"], record["Guidelines"], json.dumps(record.get("Bundle")),
+                                            record["Name"], expected_version))
+                if cursor.rowcount == 0:
+                    raise VersionConflictError(record["Name"])
+                self.conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+
+class TutorRegistry:
+    """
+    An in-process index of the tutors, shared by every session.
+
+    The names of the tutors are kept in an index that is refreshed only when the backend's version 
+    (ETag, modification time or write counter) has changed, which is checked at most once every
+    `refresh_interval` seconds. Tutor records are loaded lazily and cached until the version changes,
+    so opening a tutor does not depend on the total number of tutors.
+
+    Attributes:
+        backend (ObjectStoreBackend, SQLiteBackend or CSVBackend): Where the tutors are stored 
+                 (the CSVBackend is read-only).
+        index (dict): Maps each tutor name to its record (None until the record is loaded).
+    """
+    def __init__(self, backend, refresh_interval=30):
+        self.backend = backend
+        self.refresh_interval = refresh_interval
+        self.version = None
+        self.index = {}
+        self.checked = 0
+        self.lock = threading.Lock()
+
+    def refresh(self, force=False):
+        """Reloads the index if the stored tutors have changed."""
+        with self.lock:
+            if not force and time.time() - self.checked < self.refresh_interval:
+                return
+            version = self.backend.version()
+            self.checked = time.time()
+            if version != self.version:
+                self.index = dict.fromkeys(self.backend.list_names(version))
+                self.version = version
+
+    def names(self):
+        """Returns the names of all the tutors."""
+        self.refresh()
+        return list(self.index)
+
+    def exists(self, name):
+        """Checks whether a tutor exists, asking the backend directly when the name is not in the index."""
+        self.refresh()
+        if name in self.index:
+            return True
+        return self.backend.exists(name) if hasattr(self.backend, "exists") else False
+
+    def get(self, name):
+        """Returns the record (Name, Instructions and Guidelines) of a tutor, or None if it does not exist."""
+        self.refresh()
+        with self.lock:
+            if name not in self.index:
+                return None
+            record = self.index[name]
+            version = self.version
+        if record is None:
+            record = self.backend.load_record(name, version)
+            with self.lock:
+                # Don't cache the record if the index was reloaded while it was loading
+                if self.version == version and name in self.index:
+                    self.index[name] = record
+        return record
+
+    def get_instructions(self, name):
+        """Returns the instructions and guidelines of a tutor."""
+        record = self.get(name)
+        if record is None:
+            raise KeyError(f"No entry found for {name}")
+        return record["Instructions"], record["Guidelines"]
+
+    def save_tutor(self, name, instructions, guidelines, overwrite=False, max_retries=3):
+        """
+        Creates a tutor, or updates it if `overwrite` is True and it already exists.
+
+        The name is checked for uniqueness by the backend as part of the write. Updates are 
+        retried if the tutor is changed by someone else at the same time. The tutor's bundle 
+        (see `tutor_bundle.compile_bundle`) is compiled and stored with it.
+
+        Raises:
+            TutorExistsError: If the name is taken and `overwrite` is False.
+            VersionConflictError: If the update still conflicts after `max_retries` retries.
+        """
+        record = {"Name": name, "Instructions": instructions, "Guidelines": guidelines,
+                  "Bundle": compile_bundle(name, instructions, guidelines)}
+        try:
+            self.backend.create(record)
+        except TutorExistsError:
+            if not overwrite:
+                raise
+            for attempt in range(max_retries + 1):
+                current = self.backend.load_record(name, None)
+                try:
+                    if current is None:
+                        # The tutor was deleted since it was found, so create it again
+                        self.backend.create(record)
+                    else:
+                        self.backend.update(record, current["Version"])
+                    break
+                except (VersionConflictError, TutorExistsError):
+                    if attempt == max_retries:
+                        raise
+        # The new record is loaded lazily the next time it is used
+        with self.lock:
+            self.index[name] = None
+
+    def get_bundle(self, name):
+        """
+        Returns the compiled bundle of a tutor. Tutors saved without a (current) bundle are compiled
+        once and the bundle is kept with the cached record.
+        """
+        record = self.get(name)
+        if record is None:
+            raise KeyError(f"No entry found for {name}")
+        if not is_current(record.get("Bundle"), record["Instructions"], record["Guidelines"]):
+            record["Bundle"] = compile_bundle(name, record["Instructions"], record["Guidelines"])
+        return record["Bundle"]
+
+    def warm(self, names=None):
+        """Loads and compiles the bundles of the given tutors (or all tutors) ahead of time, e.g. before class."""
+        for name in names if names is not None else self.names():
+            self.get_bundle(name)
+
+def import_csv(csv_backend, backend):
+    """
+    Copies the tutors from the legacy CSV file into another backend, skipping tutors that already exist.
+    The backend is marked as imported once every tutor has been copied, so an import that was 
+    interrupted is resumed the next time rather than skipped.
+    """
+    if backend.imported():
+        return
+    version = csv_backend.version()
+    for name in csv_backend.list_names(version):
+        try:
+            backend.create(csv_backend.load_record(name, version))
+        except TutorExistsError:
+            pass
+    backend.mark_imported()
 
-def write_csv(fn, df):
-    # Create connection object and write file contents.
+@st.cache_resource
+def get_registry(fn):
+    """
+    Returns the tutor registry, shared by every session in the process. Set AI_TUTORS_DB to 
+    use a local SQLite database instead of S3. Either is seeded with the tutors from the legacy
+    CSV file the first time it is used.
+    """
     conn = st.connection('s3', type=FilesConnection, ttl=0)
-    with conn.open(fn, "wt") as f:
-        df.to_csv(f, index=False)
-
-def select_instructions(df, tool_name):
-    # Select the row where the Name matches the given name
-    selected_row = df[df["Name"] == tool_name]
-
-    # Extract the Instructions and Guidelines for the selected row
-    if not selected_row.empty:
-        instructions = selected_row["Instructions"].values[0]
-        guidelines = selected_row["Guidelines"].values[0]
-        return instructions, guidelines
+    tutors_db = os.environ.get("AI_TUTORS_DB")
+    if tutors_db:
+        backend = SQLiteBackend(tutors_db)
     else:
-        print(f"No entry found for {name_to_find}")
\ No newline at end of file
+        # One object per tutor, next to the legacy CSV file (e.g. ai-tutors/tutor_info.csv -> ai-tutors/tutors/)
+        backend = ObjectStoreBackend(conn.fs, os.path.join(os.path.dirname(fn), "tutors"))
+    if not backend.imported() and conn.fs.exists(fn):
+        import_csv(CSVBackend(conn.fs, fn), backend)
+    return TutorRegistry(backend)
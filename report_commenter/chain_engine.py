@@ -1,29 +1,79 @@
 import os
+import sys
+import re
+import csv
 import pandas as pd
+import asyncio
+import tiktoken
 from io import BytesIO
+from collections import Counter
 from llama_index.core.llms import ChatMessage
 from llama_index.core.prompts import PromptTemplate
 from llama_index.llms.openai import OpenAI
 from llama_index.llms.gemini import Gemini
+# The LLM cache and the async LLM layer are shared by every app
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared'))
+from llm_cache import CachedLLM, get_disk_cache
+from async_llm import http_client, run
 
 openai_api_key = os.environ["OPENAI_API_KEY"]
 gemini_api_key = os.environ["GEMINI_API_KEY"]
 
+# Name line added before each dropped file's contents (e.g. "**grades.csv**")
+FILE_MARKER_PATTERN = re.compile(r"^\*\*[^*]+\*\*$")
+
+# Sent when a shard's response is retried
+RETRY_NOTE = "Write the comments for every student above, in the usual response format with the \"## REPORT CARD COMMENTS\" table."
+
+def parse_table(lines):
+    """
+    Parses the lines of a file as a delimited (e.g. comma or tab separated) table.
+
+    Args:
+        lines (list): The non-empty lines, starting with the column header
+    Returns:
+        list or None: The fields of each line, or None if the lines are not a consistent table
+    """
+    if len(lines) < 2:
+        return None
+    for delimiter in [',', '\t', ';', '|']:
+        rows = list(csv.reader(lines, delimiter=delimiter))
+        n_columns = len(rows[0])
+        if n_columns >= 2 and all(len(row) == n_columns for row in rows) and all(row[0].strip() for row in rows):
+            return rows
+    return None
+
 class ReportCardCommentor:
     """
     A class designed to interact with an LLM (Large Language Model) to generate personalized
     report card comments for students based on provided data and user instructions.
     """
-    def __init__(self, model="gpt-4o-mini"):
+    def __init__(self, model="gpt-4o-mini", history_token_budget=16000):
 
         if 'gpt' in model:
-            self.llm = OpenAI(model=model, api_key=openai_api_key)
+            # Async calls share the process's connection-pooled HTTP client
+            self.llm = OpenAI(model=model, api_key=openai_api_key, async_http_client=http_client)
         elif 'gemini' in model:
             self.llm = Gemini(model=model, api_key=gemini_api_key)
         else:
             raise ValueError(f"Invalid model: {model}")
+        # Deterministic (temperature 0) calls are cached on disk. The comments are sampled, 
+        # so they are generated again every time (e.g. when the teacher regenerates them).
+        self.llm = CachedLLM(self.llm, cache=get_disk_cache())
 
         self.message_history = [ChatMessage(role="system", content=self.get_system_prompt())]
+
+        # Tokenizer used to measure the size of the message history
+        try:
+            self.tokenizer = tiktoken.encoding_for_model(model)
+        except KeyError:
+            self.tokenizer = tiktoken.get_encoding("cl100k_base")
+        # Maximum number of tokens in the message history before older feedback is dropped
+        self.history_token_budget = history_token_budget
+        # All of the feedback provided by the user so far
+        self.feedback_history = []
+        # Number of tokens saved by compacting the message history on each feedback turn
+        self.compaction_stats = []
     
     def get_system_prompt(self) -> str:
         """Generates the system prompt template for the chatbot LLM."""
@@ -97,6 +147,21 @@ The comments should be written in a way that is ALIGNED WITH THE COMMENT EXAMPLE
 {input_description}
 """
     
+    def prepare_initial_prompt(self, instructions, comment_examples, sentence_range, 
+                               output_description, student_data, input_description) -> str:
+        """Fills in defaults for any missing user settings and creates the initial prompt."""
+        instructions = instructions if instructions else "No specific instructions provided."
+        comment_examples = comment_examples if comment_examples else "No comment examples provided."
+        output_description = output_description if output_description else "One column for the student name and one column for the comment."
+        input_description = input_description if input_description else "The student data formatting is self-explanatory."
+
+        return self.initial_prompt_template(instructions, 
+                                            comment_examples, 
+                                            sentence_range, 
+                                            output_description, 
+                                            student_data, 
+                                            input_description)
+
     def extract_comments(self, message):
         try:
             # Split from the last occurrence of "## REPORT CARD COMMENTS"
@@ -125,49 +190,527 @@ The comments should be written in a way that is ALIGNED WITH THE COMMENT EXAMPLE
         Returns:
             str: The generated report card comments
         """
-        instructions = instructions if instructions else "No specific instructions provided."
-        comment_examples = comment_examples if comment_examples else "No comment examples provided."
-        output_description = output_description if output_description else "One column for the student name and one column for the comment."
-        input_description = input_description if input_description else "The student data formatting is self-explanatory."
-
         # Create the initial prompt
-        prompt = self.initial_prompt_template(instructions, 
-                                              comment_examples, 
-                                              sentence_range, 
-                                              output_description, 
-                                              student_data, 
-                                              input_description)
+        prompt = self.prepare_initial_prompt(instructions, 
+                                             comment_examples, 
+                                             sentence_range, 
+                                             output_description, 
+                                             student_data, 
+                                             input_description)
         print(prompt)
         self.message_history.append(ChatMessage(role="user", content=prompt))
         # Generate the initial comments
         entire_response = self.llm.chat(self.message_history).message.content
-        # Add the initial response to the message history
+        # Return the initial response, comments, and feedback request
+        return self.add_response(entire_response)
+
+    async def aget_initial_comments(self, instructions, comment_examples, sentence_range, 
+                                    output_description, student_data, input_description) -> str:
+        """Async version of `get_initial_comments`."""
+        prompt = self.prepare_initial_prompt(instructions, 
+                                             comment_examples, 
+                                             sentence_range, 
+                                             output_description, 
+                                             student_data, 
+                                             input_description)
+        self.message_history.append(ChatMessage(role="user", content=prompt))
+        entire_response = (await self.llm.achat(self.message_history)).message.content
+        return self.add_response(entire_response)
+
+    def add_response(self, entire_response):
+        """
+        Adds the LLM's response to the message history.
+
+        Args:
+            entire_response (str): The LLM's response
+        Returns:
+            tuple: The response, the comments, and the comments with the feedback request
+        """
         self.message_history.append(ChatMessage(role="assistant", content=entire_response))
         # Extract the comments and feedback request
         comments, feedback_request = self.extract_comments(entire_response)
-        # Return the initial response, comments, and feedback request
         return entire_response, comments, comments + "\n\n" + feedback_request
 
-    def user_input(self, message):
+    def stream_response(self):
         """
-        Processes user input and generates a response.
+        Prompts the LLM with the message history and streams the response as it is generated.
+
+        The "## REPORT CARD COMMENTS" table is parsed incrementally: each line is only parsed
+        once it has been completed, so table rows become available as soon as they are written.
+        Once the response is complete, it is added to the message history.
+
+        Yields:
+            dict: A dictionary containing:
+                - response (str): The response generated so far.
+                - comments (str): The completed rows of the comments table so far.
+                - done (bool): Whether the response is complete.
+                - feedback (str): The comments and feedback request (only when done).
+        """
+        entire_response = ""
+        rows = []
+        in_table = False
+        line_start = 0
+        for chunk in self.llm.stream_chat(self.message_history):
+            entire_response += chunk.delta or ""
+            # Parse the lines that have been completed since the last chunk
+            line_end = entire_response.find('\n', line_start)
+            while line_end != -1:
+                line = entire_response[line_start:line_end].strip()
+                if line.startswith("## REPORT CARD COMMENTS"):
+                    in_table = True
+                elif in_table and line.startswith('|'):
+                    rows.append(line)
+                elif in_table and line.startswith('---'):
+                    in_table = False
+                line_start = line_end + 1
+                line_end = entire_response.find('\n', line_start)
+            yield {"response": entire_response, "comments": '\n'.join(rows), "done": False}
+
+        # Add the response to the message history
+        self.message_history.append(ChatMessage(role="assistant", content=entire_response))
+        # Extract the comments and feedback request
+        comments, feedback_request = self.extract_comments(entire_response)
+        yield {"response": entire_response, 
+               "comments": comments, 
+               "done": True,
+               "feedback": comments + "\n\n" + feedback_request}
+
+    def stream_initial_comments(self, instructions, comment_examples, sentence_range, 
+                                output_description, student_data, input_description):
+        """
+        Streaming version of `get_initial_comments`.
+
+        Args:
+            instructions (str): Instructions for the report card comments
+            comment_examples (str): Examples of high quality comments
+            sentence_range (list): The range of sentences per comment
+            output_description (str): The description of the output table
+            student_data (str): The student data
+            input_description (str): The description of the student data
+        Yields:
+            dict: The streamed response (see `stream_response`)
+        """
+        prompt = self.prepare_initial_prompt(instructions, 
+                                             comment_examples, 
+                                             sentence_range, 
+                                             output_description, 
+                                             student_data, 
+                                             input_description)
+        self.message_history.append(ChatMessage(role="user", content=prompt))
+        yield from self.stream_response()
+
+    def stream_user_input(self, message):
+        """
+        Streaming version of `user_input`.
+
+        Args:
+            message (str): The user's input message
+        Yields:
+            dict: The streamed response (see `stream_response`)
+        """
+        self.compact_history()
+        self.feedback_history.append(message)
+        self.message_history.append(ChatMessage(role="user", content=message))
+        yield from self.stream_response()
+
+    def count_tokens(self, messages):
+        """Counts the number of tokens in the content of a list of messages."""
+        return sum(len(self.tokenizer.encode(message.content or "")) for message in messages)
+
+    def feedback_summary_template(self, feedback_history) -> str:
+        """Generates a summary of the feedback that has already been applied to the comments."""
+        feedback = '\n'.join(f"- {' '.join(message.split())}" for message in feedback_history)
+        return f"""
+## Earlier Feedback
+
+The latest comments below have already been revised based on the following feedback:
+
+{feedback}
+"""
+
+    def compact_history(self):
+        """
+        Compacts the message history before a new feedback turn.
+
+        The system prompt and the original prompt with the student data are always kept. 
+        Every earlier comments table is replaced by the latest response, and the earlier 
+        feedback is replaced by a short summary. If the history is still larger than the 
+        token budget, the oldest feedback is dropped from the summary.
+
+        Returns:
+            dict: The number of tokens before and after compaction, and the tokens saved.
+        """
+        tokens_before = self.count_tokens(self.message_history)
+        if len(self.message_history) > 3 and self.message_history[-1].role.value == 'assistant':
+            system_prompt, initial_prompt = self.message_history[:2]
+            latest_response = self.message_history[-1]
+            feedback_history = list(self.feedback_history)
+            while True:
+                summary = []
+                if feedback_history:
+                    summary = [ChatMessage(role="user", content=self.feedback_summary_template(feedback_history))]
+                compacted_history = [system_prompt, initial_prompt] + summary + [latest_response]
+                if (not feedback_history or self.history_token_budget is None or 
+                        self.count_tokens(compacted_history) <= self.history_token_budget):
+                    break
+                # Drop the oldest feedback to stay within the token budget
+                feedback_history.pop(0)
+            self.message_history = compacted_history
+        tokens_after = self.count_tokens(self.message_history)
+
+        stats = {"turn": len(self.compaction_stats) + 1,
+                 "tokens_before": tokens_before, 
+                 "tokens_after": tokens_after, 
+                 "tokens_saved": tokens_before - tokens_after}
+        self.compaction_stats.append(stats)
+        return stats
+
+    def total_tokens_saved(self):
+        """Returns the total number of tokens saved by compacting the message history."""
+        return sum(stats["tokens_saved"] for stats in self.compaction_stats)
+
+    def split_student_data(self, student_data, shard_size=1):
+        """
+        Splits tabular student data into shards of at most `shard_size` students.
+
+        The data may contain several files, each starting with a "**file name**" line (added when 
+        files are dropped in the app). The first line of each file is its column header, which is 
+        repeated (along with the file name) at the top of every shard from that file, so that each 
+        shard can be understood on its own. Each remaining line is one student (e.g. a row in a .csv file).
+
+        Args:
+            student_data (str): The student data
+            shard_size (int): The maximum number of students per shard
+        Returns:
+            list or None: (shard data, student names) pairs, or None if the data is not tabular 
+                          (e.g. free-form notes), in which case it should not be split.
+        """
+        # Split the data into files
+        files = []
+        name, lines = None, []
+        for line in student_data.strip().split('\n'):
+            if FILE_MARKER_PATTERN.match(line.strip()):
+                files.append((name, lines))
+                name, lines = line.strip(), []
+            elif line.strip():
+                lines.append(line)
+        files.append((name, lines))
+
+        shard_size = max(1, int(shard_size))
+        shards = []
+        for name, lines in files:
+            if not lines:
+                continue
+            rows = parse_table(lines)
+            if rows is None:
+                return None
+            header = [name, lines[0]] if name else [lines[0]]
+            for i in range(1, len(lines), shard_size):
+                students = [row[0].strip() for row in rows[i:i + shard_size]]
+                shards.append(('\n'.join(header + lines[i:i + shard_size]), students))
+        return shards
+
+    def merge_comment_tables(self, tables):
+        """
+        Merges several markdown tables (one per shard) into a single markdown table.
+
+        The header and separator lines are taken from the first table that has them,
+        and only the body rows are kept from the remaining tables.
+
+        Args:
+            tables (list): The markdown tables to merge
+        Returns:
+            str: The merged markdown table
+        """
+        header_lines = []
+        body_lines = []
+        for table in tables:
+            header, rows = self.split_comment_table(table)
+            if not header_lines:
+                header_lines = header
+            body_lines += rows
+        return '\n'.join(header_lines + body_lines)
+
+    def get_batch_comments(self, instructions, comment_examples, sentence_range, 
+                           output_description, student_data, input_description, 
+                           shard_size=1, max_workers=4, max_retries=2) -> str:
+        """
+        Generates report card comments by splitting the student data into shards and 
+        prompting the LLM for each shard concurrently (on the shared event loop). The comments from every shard are 
+        merged into a single markdown table, so the output has the same format as 
+        `get_initial_comments`.
+
+        A shard that fails (or whose response has no comments table) is retried on its own. If it 
+        still fails, the comments from the other shards are kept and the response names the students 
+        whose comments are missing. Data that is not tabular is not split (see `get_initial_comments`).
+
+        Args:
+            instructions (str): Instructions for the report card comments
+            comment_examples (str): Examples of high quality comments
+            sentence_range (list): The range of sentences per comment
+            output_description (str): The description of the output table
+            student_data (str): The student data
+            input_description (str): The description of the student data
+            shard_size (int): The maximum number of students per shard
+            max_workers (int): The maximum number of concurrent LLM calls
+            max_retries (int): The number of times a failed shard is retried
+        Returns:
+            str: The generated report card comments
+        """
+        return run(self.aget_batch_comments(instructions, comment_examples, sentence_range, 
+                                            output_description, student_data, input_description, 
+                                            shard_size, max_workers, max_retries))
+
+    async def aget_batch_comments(self, instructions, comment_examples, sentence_range, 
+                                  output_description, student_data, input_description, 
+                                  shard_size=1, max_workers=4, max_retries=2) -> str:
+        """Async version of `get_batch_comments`."""
+        shards = self.split_student_data(student_data, shard_size)
+        if shards is None or len(shards) <= 1:
+            # Free-form (or small) data is written in a single prompt
+            return await self.aget_initial_comments(instructions, comment_examples, sentence_range, 
+                                                    output_description, student_data, input_description)
+        limit = asyncio.Semaphore(max(1, int(max_workers)))
+
+        async def generate_shard(shard_data, retry=False):
+            # Each shard is an independent conversation with the system prompt
+            prompt = self.prepare_initial_prompt(instructions, 
+                                                 comment_examples, 
+                                                 sentence_range, 
+                                                 output_description, 
+                                                 shard_data, 
+                                                 input_description)
+            messages = [self.message_history[0], ChatMessage(role="user", content=prompt)]
+            if retry:
+                # Also changes the request, so an earlier (cached) malformed response is not reused
+                messages.append(ChatMessage(role="user", content=RETRY_NOTE))
+            async with limit:
+                response = (await self.llm.achat(messages)).message.content
+            comments, feedback_request = self.extract_comments(response)
+            if not self.split_comment_table(comments)[1]:
+                raise ValueError("The response did not include a comments table.")
+            return comments, feedback_request
+
+        # Generate the comments for each shard concurrently (results keep the shard order)
+        results = await asyncio.gather(*[generate_shard(data) for data, _ in shards], return_exceptions=True)
+        for _ in range(max_retries):
+            failed = [i for i, result in enumerate(results) if isinstance(result, Exception)]
+            if not failed:
+                break
+            retries = await asyncio.gather(*[generate_shard(shards[i][0], retry=True) for i in failed], 
+                                           return_exceptions=True)
+            for i, result in zip(failed, retries):
+                results[i] = result
+
+        failed = [i for i, result in enumerate(results) if isinstance(result, Exception)]
+        if len(failed) == len(shards):
+            raise results[0]
+        shard_comments = [result for result in results if not isinstance(result, Exception)]
+
+        # Merge the tables from each shard
+        comments = self.merge_comment_tables([c for c, _ in shard_comments])
+        feedback_request = shard_comments[0][1]
+        if failed:
+            missing = '\n'.join(f"- Batch {i + 1} of {len(shards)} ({', '.join(shards[i][1])}): {results[i]}" 
+                                 for i in failed)
+            feedback_request = (f"**Comments could not be written for these students:**\n\n{missing}\n\n"
+                                f"Ask me to write their comments.\n\n{feedback_request}")
+        entire_response = f"## REPORT CARD COMMENTS\n\n{comments}\n\n---\n\n{feedback_request}"
+
+        # Record the full data and merged response so that feedback applies to all students
+        prompt = self.prepare_initial_prompt(instructions, 
+                                             comment_examples, 
+                                             sentence_range, 
+                                             output_description, 
+                                             student_data, 
+                                             input_description)
+        self.message_history.append(ChatMessage(role="user", content=prompt))
+        self.message_history.append(ChatMessage(role="assistant", content=entire_response))
+        # Return the merged response, comments, and feedback request
+        return entire_response, comments, comments + "\n\n" + feedback_request
+
+    def split_comment_table(self, comments):
+        """
+        Splits a markdown comments table into its header lines and body rows.
+
+        Args:
+            comments (str): The markdown table
+        Returns:
+            tuple: The header lines (header row and separator) and the body rows
+        """
+        lines = [line.strip() for line in comments.split('\n') if line.strip().startswith('|')]
+        if not lines:
+            return [], []
+        n_header = 2 if len(lines) > 1 and lines[1].startswith('|-') else 1
+        return lines[:n_header], [line for line in lines[n_header:] if not line.startswith('|-')]
+
+    def row_name(self, row):
+        """Returns the student name (the first column) of a table row, normalised for comparison."""
+        return ' '.join(row.strip('|').split('|')[0].split()).lower()
+
+    def name_tokens(self, name):
+        """Returns the parts of a student name, first name first ("First Middle Last" or "Last, First Middle")."""
+        if ',' in name:
+            # Names formatted as "Last, First Middle"
+            last, first = [part.split() for part in name.split(',', 1)]
+            return first + last
+        return name.split()
+
+    def name_patterns(self, name):
+        """
+        Returns the ways a student's name may be written in the user's feedback: the full name 
+        and, for names with more than one part, the first and last names ("First Last" or "Last, First").
+
+        Args:
+            name (str): The student name from the comments table
+        Returns:
+            list: The names to search for
+        """
+        tokens = self.name_tokens(name)
+        patterns = [name]
+        if len(tokens) > 1:
+            patterns += [f"{tokens[0]} {tokens[-1]}", f"{tokens[-1]}, {tokens[0]}"]
+        return patterns
+
+    def find_target_rows(self, rows, message):
+        """
+        Finds the table rows for the students that are named in the user's feedback.
+
+        A row is targeted if the student's full name, or their first and last names, 
+        appear as whole words in the feedback (e.g. "Jane Doe's comment"). A first or last 
+        name on its own (e.g. "Jane's comment") also targets the row if no other student in 
+        the table has that name. Single names (e.g. "Will") are only matched with the same 
+        capitalisation as in the table, so ordinary words don't match them.
+
+        Args:
+            rows (list): The body rows of the comments table
+            message (str): The user's feedback
+        Returns:
+            list: The indices of the targeted rows
+        """
+        written_names = [row.strip('|').split('|')[0].strip() for row in rows]
+        # The number of students with each first or last name
+        name_counts = Counter()
+        for written_name in written_names:
+            tokens = self.name_tokens(written_name)
+            name_counts.update({token.lower() for token in tokens[:1] + tokens[-1:]})
+        targets = []
+        for i, (row, written_name) in enumerate(zip(rows, written_names)):
+            name = self.row_name(row)
+            if not name:
+                continue
+            if ' ' in name or ',' in name:
+                found = any(re.search(rf'\b{re.escape(pattern)}\b', message, re.IGNORECASE) 
+                            for pattern in self.name_patterns(name))
+                tokens = self.name_tokens(written_name)
+                if not found and len(tokens) > 1:
+                    # Match a first or last name on its own (as written in the table) if it is unique
+                    found = any(name_counts[part.lower()] == 1 and re.search(rf'\b{re.escape(part)}\b', message)
+                                for part in (tokens[0], tokens[-1]))
+            else:
+                # Match single names as written in the table
+                found = re.search(rf'\b{re.escape(written_name)}\b', message) is not None
+            if found:
+                targets.append(i)
+        return targets
+
+    def targeted_prompt_template(self, message, header, target_rows) -> str:
+        """Generates the prompt used to only rewrite the comments targeted by the user's feedback."""
+        table = '\n'.join(header + target_rows)
+        return f"""
+## User Feedback
+
+{message}
+
+## Comments to Revise
+
+{table}
+
+## Your Task
+
+Apply the user's feedback to ONLY the comments listed above. The other comments will not be changed.
+
+Follow the usual response format, but the "## REPORT CARD COMMENTS" table should ONLY INCLUDE THE {len(target_rows)} ROWS LISTED ABOVE, in the same order and with the same columns.
+"""
+
+    def targeted_user_input(self, message):
+        """
+        Processes user feedback by only regenerating the comments for the students named in the feedback. 
+        The remaining rows are reused from the latest comments table. If the feedback does not 
+        target specific students, the whole table is regenerated with `user_input`.
 
         Args:
             message (str): The user's input message
         Returns:
             str: The generated response
         """
-        # Add user prompt to history
+        self.compact_history()
+        # Parse the latest comments table
+        latest_comments, _ = self.extract_comments(self.message_history[-1].content)
+        header, rows = self.split_comment_table(latest_comments)
+        targets = self.find_target_rows(rows, message)
+        if not header or not targets or len(targets) == len(rows):
+            return self.user_input(message, compact=False)
+
+        # Only ask the LLM to rewrite the targeted rows
+        prompt = self.targeted_prompt_template(message, header, [rows[i] for i in targets])
+        response = self.llm.chat(self.message_history + [ChatMessage(role="user", content=prompt)]).message.content
+        revised_comments, feedback_request = self.extract_comments(response)
+        _, revised_rows = self.split_comment_table(revised_comments)
+        # Match the revised rows to the targeted rows by student name
+        revised_by_name = {self.row_name(row): row for row in revised_rows}
+        target_names = [self.row_name(rows[i]) for i in targets]
+        all_names = [self.row_name(row) for row in rows]
+        if (len(revised_by_name) != len(revised_rows) 
+                or set(revised_by_name) != set(target_names)
+                or any(all_names.count(name) > 1 for name in target_names)):
+            # The LLM did not return every targeted student exactly once (or a name is ambiguous), 
+            # so fall back to regenerating the table
+            return self.user_input(message, compact=False)
+
+        # Splice the revised rows into the latest table
+        for i, name in zip(targets, target_names):
+            rows[i] = revised_by_name[name]
+        comments = '\n'.join(header + rows)
+        entire_response = f"## REPORT CARD COMMENTS\n\n{comments}\n\n---\n\n{feedback_request}"
+
+        # Record the feedback and the full updated table in the message history
+        self.feedback_history.append(message)
         self.message_history.append(ChatMessage(role="user", content=message))
-        # Prompt LLM with history
-        entire_response = self.llm.chat(self.message_history).message.content
-        # Extract the comments and feedback request
-        comments, feedback_request = self.extract_comments(entire_response)
-        # Add the response to the message history
         self.message_history.append(ChatMessage(role="assistant", content=entire_response))
         # Return the response, comments, and feedback request
         return entire_response, comments, comments + "\n\n" + feedback_request
 
+    def user_input(self, message, compact=True):
+        """
+        Processes user input and generates a response.
+
+        Args:
+            message (str): The user's input message
+            compact (bool): Whether to compact the message history first
+        Returns:
+            str: The generated response
+        """
+        self.add_user_input(message, compact)
+        # Prompt LLM with history
+        entire_response = self.llm.chat(self.message_history).message.content
+        # Return the response, comments, and feedback request
+        return self.add_response(entire_response)
+
+    async def auser_input(self, message, compact=True):
+        """Async version of `user_input`."""
+        self.add_user_input(message, compact)
+        entire_response = (await self.llm.achat(self.message_history)).message.content
+        return self.add_response(entire_response)
+
+    def add_user_input(self, message, compact=True):
+        """Adds the user's feedback to the message history, compacting the history first if `compact` is set."""
+        if compact:
+            self.compact_history()
+        # Add user prompt to history
+        self.feedback_history.append(message)
+        self.message_history.append(ChatMessage(role="user", content=message))
+
     
     def produce_list(self, comments):
         """Convert markdown table to CSV format."""
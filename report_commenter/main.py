@@ -162,6 +162,8 @@ if not st.session_state.more_settings:
     input_description = ""
     sentence_range = (3, 6)
     output_description = ""
+    batch_mode = False
+    shard_size = 5
 else:
     ###
 
@@ -206,6 +208,16 @@ else:
                                     label_visibility='hidden', 
                                     placeholder='e.g. The output should have the following columns: "Student Name", "Comment".')
 
+    ###
+
+    st.markdown('----')
+    st.markdown('### Batch Generation ⚡')
+    st.markdown('Have a large class? Generate the comments for small groups of students at the same time. This assumes your data has one row per student.')
+    batch_mode = st.checkbox("Generate comments in batches")
+    shard_size = st.slider("Students per batch", 
+                           min_value=1, max_value=10, value=5, 
+                           disabled=not batch_mode)
+
 if "model_loaded" not in st.session_state:
     st.session_state.model_loaded = False
 if "messages" not in st.session_state:
@@ -214,6 +226,19 @@ if "messages" not in st.session_state:
 if "model_loads" not in st.session_state:
     st.session_state["model_loads"] = 0
 
+def write_comment_stream(updates, status):
+    """Displays the comment table while it is being generated and returns the final update."""
+    with st.chat_message("assistant", avatar=avatar["assistant"]):
+        placeholder = st.empty()
+        placeholder.markdown(status)
+        for update in updates:
+            if update["done"]:
+                placeholder.markdown(rf"{update['feedback']}")
+            elif update["comments"]:
+                # Show the rows that have been completed so far
+                placeholder.markdown(rf"{update['comments']}")
+    return update
+
 # Button to initialize process
 if "init_model" not in st.session_state:
     st.session_state["init_model"] = False
@@ -235,25 +260,36 @@ if st.session_state.init_model:
         if not st.session_state.model_loaded:
             # Reset conversation
             st.session_state["messages"] = []
-            # Initialize pipeline
-            with st.spinner('Generating initial comments...'):
-                # Construct pipiline
-                st.session_state['comment_pipeline'] = ReportCardCommentor(model="gpt-4o-mini")
-                st.session_state.model_loads +=1
-                # Run initial prompt
-                print(instructions)
-                entire_response, comments, response = st.session_state.comment_pipeline.get_initial_comments(instructions, 
-                                                                                                             comment_examples,
-                                                                                                             sentence_range, 
-                                                                                                             output_description, 
-                                                                                                             student_data, 
-                                                                                                             input_description)
-                st.session_state["report_comments"] = comments
-                st.session_state.messages.append({"role": "assistant", "content": rf"{response}"})
+            # Construct pipiline
+            st.session_state['comment_pipeline'] = ReportCardCommentor(model="gpt-4o-mini")
+            st.session_state.model_loads +=1
+            # Run initial prompt
+            print(instructions)
+            if batch_mode:
+                with st.spinner('Generating initial comments...'):
+                    entire_response, comments, response = st.session_state.comment_pipeline.get_batch_comments(instructions, 
+                                                                                                               comment_examples,
+                                                                                                               sentence_range, 
+                                                                                                               output_description, 
+                                                                                                               student_data, 
+                                                                                                               input_description,
+                                                                                                               shard_size=shard_size)
                 st.chat_message("assistant", avatar=avatar["assistant"]).markdown(rf"{response}")
-                st.session_state.model_loaded = True
-                st.session_state.init_model = False
-                st.rerun()
+            else:
+                # Stream the comments so that rows are displayed as soon as they are written
+                update = write_comment_stream(st.session_state.comment_pipeline.stream_initial_comments(instructions, 
+                                                                                                        comment_examples,
+                                                                                                        sentence_range, 
+                                                                                                        output_description, 
+                                                                                                        student_data, 
+                                                                                                        input_description),
+                                              status='Generating initial comments...')
+                comments, response = update["comments"], update["feedback"]
+            st.session_state["report_comments"] = comments
+            st.session_state.messages.append({"role": "assistant", "content": rf"{response}"})
+            st.session_state.model_loaded = True
+            st.session_state.init_model = False
+            st.rerun()
     else:
         st.error("Please either upload a file or paste your student data in the text area.")
 
@@ -305,13 +341,20 @@ if len(st.session_state.messages)>0:
     
 # Only show chat if model has been loaded
 if st.session_state.model_loaded:
+    targeted_edits = st.checkbox("Only rewrite the comments for students named in my feedback",
+                                 help="Faster for large classes. Feedback that does not name a student still updates every comment.")
     if prompt := st.chat_input():
         st.session_state.messages.append({"role": "user", "content": rf"{prompt}"})
         st.chat_message("user", avatar=avatar["user"]).write(prompt)
-        with st.spinner('Applying edits...'):
-            # Apply edits
-            entire_response, comments, response = st.session_state.comment_pipeline.user_input(prompt)
+        # Apply edits
+        if targeted_edits:
+            with st.spinner('Applying edits...'):
+                entire_response, comments, response = st.session_state.comment_pipeline.targeted_user_input(prompt)
+            st.chat_message("assistant", avatar=avatar["assistant"]).markdown(rf"{response}")
+        else:
+            update = write_comment_stream(st.session_state.comment_pipeline.stream_user_input(prompt),
+                                          status='Applying edits...')
+            comments, response = update["comments"], update["feedback"]
         st.session_state.report_comments = comments
         st.session_state.messages.append({"role": "assistant", "content": rf"{response}"})
-        st.chat_message("assistant", avatar=avatar["assistant"]).markdown(rf"{response}")
         st.rerun()
\ No newline at end of file
@@ -0,0 +1,225 @@
+import pytest
+from llama_index.core.llms import ChatMessage, ChatResponse
+
+from chain_engine import RETRY_NOTE, ReportCardCommentor, parse_table
+
+HEADER = "| Student Name | Comment |\n|--------------|---------|"
+
+def table(*rows):
+    return '\n'.join([HEADER] + [f"| {name} | {comment} |" for name, comment in rows])
+
+def response(*rows):
+    return f"Plan...\n\n## REPORT CARD COMMENTS\n\n{table(*rows)}\n\n---\n\nAny changes?"
+
+class ScriptedLLM:
+    """Returns the given responses in order, and records the messages of each call."""
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    def chat(self, messages, **kwargs):
+        self.calls.append(messages)
+        return ChatResponse(message=ChatMessage(role="assistant", content=self.responses.pop(0)))
+
+    async def achat(self, messages, **kwargs):
+        return self.chat(messages, **kwargs)
+
+@pytest.fixture
+def commentor():
+    return ReportCardCommentor()
+
+def rows(*names):
+    return [f"| {name} | A comment. |" for name in names]
+
+@pytest.mark.parametrize("message", ["Make Jane Doe's comment shorter",
+                                     "make jane doe's comment shorter",
+                                     "Doe, Jane needs more detail",
+                                     "Jane's comment is too long",
+                                     "Please fix Doe's comment"])
+def test_a_student_is_targeted_by_any_unique_name(commentor, message):
+    assert commentor.find_target_rows(rows("Jane Doe", "Sam Lee", "Ana Ruiz"), message) == [0]
+
+def test_middle_names_and_last_first_order_are_matched(commentor):
+    table_rows = rows("Doe, Jane Marie", "Lee, Sam")
+    assert commentor.find_target_rows(table_rows, "Jane Doe needs more detail") == [0]
+    assert commentor.find_target_rows(table_rows, "Sam's comment is too long") == [1]
+
+def test_shared_first_names_are_not_matched_alone(commentor):
+    table_rows = rows("Jane Doe", "Jane Smith", "Sam Lee")
+    assert commentor.find_target_rows(table_rows, "Make Jane's comment shorter") == []
+    assert commentor.find_target_rows(table_rows, "Make Jane Smith's comment shorter") == [1]
+    assert commentor.find_target_rows(table_rows, "Make Smith's comment shorter") == [1]
+
+def test_single_names_only_match_as_written(commentor):
+    table_rows = rows("Will", "Grace Hopper")
+    assert commentor.find_target_rows(table_rows, "Will's comment is great") == [0]
+    assert commentor.find_target_rows(table_rows, "These comments will need more grace") == []
+
+def test_targeted_feedback_only_rewrites_the_named_rows(commentor):
+    original = [("Jane Doe", "Old comment."), ("Sam Lee", "Sam's comment.")]
+    commentor.message_history.append(ChatMessage(role="assistant", content=response(*original)))
+    commentor.llm = ScriptedLLM(response(("Jane Doe", "Short.")))
+    _, comments, _ = commentor.targeted_user_input("Make Jane's comment shorter")
+    assert comments == table(("Jane Doe", "Short."), ("Sam Lee", "Sam's comment."))
+    # Only the targeted row was sent to the LLM
+    prompt = commentor.llm.calls[0][-1].content
+    assert "Jane Doe" in prompt and "Sam's comment." not in prompt
+    assert commentor.feedback_history == ["Make Jane's comment shorter"]
+
+def test_targeted_feedback_falls_back_when_rows_do_not_match(commentor):
+    original = [("Jane Doe", "Old comment."), ("Sam Lee", "Sam's comment.")]
+    commentor.message_history.append(ChatMessage(role="assistant", content=response(*original)))
+    regenerated = response(("Jane Doe", "New."), ("Sam Lee", "New too."))
+    commentor.llm = ScriptedLLM(response(("Janet Doe", "Short.")), regenerated)
+    _, comments, _ = commentor.targeted_user_input("Make Jane's comment shorter")
+    assert comments == table(("Jane Doe", "New."), ("Sam Lee", "New too."))
+    assert len(commentor.llm.calls) == 2
+
+STUDENT_DATA = """**grades.csv**
+Name,Grade
+Jane Doe,A
+Sam Lee,B
+Ana Ruiz,C"""
+
+class ShardLLM:
+    """Writes a comment for every student in the prompt, failing the shards listed in `failures` that many times."""
+    def __init__(self, failures=None):
+        self.failures = dict(failures or {})
+        self.prompts = []
+
+    async def achat(self, messages, **kwargs):
+        prompt = messages[1].content
+        self.prompts.append([message.content for message in messages[1:]])
+        names = [name for name in ("Jane Doe", "Sam Lee", "Ana Ruiz") if f"\n{name}," in prompt]
+        for name in names:
+            if self.failures.get(name):
+                self.failures[name] -= 1
+                raise ConnectionError(f"The request for {name} failed")
+        content = response(*[(name, f"{name.split()[0]} did well.") for name in names])
+        return ChatResponse(message=ChatMessage(role="assistant", content=content))
+
+def batch_comments(commentor, shard_size=1, max_retries=2):
+    return commentor.get_batch_comments("Be kind.", "", [2, 3], "", STUDENT_DATA, "", 
+                                        shard_size=shard_size, max_retries=max_retries)
+
+def test_parse_table_detects_the_delimiter():
+    assert parse_table(["Name\tGrade", "Jane Doe\tA"]) == [["Name", "Grade"], ["Jane Doe", "A"]]
+    assert parse_table(["Name,Grade", "Jane Doe,A"]) == [["Name", "Grade"], ["Jane Doe", "A"]]
+    # Free-form notes, and a single line, are not tables
+    assert parse_table(["Jane did well, mostly.", "Sam needs to focus"]) is None
+    assert parse_table(["Name,Grade"]) is None
+
+def test_student_data_is_split_into_shards_with_the_header(commentor):
+    shards = commentor.split_student_data(STUDENT_DATA, shard_size=2)
+    assert shards == [("**grades.csv**\nName,Grade\nJane Doe,A\nSam Lee,B", ["Jane Doe", "Sam Lee"]),
+                      ("**grades.csv**\nName,Grade\nAna Ruiz,C", ["Ana Ruiz"])]
+
+def test_each_file_is_split_on_its_own(commentor):
+    data = STUDENT_DATA + "\n**notes.tsv**\nName\tNote\nJane Doe\tQuiet"
+    shards = commentor.split_student_data(data, shard_size=5)
+    assert [students for _, students in shards] == [["Jane Doe", "Sam Lee", "Ana Ruiz"], ["Jane Doe"]]
+    assert shards[1][0] == "**notes.tsv**\nName\tNote\nJane Doe\tQuiet"
+
+def test_free_form_data_is_not_split(commentor):
+    assert commentor.split_student_data("Jane did well this term.\nSam needs to focus.") is None
+
+def test_shards_are_merged_in_order(commentor):
+    commentor.llm = ShardLLM()
+    _, comments, _ = batch_comments(commentor)
+    assert comments == table(("Jane Doe", "Jane did well."), ("Sam Lee", "Sam did well."), ("Ana Ruiz", "Ana did well."))
+    assert len(commentor.llm.prompts) == 3
+    # The full data and the merged table are recorded, so feedback applies to every student
+    assert "Ana Ruiz,C" in commentor.message_history[-2].content
+    assert comments in commentor.message_history[-1].content
+
+def test_failed_shards_are_retried(commentor):
+    commentor.llm = ShardLLM(failures={"Sam Lee": 1})
+    _, comments, feedback = batch_comments(commentor)
+    assert "| Sam Lee | Sam did well. |" in comments
+    assert "could not be written" not in feedback
+    # The retry changes the request, so a cached malformed response is not reused
+    assert [prompt[-1] for prompt in commentor.llm.prompts if len(prompt) > 1] == [RETRY_NOTE]
+
+def test_students_of_shards_that_keep_failing_are_named(commentor):
+    commentor.llm = ShardLLM(failures={"Sam Lee": 10})
+    _, comments, feedback = batch_comments(commentor, max_retries=1)
+    assert "Sam Lee" not in comments
+    assert comments.count("did well") == 2
+    assert "Batch 2 of 3 (Sam Lee)" in feedback
+
+def test_an_error_is_raised_when_every_shard_fails(commentor):
+    commentor.llm = ShardLLM(failures={"Jane Doe": 10, "Sam Lee": 10, "Ana Ruiz": 10})
+    with pytest.raises(ConnectionError):
+        batch_comments(commentor, max_retries=1)
+
+def test_merge_comment_tables_keeps_one_header(commentor):
+    merged = commentor.merge_comment_tables([table(("Jane Doe", "Good.")), "No table here", table(("Sam Lee", "Fine."))])
+    assert merged == table(("Jane Doe", "Good."), ("Sam Lee", "Fine."))
+
+class StreamingLLM:
+    """Streams the given deltas."""
+    def __init__(self, *deltas):
+        self.deltas = deltas
+
+    def stream_chat(self, messages, **kwargs):
+        for delta in self.deltas:
+            yield ChatResponse(message=ChatMessage(role="assistant", content=delta), delta=delta)
+
+def test_table_rows_are_streamed_once_they_are_complete(commentor):
+    commentor.llm = StreamingLLM("Plan...\n\n## REPORT CARD COMMENTS\n\n", HEADER + "\n| Jane Doe | Gre",
+                                 "at work. |\n| Sam Lee | Fine. |\n", "\n---\n\nAny changes?")
+    updates = list(commentor.stream_initial_comments("Be kind.", "", [2, 3], "", "Jane Doe\nSam Lee", ""))
+    assert [update["comments"] for update in updates[:-1]] == [
+        "",
+        HEADER,
+        table(("Jane Doe", "Great work."), ("Sam Lee", "Fine.")),
+        table(("Jane Doe", "Great work."), ("Sam Lee", "Fine.")),
+    ]
+    final = updates[-1]
+    assert final["done"]
+    assert final["comments"] == table(("Jane Doe", "Great work."), ("Sam Lee", "Fine."))
+    assert final["feedback"].endswith("Any changes?")
+    assert commentor.message_history[-1].content == final["response"]
+
+def test_streamed_feedback_is_recorded(commentor):
+    commentor.message_history.append(ChatMessage(role="assistant", content=response(("Jane Doe", "Old."))))
+    commentor.llm = StreamingLLM(response(("Jane Doe", "New.")))
+    updates = list(commentor.stream_user_input("Make it shorter"))
+    assert updates[-1]["comments"] == table(("Jane Doe", "New."))
+    assert commentor.feedback_history == ["Make it shorter"]
+
+def start_session(commentor, *feedback):
+    """Creates a session with the initial comments and a revision for each piece of feedback."""
+    commentor.message_history.append(ChatMessage(role="user", content="Initial prompt with the student data"))
+    commentor.message_history.append(ChatMessage(role="assistant", content=response(("Jane Doe", "Version 0."))))
+    for i, message in enumerate(feedback, 1):
+        commentor.llm = ScriptedLLM(response(("Jane Doe", f"Version {i}.")))
+        commentor.user_input(message)
+
+def test_history_keeps_the_prompt_latest_comments_and_feedback_summary(commentor):
+    start_session(commentor, "Shorter please", "Mention effort")
+    stats = commentor.compact_history()
+    roles = [message.role.value for message in commentor.message_history]
+    assert roles == ["system", "user", "user", "assistant"]
+    summary = commentor.message_history[2].content
+    assert "- Shorter please\n- Mention effort" in summary
+    assert commentor.message_history[-1].content == response(("Jane Doe", "Version 2."))
+    assert stats["tokens_saved"] == stats["tokens_before"] - stats["tokens_after"] > 0
+
+def test_history_is_not_compacted_before_the_first_feedback(commentor):
+    start_session(commentor)
+    history = list(commentor.message_history)
+    assert commentor.compact_history()["tokens_saved"] == 0
+    assert commentor.message_history == history
+
+def test_oldest_feedback_is_dropped_to_fit_the_budget(commentor):
+    start_session(commentor, "First feedback", "Second feedback", "Third feedback")
+    latest_summary = ChatMessage(role="user", content=commentor.feedback_summary_template(["Third feedback"]))
+    commentor.history_token_budget = commentor.count_tokens(commentor.message_history[:2] + [latest_summary] + 
+                                                            commentor.message_history[-1:])
+    commentor.compact_history()
+    summary = commentor.message_history[2].content
+    assert "Third feedback" in summary
+    assert "First feedback" not in summary
+    assert commentor.count_tokens(commentor.message_history) <= commentor.history_token_budget
+    assert commentor.total_tokens_saved() == sum(stats["tokens_saved"] for stats in commentor.compaction_stats)
@@ -5,10 +5,14 @@ cur_dir = os.path.dirname(__file__)
 sys.path.append(cur_dir)
 from drop_file import extract_text_from_different_file_types
 from tutor_llm import TutorChain
+from resources import get_llm
 
 # Streamlit
 st.set_page_config(page_title="AI Science Tutor", page_icon="https://raw.githubusercontent.com/teaghan/educational-prompt-engineering/main/images/science_tutor_favicon_small.png", layout="wide")
 
+# Create the shared LLM client on the first page load, so its connection is open before the first student message
+get_llm(model='gpt-4o-mini', temperature=0.4)
+
 # Avatar images
 avatar = {"user": "https://raw.githubusercontent.com/teaghan/educational-prompt-engineering/main/images/science_student_avatar.png",
           "assistant": "https://raw.githubusercontent.com/teaghan/educational-prompt-engineering/main/images/science_tutor_avatar.png"}
@@ -90,6 +94,11 @@ if st.session_state.drop_file:
             else:  # if it is not zip, the return is a string (here we concatenate the strings)
                 prompt_f = prompt_f + extract + "\n\n"
 
+# Moderate each paragraph of the response while the rest is being generated
+pipelined = st.sidebar.toggle("Moderate while responding", value=True, 
+                              help="Check the response paragraph by paragraph as it is written, "
+                                   "so an inappropriate response is stopped and corrected sooner.")
+
 # Display conversation
 if len(st.session_state.messages)>0:
     for msg in st.session_state.messages:
@@ -122,6 +131,7 @@ if prompt := st.chat_input():
 
     # Use a spinner to indicate processing and display the assistant's response after processing
     #with st.spinner('Thinking...'):
+    st.session_state.tutor_llm.pipelined = pipelined
     response = st.session_state.tutor_llm.get_response(prompt_full)
     st.session_state.messages.append({"role": "assistant", "content": rf"{response}"})    
     
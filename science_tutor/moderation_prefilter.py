@@ -0,0 +1,144 @@
+import re
+import threading
+from collections import Counter
+
+# Statements that give away the answer instead of guiding the student towards it. The phrases must start
+# a sentence that is not a question (e.g. "What do you think the answer is?" does not match), so that
+# guiding questions are not rejected.
+ANSWER_LEAK_PATTERNS = [r"(?:^|[.!:]\s+)(?:so,? )?the (?:final |correct |right )?answer (?:is|would be)\b(?![^.!?\n]*\?)",
+                        r"(?:^|[.!:]\s+)(?:so,? )?the solution is\b(?![^.!?\n]*\?)",
+                        r"(?:^|[.!:]\s+)so the answers? (?:is|are|would be)\b(?![^.!?\n]*\?)",
+                        # A value solved for an unknown (e.g. "x = 4"), rather than arithmetic like "2 + 3 = 5"
+                        r"(?<![+\-*/^]\s)(?<![+\-*/^])\b[a-zA-Z]\s*=\s*-?\d[\d,]*(?:\.\d+)?\b(?![^.!?\n]*\?)"]
+
+# Responses that are provably safe to approve without the LLM moderator: a greeting or offer of help
+# with nothing else in it (e.g. "Hi! How can I help you today?")
+SAFE_RESPONSE_PATTERN = re.compile(r"^\W*(?=\w)(?:(?:hi|hello|hey|you're welcome|good (?:morning|afternoon|evening))"
+                                   r"(?: there)?\W*)?(?:(?:how|what) can i help(?: you)?(?: with)?(?: today)?\W*)?$",
+                                   re.IGNORECASE)
+
+# Words in a guideline sentence that mark the quoted phrases or code in that sentence as forbidden
+PROHIBITION_PATTERN = re.compile(r"\b(?:never|avoid|don't|do not|must not)\b", re.IGNORECASE)
+
+def compile_rules(guidelines):
+    """
+    Compiles simple regular expression rules from the moderation guidelines.
+
+    Any quoted phrase or `code` in a guideline sentence that prohibits something (e.g. "Avoid
+    discouraging phrases like "You're wrong"" or "NEVER USE `\\(`") becomes a flagged pattern.
+    Quoted examples of what to do instead (after "Instead") are ignored. If the guidelines
+    mention answers, the answer-leak patterns are added as well.
+
+    Arguments:
+        guidelines (str): The moderation guidelines.
+
+    Returns:
+        list: (pattern, reason) pairs, where the reason is passed to the LLM moderator as a hint.
+    """
+    rules = []
+    for sentence in re.split(r"(?<=[.!?])\s+|(?<=[.!?][\"”])\s+|(?<=[.!?]\*\*)\s+|\n", guidelines):
+        match = PROHIBITION_PATTERN.search(sentence)
+        if not match:
+            continue
+        # Only the text after the prohibition (and before any alternative) is forbidden
+        forbidden = re.split(r"\binstead\b", sentence[match.start():], flags=re.IGNORECASE)[0]
+        reason = sentence.strip(" -*")
+        for phrase in re.findall(r"[\"“]([^\"”]{3,})[\"”]", forbidden):
+            rules.append((re.compile(re.escape(phrase.strip(" .,!?")), re.IGNORECASE), reason))
+        for code in re.findall(r"`([^`]+)`", forbidden):
+            rules.append((re.compile(re.escape(code)), reason))
+    if "answer" in guidelines.lower():
+        for pattern in ANSWER_LEAK_PATTERNS:
+            rules.append((re.compile(pattern, re.IGNORECASE | re.MULTILINE),
+                          "The response gives the student the answer."))
+    return rules
+
+def serialize_rules(rules):
+    """Converts compiled rules into JSON-serializable [pattern, flags, reason] lists (e.g. for tutor bundles)."""
+    return [[pattern.pattern, pattern.flags, reason] for pattern, reason in rules]
+
+def deserialize_rules(serialized_rules):
+    """Converts rules from `serialize_rules` back into (pattern, reason) pairs."""
+    return [(re.compile(pattern, flags), reason) for pattern, flags, reason in serialized_rules]
+
+class ModerationPrefilter:
+    """
+    Cheap, CPU-only moderation checks that run before the LLM moderator.
+
+    Responses are decided without the LLM moderator when the checks are confident:
+        1. Safe responses (a greeting with nothing else in it) are approved.
+        2. Empty responses are rejected.
+        3. Rules: responses matching a phrase the guidelines prohibit, or an answer-leak pattern, are rejected.
+        4. Classifier (optional): responses that a local model finds very likely to violate the guidelines
+           are rejected.
+    Every other response is escalated to the LLM moderator, with a hint if the classifier flagged it.
+
+    Attributes:
+        rules (list): The compiled (pattern, reason) rules.
+        classifier (callable, optional): Takes the response text and returns the probability of a violation.
+        flag_threshold (float): The probability from which the classifier's flag is passed to the LLM moderator.
+        reject_threshold (float): The probability from which the classifier rejects the response on its own.
+        stats (Counter): The number of responses decided by each tier.
+    """
+    def __init__(self, guidelines, classifier=None, flag_threshold=0.5, reject_threshold=0.9, rules=None):
+        # Rules may be compiled ahead of time
+        self.rules = rules if rules is not None else compile_rules(guidelines)
+        self.classifier = classifier
+        self.flag_threshold = flag_threshold
+        self.reject_threshold = reject_threshold
+        self.stats = Counter()
+        self.lock = threading.Lock()
+
+    def record(self, tier):
+        """Records that a response was decided by the given tier."""
+        with self.lock:
+            self.stats[tier] += 1
+
+    def hit_rates(self):
+        """Returns the fraction of responses decided by each tier."""
+        with self.lock:
+            stats = dict(self.stats)
+        total = sum(stats.values())
+        return {tier: count / total for tier, count in stats.items()} if total else {}
+
+    def check(self, ai_response, partial=False):
+        """
+        Decides the AI response if the checks are confident (see the class docstring).
+
+        Arguments:
+            ai_response (str): The response provided by the AI tutor that needs moderation.
+            partial (bool): Whether the response is still being generated.
+
+        Returns:
+            tuple or None: The moderator's feedback and whether the response is appropriate,
+                           or None if the response should be escalated to the LLM moderator.
+        """
+        if not ai_response.strip():
+            self.record("rules")
+            return "The response is empty.\n\nNo. The response is inappropriate.", False
+        if SAFE_RESPONSE_PATTERN.match(ai_response.strip()):
+            self.record("rules")
+            return "The response is only a greeting.\n\nYes. The response is appropriate.", True
+        for pattern, reason in self.rules:
+            if pattern.search(ai_response):
+                self.record("rules")
+                return f"{reason}\n\nNo. The response is inappropriate.", False
+        if self.classifier is not None and self.classifier(ai_response) >= self.reject_threshold:
+            self.record("classifier")
+            return "A local classifier found that the response violates the guidelines.\n\nNo. The response is inappropriate.", False
+        return None
+
+    def hints(self, ai_response):
+        """
+        Runs the rules and the classifier on the AI response.
+
+        Returns:
+            list: The reasons the response may violate the guidelines, for the LLM moderator to verify.
+        """
+        hints = []
+        for pattern, reason in self.rules:
+            if pattern.search(ai_response) and reason not in hints:
+                hints.append(reason)
+        if self.classifier is not None and self.classifier(ai_response) >= self.flag_threshold:
+            hints.append("A local classifier flagged this response.")
+        return hints
@@ -1,15 +1,42 @@
 import streamlit as st
 
 import os
+import sys
+import json
+import hashlib
 from llama_index.core.llms import ChatMessage
-from llama_index.llms.openai import OpenAI
-from llama_index.embeddings.openai import OpenAIEmbedding
 from llama_index.core import VectorStoreIndex, SimpleDirectoryReader
-from transformers import OpenAIGPTTokenizerFast
+# The LLM cache and the async LLM layer are shared by every app
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared'))
+from llm_cache import MemoryCache
+from moderation_prefilter import ModerationPrefilter
+from resources import get_llm, get_embedding_model, get_tokenizer, get_guideline_index
+
+# Moderation is deterministic, so identical moderation requests are served from the LLM response cache
+MODERATION_TEMPERATURE = 0
 
 def load_text_file(file_path):
     return open(file_path, 'r').read()
 
+def normalize_text(text):
+    """Normalizes text for cache lookups by ignoring case, surrounding quotes and whitespace differences."""
+    return ' '.join((text or "").lower().split()).strip('"\'')
+
+# Added to the moderation query when the response is still being generated
+PARTIAL_RESPONSE_NOTE = """
+**Note**: The AI response above is still being generated. Only decide whether the text so far violates a guideline. 
+Do not consider it inappropriate because of content that could still come later (e.g. a closing question).
+"""
+
+# Added to the moderation query with the prefilter's hints, which are not verdicts on their own
+HINTS_NOTE = """
+**Automated Checks**: The following may indicate a problem with the AI response. Check whether each one 
+is actually a violation (e.g. a guiding question or a worked example is not giving away the answer):
+"""
+
+# Moderation verdicts shared by every moderator in the process
+verdict_cache = MemoryCache(max_entries=4096, ttl=24 * 60 * 60)
+
 class ContentModerator:
     """
 
@@ -20,7 +47,8 @@ class ContentModerator:
 
     """
 
-    def __init__(self, guidelines_path, llm_model, display_guidelines=False):
+    def __init__(self, guidelines_path, llm_model, display_guidelines=False, context_turns=4,
+                 use_prefilter=True, classifier=None):
         self.llm = llm_model
 
         # Load pre-defined moreation guidelines
@@ -31,21 +59,44 @@ class ContentModerator:
             print(f"The following guidelines will be used from the {guidelines_path} file:\n")
             print(self.guidelines)
 
+        # Number of trailing messages from the conversation used to look up cached verdicts
+        self.context_turns = context_turns
+        self.verdict_cache = verdict_cache
 
-    def moderate_response(self, chat_history, ai_response):
+        # Cheap local checks that decide clear passes and fails before the LLM moderator
+        self.use_prefilter = use_prefilter
+        self.prefilter = ModerationPrefilter(self.guidelines, classifier=classifier)
+
+
+    def moderate_response(self, chat_history, ai_response, partial=False, hints=None):
         """
         Uses the LLM to moderate the AI tutor's response based on the loaded guidelines and the full chat history.
     
         Arguments:
             chat_history (str): The full chat history (formatted as a string).
             ai_response (str): The response provided by the AI tutor that needs moderation.
+            partial (bool): Whether the response is still being generated.
+            hints (list, optional): Possible problems found by the prefilter, for the moderator to verify.
     
         Returns:
             tuple: 
                 - moderator_response (str): Feedback from the moderator explaining the decision.
                 - is_appropriate (bool): Indicates whether the AI response is appropriate or not (True for appropriate, False for inappropriate).
         """
+        message_history = self.moderation_messages(chat_history, ai_response, partial, hints)
+        
+        # Query the moderator LLM with the response
+        moderation_result = self.llm.chat(message_history, temperature=MODERATION_TEMPERATURE).message.content
+        return self.parse_verdict(moderation_result)
+
+    async def amoderate_response(self, chat_history, ai_response, partial=False, hints=None):
+        """Async version of `moderate_response`."""
+        message_history = self.moderation_messages(chat_history, ai_response, partial, hints)
+        moderation_result = (await self.llm.achat(message_history, temperature=MODERATION_TEMPERATURE)).message.content
+        return self.parse_verdict(moderation_result)
 
+    def moderation_messages(self, chat_history, ai_response, partial=False, hints=None):
+        """Creates the messages sent to the moderator LLM (see `moderate_response`)."""
         system_prompt = f'''
 # Your Task
 
@@ -76,13 +127,17 @@ Based on the moderation guidelines, is the following AI response appropriate giv
 **AI Response**:\n
 "{ai_response}"
         '''
+        if partial:
+            query += PARTIAL_RESPONSE_NOTE
+        if hints:
+            query += HINTS_NOTE + "".join(f"- {hint}\n" for hint in hints)
 
-        message_history = [ChatMessage(role="system", content=system_prompt),
-                           ChatMessage(role="user", content=query)]
-        
-        # Query the moderator LLM with the response
-        moderation_result = self.llm.chat(message_history).message.content
-        
+        return [ChatMessage(role="system", content=system_prompt),
+                ChatMessage(role="user", content=query)]
+
+    @staticmethod
+    def parse_verdict(moderation_result):
+        """Splits the moderator LLM's output into its feedback and whether the response is appropriate."""
         # Extract the moderator's feedback from the response (full response)
         moderator_response = moderation_result.strip()
         
@@ -92,7 +147,85 @@ Based on the moderation guidelines, is the following AI response appropriate giv
 
         return moderator_response, is_appropriate
 
-    def correct_response(self, chat_history, ai_response, moderator_feedback):
+    def format_conversation(self, chat_history):
+        """Combines a list of chat messages into a single string."""
+        return "\n\n".join([f"{message.role.value}: {message.content}" for message in chat_history])
+
+    def verdict_key(self, chat_history, ai_response, partial=False):
+        """
+        Creates the verdict cache key from the guidelines, the trailing conversation window and the AI response.
+        All of the text is normalized so that trivial differences do not prevent cache hits.
+        """
+        window = chat_history[-self.context_turns:] if self.context_turns else []
+        key = [normalize_text(self.guidelines),
+               [[message.role.value, normalize_text(message.content)] for message in window],
+               normalize_text(ai_response),
+               partial]
+        return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+    def cached_moderate_response(self, chat_history, ai_response, partial=False):
+        """
+        Moderates the AI tutor's response in tiers. Responses the local prefilter is confident about 
+        (e.g. a greeting, or a phrase the guidelines prohibit) are decided by the prefilter, then the 
+        verdict for an identical response given the same guidelines and the same recent conversation 
+        is reused, and only the remaining responses are sent to the LLM moderator, along with the 
+        prefilter's hints. The number of responses decided 
+        by each tier is recorded in `self.prefilter.stats`.
+    
+        Arguments:
+            chat_history (list): The chat messages before the AI response.
+            ai_response (str): The response provided by the AI tutor that needs moderation.
+            partial (bool): Whether the response is still being generated.
+    
+        Returns:
+            tuple: The moderator's feedback and whether the AI response is appropriate (see `moderate_response`).
+        """
+        verdict, key = self.cached_verdict(chat_history, ai_response, partial)
+        if verdict is not None:
+            return verdict
+        moderator_response, is_appropriate = self.moderate_response(self.format_conversation(chat_history), 
+                                                                    ai_response, 
+                                                                    partial=partial,
+                                                                    hints=self.hints(ai_response))
+        self.verdict_cache.set(key, json.dumps([moderator_response, is_appropriate]))
+        return moderator_response, is_appropriate
+
+    async def acached_moderate_response(self, chat_history, ai_response, partial=False):
+        """Async version of `cached_moderate_response`."""
+        verdict, key = self.cached_verdict(chat_history, ai_response, partial)
+        if verdict is not None:
+            return verdict
+        moderator_response, is_appropriate = await self.amoderate_response(self.format_conversation(chat_history), 
+                                                                            ai_response, 
+                                                                            partial=partial,
+                                                                            hints=self.hints(ai_response))
+        self.verdict_cache.set(key, json.dumps([moderator_response, is_appropriate]))
+        return moderator_response, is_appropriate
+
+    def hints(self, ai_response):
+        """Returns the prefilter's hints for the LLM moderator (see `ModerationPrefilter.hints`)."""
+        return self.prefilter.hints(ai_response) if self.use_prefilter else []
+
+    def cached_verdict(self, chat_history, ai_response, partial=False):
+        """
+        Looks up the verdict for the AI response from the prefilter and the verdict cache.
+
+        Returns:
+            tuple: The verdict (None if it needs the LLM moderator) and the verdict cache key.
+        """
+        if self.use_prefilter:
+            verdict = self.prefilter.check(ai_response, partial=partial)
+            if verdict is not None:
+                return verdict, None
+        key = self.verdict_key(chat_history, ai_response, partial)
+        verdict = self.verdict_cache.get(key)
+        if verdict is not None:
+            self.prefilter.record("cache")
+            return tuple(json.loads(verdict)), key
+        self.prefilter.record("llm")
+        return None, key
+
+    def correct_response(self, chat_history, ai_response, moderator_feedback, direction=None):
         """
         Generates a corrected response based on the chat history, AI tutor's inappropriate response, and moderator feedback.
     
@@ -100,12 +233,25 @@ Based on the moderation guidelines, is the following AI response appropriate giv
             chat_history (str): The full chat history before the AI response.
             ai_response (str): The AI tutor's inappropriate response.
             moderator_feedback (str): Feedback from the moderator explaining why the response was inappropriate.
+            direction (str, optional): An additional direction for how to write the corrected response.
     
         Returns:
             str: The corrected response generated by the LLM, ensuring alignment with the guidelines.
         """
+        message_history = self.correction_messages(chat_history, ai_response, moderator_feedback, direction)
+    
+        # Run the correction prompt through the corrector LLM
+        corrected_response = self.llm.chat(message_history).message.content
+        return self.clean_correction(corrected_response)
 
+    async def acorrect_response(self, chat_history, ai_response, moderator_feedback, direction=None):
+        """Async version of `correct_response`."""
+        message_history = self.correction_messages(chat_history, ai_response, moderator_feedback, direction)
+        corrected_response = (await self.llm.achat(message_history)).message.content
+        return self.clean_correction(corrected_response)
 
+    def correction_messages(self, chat_history, ai_response, moderator_feedback, direction=None):
+        """Creates the messages sent to the corrector LLM (see `correct_response`)."""
         system_prompt = f'''
 # Your Task
 
@@ -130,21 +276,19 @@ The AI tutor gave the following inappropriate response in this conversation:
 
 Your Task: Provide a corrected response based on the full conversation that is appropriate according to the moderation guidelines. Respond ONLY WITH THE CORRECTED RESPONSE.
         """
+        if direction:
+            correction_prompt += f"\n**Additional Direction**: {direction}\n"
 
-        message_history = [ChatMessage(role="system", content=system_prompt),
-                          ChatMessage(role="user", content=correction_prompt)]
+        return [ChatMessage(role="system", content=system_prompt),
+                ChatMessage(role="user", content=correction_prompt)]
 
-    
-        # Run the correction prompt through the corrector LLM
-        corrected_response = self.llm.chat(message_history).message.content
-    
+    @staticmethod
+    def clean_correction(corrected_response):
         # Optionally remove quotes if they exist in the output
         if corrected_response.startswith('"') and corrected_response.endswith('"'):
             corrected_response = corrected_response[1:-1]
-        
         return corrected_response
 
-
     def forward(self, chat_history):
         """
         Moderates and potentially corrects the AI tutor's latest response. If the response is deemed inappropriate, 
@@ -175,11 +319,11 @@ Your Task: Provide a corrected response based on the full conversation that is a
         ai_response = latest_message.content
         
         # Combine all prior messages (before the last AI response) into the conversation context
-        previous_conversation = "\n\n".join([f"{message.role.value}: {message.content}" for message in chat_history[:-1]])
+        previous_conversation = self.format_conversation(chat_history[:-1])
     
         # Moderate the AI response using the full previous conversation context
         with st.spinner('Moderating...'):
-            moderator_feedback, is_appropriate = self.moderate_response(previous_conversation, ai_response)
+            moderator_feedback, is_appropriate = self.cached_moderate_response(chat_history[:-1], ai_response)
         
         # If the response is inappropriate, pass it to the corrector LLM
         if not is_appropriate:
@@ -198,6 +342,33 @@ Your Task: Provide a corrected response based on the full conversation that is a
             "final_response": final_response
         }
 
+    async def aforward(self, chat_history):
+        """
+        Async version of `forward` (without the Streamlit spinners, since it may not run in the script thread).
+        """
+        if not chat_history:
+            raise ValueError("Chat history cannot be empty.")
+        latest_message = chat_history[-1]
+        if latest_message.role.value != 'assistant':
+            raise ValueError("The latest message in the chat history must be from the AI.")
+        ai_response = latest_message.content
+        previous_conversation = self.format_conversation(chat_history[:-1])
+    
+        # Moderate the AI response and, if it is inappropriate, correct it
+        moderator_feedback, is_appropriate = await self.acached_moderate_response(chat_history[:-1], ai_response)
+        if not is_appropriate:
+            final_response = await self.acorrect_response(previous_conversation, ai_response, moderator_feedback)
+        else:
+            final_response = ai_response
+        
+        return {
+            "previous_conversation": previous_conversation,
+            "ai_response": ai_response,
+            "moderated": not is_appropriate,
+            "moderator_feedback": moderator_feedback,
+            "final_response": final_response
+        }
+
 class ContentIndexingModerator:
     """
     A class that moderates and corrects AI-generated responses based on pre-defined guidelines. 
@@ -247,7 +418,7 @@ class ContentIndexingModerator:
         print(result['final_response'])
     """
     def __init__(self, guidelines_path, llm_model, embedding_model, tokenizer, chat_mode="openai", 
-                 display_guidelines=False):
+                 display_guidelines=False, index=None):
         """
         Initializes the ContentModerator class with the specified LLM models, embedding models, 
         and tokenizer. Loads the moderation guidelines and sets up moderation and correction engines.
@@ -263,6 +434,8 @@ class ContentIndexingModerator:
             tokenizer (Any): Tokenizer to process the input text before sending it to the LLM.
             chat_mode (str, optional): The mode for the correction engine (default is "openai").
             display_guidelines (bool, optional): If True, prints out the loaded moderation guidelines for review.
+            index (VectorStoreIndex, optional): A pre-built index of the guidelines (e.g. shared between sessions). 
+                                                If not provided, the guidelines are indexed here.
         """
         
         # Load the moderation guidelines from the specified path
@@ -276,11 +449,12 @@ class ContentIndexingModerator:
             print(self.documents[0].text)
         
         # Index the moderation guidelines using the embedding model
-        index = VectorStoreIndex.from_documents(
-            self.documents,
-            llm=llm_model,
-            embed_model=embedding_model,
-            tokenizer=tokenizer)
+        if index is None:
+            index = VectorStoreIndex.from_documents(
+                self.documents,
+                llm=llm_model,
+                embed_model=embedding_model,
+                tokenizer=tokenizer)
 
         # Set up the query engine to retrieve moderation rules and apply them
         self.moderator_engine = index.as_query_engine(llm=llm_model, 
@@ -417,22 +591,18 @@ def load_moderator():
     # Example usage:
     guidelines_path = 'science_tutor/moderation_guidelines.txt'
 
-    openai_api_key = os.environ["OPENAI_API_KEY"]
-    hf_token = os.environ["LANGCHAIN_API_KEY"]
-        
-    # Initialize the OpenAI embedding model used in the correction pipeline
-    embedding_model = OpenAIEmbedding(model='text-embedding-3-small', api_key=openai_api_key)
-        
-    # Initialize the OpenAI LLM for correcting inappropriate AI responses
-    llm_model = OpenAI(model='gpt-4o-mini', api_key=openai_api_key)
-        
-    # Tokenizer for OpenAI's GPT models (used in correction)
-    tokenizer = OpenAIGPTTokenizerFast.from_pretrained("openai-community/openai-gpt", token=hf_token)
+    # The models, tokenizer and guidelines index are shared by every session in the process
+    llm_model = get_llm(model='gpt-4o-mini', temperature=MODERATION_TEMPERATURE).llm
+    embedding_model = get_embedding_model('text-embedding-3-small')
+    tokenizer = get_tokenizer("openai-community/openai-gpt")
+    index = get_guideline_index(guidelines_path)
         
-    # Create an instance of the ContentModerator class
-    moderator = ContentModerator(guidelines_path, 
-                                     llm_model, 
-                                     embedding_model, 
-                                     tokenizer, 
-                                     chat_mode="openai", 
-                                     display_guidelines=True)
\ No newline at end of file
+    # Create an instance of the ContentIndexingModerator class
+    moderator = ContentIndexingModerator(guidelines_path, 
+                                         llm_model, 
+                                         embedding_model, 
+                                         tokenizer, 
+                                         chat_mode="openai", 
+                                         display_guidelines=True,
+                                         index=index)
+    return moderator
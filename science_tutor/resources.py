@@ -0,0 +1,96 @@
+import os
+import logging
+import sys
+import threading
+import streamlit as st
+from llama_index.llms.openai import OpenAI
+from typing import Any
+from llama_index.core.embeddings import BaseEmbedding
+from llama_index.core import VectorStoreIndex, SimpleDirectoryReader
+from transformers import OpenAIGPTTokenizerFast
+# The LLM cache and the async LLM layer are shared by every app
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared'))
+from llm_cache import CachedLLM, get_disk_cache
+from async_llm import http_client, run
+from embedding_service import get_embedding_service
+
+logger = logging.getLogger(__name__)
+
+# Sent (for a single token) to open the connections to the LLM API
+WARM_UP_PROMPT = "Hi"
+
+# Resources that are expensive to create are built once per process and shared by every Streamlit session.
+# Per-session state (st.session_state) should only hold the message history.
+
+def open_connection(llm):
+    """
+    Opens the LLM clients' connections to the API (TCP and TLS handshakes) in a background thread,
+    with a one-token completion. The clients keep the connections in their pools, so the first student 
+    message does not wait for them. Both the sync client and the async client (whose connections belong 
+    to the shared event loop) are warmed up.
+
+    Returns:
+        threading.Thread: The background thread.
+    """
+    def request():
+        # If a request fails, the connection is opened by the first student message instead
+        try:
+            llm.complete(WARM_UP_PROMPT, max_tokens=1)
+        except Exception:
+            logger.warning("Could not open the sync client's connection to the LLM API", exc_info=True)
+        try:
+            run(llm.acomplete(WARM_UP_PROMPT, max_tokens=1), timeout=30)
+        except Exception:
+            logger.warning("Could not open the async client's connection to the LLM API", exc_info=True)
+    thread = threading.Thread(target=request, daemon=True)
+    thread.start()
+    return thread
+
+@st.cache_resource
+def get_llm(model='gpt-4o-mini', temperature=0.4):
+    """Returns the (cached) LLM client for the given model and temperature, with its connection pre-opened."""
+    openai_api_key = os.environ["OPENAI_API_KEY"]
+    # Async calls share the process's connection-pooled HTTP client
+    llm = OpenAI(model=model, temperature=temperature, api_key=openai_api_key, async_http_client=http_client)
+    open_connection(llm)
+    # Deterministic calls (e.g. moderation at temperature 0) are cached on disk, shared by every process
+    return CachedLLM(llm, cache=get_disk_cache())
+
+class ServiceEmbedding(BaseEmbedding):
+    """Adapts the shared (batched, rate-limited and cached) embedding service to a llama_index embedding model."""
+    service: Any = None
+
+    def _get_query_embedding(self, query):
+        return self.service.embed_query(query)
+
+    async def _aget_query_embedding(self, query):
+        return await self.service.aembed_query(query)
+
+    def _get_text_embedding(self, text):
+        # Documents are embedded through the on-disk cache (queries are only cached in memory)
+        return self.service.embed_documents([text])[0]
+
+    def _get_text_embeddings(self, texts):
+        return self.service.embed_documents(texts)
+
+@st.cache_resource
+def get_embedding_model(model='text-embedding-3-small'):
+    """Returns the embedding model, which embeds texts through the shared embedding service."""
+    # The service does its own batching, so llama_index passes all the texts at once
+    return ServiceEmbedding(model_name=model, service=get_embedding_service(model), embed_batch_size=2048)
+
+@st.cache_resource
+def get_tokenizer(name="openai-community/openai-gpt"):
+    """Returns the tokenizer, which is only downloaded once per process."""
+    hf_token = os.environ["LANGCHAIN_API_KEY"]
+    return OpenAIGPTTokenizerFast.from_pretrained(name, token=hf_token)
+
+@st.cache_resource
+def get_guideline_index(guidelines_path, model='gpt-4o-mini', embedding='text-embedding-3-small'):
+    """Returns the vector index of the moderation guidelines, which is only embedded once per process."""
+    documents = SimpleDirectoryReader(input_files=[guidelines_path]).load_data()
+    # Unwrap the cached LLM since the index requires a llama_index LLM
+    return VectorStoreIndex.from_documents(documents,
+                                           llm=get_llm(model, temperature=0.1).llm,
+                                           embed_model=get_embedding_model(embedding),
+                                           tokenizer=get_tokenizer())
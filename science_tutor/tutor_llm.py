@@ -1,31 +1,56 @@
 import streamlit as st
 
 import os
+import sys
+import re
+import time
+import logging
+import asyncio
+from concurrent import futures
 from chatbot_llm import AITutor
 from moderator_llm import ContentModerator
+# The LLM cache and the async LLM layer are shared by every app
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared'))
+from async_llm import run, submit
+from resources import get_llm
 
-from llama_index.llms.openai import OpenAI
-from llama_index.embeddings.openai import OpenAIEmbedding
-from transformers import OpenAIGPTTokenizerFast
+from llama_index.core.llms import ChatMessage
+
+logger = logging.getLogger(__name__)
+
+# Response used when no approved response is found within the correction budget
+FALLBACK_RESPONSE = "Let's take this one step at a time. What do you already know about this topic, and which part would you like to work through first?"
+
+# Each parallel correction candidate is written with a different direction
+CORRECTION_DIRECTIONS = [None,
+                         "Keep the response as short as possible.",
+                         "Focus the response on a single guiding question.",
+                         "Use simple language and a relatable example."]
+
+# Boundaries at which a partially generated response is moderated
+SEGMENT_PATTERNS = {"paragraph": re.compile(r"\n\s*\n"),
+                    "sentence": re.compile(r"(?<=[.!?])\s+")}
 
 class TutorChain:
 
     def __init__(self, 
                  instructions_path='science_tutor/tutor_instructions.txt', 
-                 guidelines_path='science_tutor/moderation_guidelines.txt'):
-
-        # Load API keys
-        openai_api_key = os.environ["OPENAI_API_KEY"]
-        hf_token = os.environ["LANGCHAIN_API_KEY"]
+                 guidelines_path='science_tutor/moderation_guidelines.txt',
+                 max_corrections=3,
+                 deadline=60,
+                 n_candidates=2,
+                 pipelined=True,
+                 segment_by='paragraph',
+                 min_segment_length=80):
 
         # Initialize the OpenAI embedding model
-        #embedding_model = OpenAIEmbedding(model='text-embedding-3-small', api_key=openai_api_key)
+        #embedding_model = get_embedding_model('text-embedding-3-small')
         
-        # Initialize the OpenAI LLM
-        llm_model = OpenAI(model='gpt-4o-mini', temperature=0.4, api_key=openai_api_key)
+        # Initialize the OpenAI LLM (shared by every session in the process)
+        llm_model = get_llm(model='gpt-4o-mini', temperature=0.4)
         
         # Tokenizer for OpenAI's GPT models
-        #tokenizer = OpenAIGPTTokenizerFast.from_pretrained("openai-community/openai-gpt", token=hf_token)
+        #tokenizer = get_tokenizer("openai-community/openai-gpt")
 
         # Initialize the tutor with the LLM and instructions
         self.tutor_llm = AITutor(llm_model, instructions_path)
@@ -35,37 +60,213 @@ class TutorChain:
         self.moderator_llm = ContentModerator(guidelines_path, 
                                              llm_model)
 
+        # Budget for correcting inappropriate responses
+        self.max_corrections = max_corrections
+        self.deadline = deadline
+        self.n_candidates = max(1, min(n_candidates, len(CORRECTION_DIRECTIONS)))
+
+        # Settings for moderating the response while it is being generated
+        self.pipelined = pipelined
+        self.segment_by = segment_by
+        self.min_segment_length = min_segment_length
+
     def get_response(self, student_prompt, moderate=True):
+        if moderate and self.pipelined:
+            return self.get_pipelined_response(student_prompt)
+
         # Prompt AI tutor
         with st.spinner('Responding...'):
             ai_response = self.tutor_llm.get_response(student_prompt)
 
-        corrections = 0
+        moderated_response = ai_response
         if moderate:
-            needs_checking = True
-            while needs_checking:
-                # Moderate response
-                results = self.moderator_llm.forward(self.tutor_llm.message_history)
+            with st.spinner('Moderating...'):
+                moderated_response = self.moderate(self.tutor_llm.message_history)
+            # Update chat history
+            self.tutor_llm.message_history[-1].content = moderated_response
+
+        return moderated_response
+
+    def get_pipelined_response(self, student_prompt):
+        """
+        Streams the AI tutor's response and moderates each completed segment (paragraph or sentence) 
+        while the rest of the response is still being generated. If a segment is found to be 
+        inappropriate, generation is stopped early and the partial response is corrected. 
+        Otherwise, the full response is moderated as well, and the response is approved once every 
+        check has approved it. If a check fails or doesn't finish in time, the fallback response 
+        is returned.
+        """
+        segment_pattern = SEGMENT_PATTERNS[self.segment_by]
+        segment_checks = []
+        violation = None
+        with st.spinner('Responding...'):
+            # The conversation before the AI response
+            chat_history = self.tutor_llm.message_history + [ChatMessage(role="user", content=student_prompt)]
+            stream = self.tutor_llm.stream_response(student_prompt)
+            ai_response = ""
+            checked_upto = 0
+            try:
+                for delta in stream:
+                    ai_response += delta
+                    # Moderate the response up to the last completed segment
+                    boundaries = [match.end() for match in segment_pattern.finditer(ai_response, checked_upto)]
+                    if boundaries and boundaries[-1] - checked_upto >= self.min_segment_length:
+                        checked_upto = boundaries[-1]
+                        segment_checks.append(submit(self.moderator_llm.acached_moderate_response(
+                            chat_history, ai_response[:checked_upto].strip(), True)))
+                    # Stop generating as soon as a segment is rejected
+                    violation = self.first_rejection([future for future in segment_checks if future.done()])
+                    if violation is not None:
+                        break
+            finally:
+                stream.close()
+
+        with st.spinner('Moderating...'):
+            try:
+                if violation is None:
+                    # Moderate the full response (even if it ended on a segment boundary, since the 
+                    # segments were only checked as partial responses) and wait for every verdict
+                    segment_checks.append(submit(self.moderator_llm.acached_moderate_response(
+                        chat_history, ai_response.strip())))
+                    futures.wait(segment_checks, timeout=self.deadline)
+                    violation = self.first_rejection(segment_checks)
+            finally:
+                # Don't wait for any segment checks that are still running
+                for future in segment_checks:
+                    future.cancel()
+
+            if violation is None:
+                # Every segment was approved
+                moderated_response = self.tutor_llm.message_history[-1].content
+            elif violation[0] is None:
+                # A segment could not be checked
+                moderated_response = FALLBACK_RESPONSE
+            else:
+                # Correct the partial response using the moderator's feedback
+                deadline = time.monotonic() + self.deadline
+                moderated_response = self.correct(chat_history, self.tutor_llm.message_history[-1].content, 
+                                                  violation[0], deadline)
+        # Update chat history
+        self.tutor_llm.message_history[-1].content = moderated_response
+
+        return moderated_response
+
+    @staticmethod
+    def first_rejection(segment_checks):
+        """
+        Returns the verdict of the first segment check that rejected its segment (or None if every 
+        segment was approved). A check that failed or didn't finish rejects its segment without 
+        feedback, and is logged.
+        """
+        for future in segment_checks:
+            try:
+                moderator_feedback, is_appropriate = future.result(timeout=0)
+            except futures.TimeoutError:
+                logger.warning("A moderation check did not finish before the deadline")
+                return None, False
+            except futures.CancelledError:
+                logger.warning("A moderation check was cancelled")
+                return None, False
+            except Exception:
+                logger.exception("A moderation check failed")
+                return None, False
+            if not is_appropriate:
+                return moderator_feedback, is_appropriate
+        return None
+
+    async def acorrect_and_check(self, chat_history, ai_response, moderator_feedback, direction):
+        """
+        Corrects an inappropriate response and moderates the corrected response.
+
+        Returns:
+            tuple: The corrected response, the moderator's feedback and whether it is appropriate.
+        """
+        corrected_response = await self.moderator_llm.acorrect_response(self.moderator_llm.format_conversation(chat_history), 
+                                                                        ai_response, 
+                                                                        moderator_feedback, 
+                                                                        direction=direction)
+        moderator_feedback, is_appropriate = await self.moderator_llm.acached_moderate_response(chat_history, corrected_response)
+        return corrected_response, moderator_feedback, is_appropriate
+
+    def moderate(self, message_history):
+        """
+        Moderates the latest AI response and, if needed, corrects it (see `correct`).
+
+        Arguments:
+            message_history (list): The chat history, ending with the AI response to moderate.
+
+        Returns:
+            str: The approved response (or the fallback response).
+        """
+        return run(self.amoderate(message_history))
+
+    async def amoderate(self, message_history):
+        """Async version of `moderate`."""
+        deadline = time.monotonic() + self.deadline
+        chat_history = message_history[:-1]
+        ai_response = message_history[-1].content
+
+        # Moderate the original response
+        moderator_feedback, is_appropriate = await self.moderator_llm.acached_moderate_response(chat_history, ai_response)
+        if is_appropriate:
+            return ai_response
+        return await self.acorrect(chat_history, ai_response, moderator_feedback, deadline)
 
-                '''
-                # Print the entire moderation and correction process for review
-                st.markdown("\n\n### Full Moderation and Correction Process ###")
-                st.markdown(f"\nAI Tutor's Latest Response: {results['ai_response']}")
-                st.text(f"\n\nModerator's Feedback: {results['moderator_feedback']}")
-                st.markdown(f"\n\nFinal Response (Corrected or Original): {results['final_response']}")
-                '''
+    def correct(self, chat_history, ai_response, moderator_feedback, deadline):
+        """
+        Corrects an inappropriate AI response within a limited budget.
 
-                moderated_response = results['final_response']
-                # Update chat history
-                self.tutor_llm.message_history[-1].content = moderated_response
-                if not results['moderated']:
-                    # Response is good to go
-                    needs_checking = False
-                else:
-                    corrections +=1
+        Each round generates several corrections concurrently (one per correction direction), 
+        moderates each of them, and returns the first one that is approved. If none are approved, 
+        the next round corrects one of the rejected candidates. Candidates that fail (e.g. an LLM 
+        error) are logged and skipped. Once every candidate of a round has failed, `max_corrections` 
+        rounds have been run or the deadline has passed, the fallback response is returned.
 
-        return moderated_response #+ f' (No. of corrections: {str(corrections)})'
+        Arguments:
+            chat_history (list): The chat history before the AI response.
+            ai_response (str): The inappropriate AI response.
+            moderator_feedback (str): The moderator's feedback on the AI response.
+            deadline (float): The `time.monotonic()` time at which to stop correcting.
 
+        Returns:
+            str: The approved response (or the fallback response).
+        """
+        return run(self.acorrect(chat_history, ai_response, moderator_feedback, deadline))
 
+    async def acorrect(self, chat_history, ai_response, moderator_feedback, deadline):
+        """Async version of `correct`."""
+        for _ in range(self.max_corrections):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            # Generate and moderate the candidate corrections concurrently
+            tasks = [asyncio.ensure_future(self.acorrect_and_check(chat_history, ai_response, moderator_feedback, direction)) 
+                     for direction in CORRECTION_DIRECTIONS[:self.n_candidates]]
+            rejected = []
+            try:
+                while tasks and remaining > 0:
+                    done, tasks = await asyncio.wait(tasks, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                    # Read every finished candidate, so that none of their errors go unlogged
+                    finished = []
+                    for task in done:
+                        try:
+                            finished.append(task.result())
+                        except Exception:
+                            # Skip candidates that could not be written or moderated
+                            logger.exception("A correction candidate failed")
+                    for candidate, candidate_feedback, is_appropriate in finished:
+                        if is_appropriate:
+                            # Return the first approved candidate
+                            return candidate
+                        rejected.append((candidate, candidate_feedback))
+                    remaining = deadline - time.monotonic()
+            finally:
+                # Cancel the requests of any candidates that are still running
+                for task in tasks:
+                    task.cancel()
+            if not rejected:
+                break
+            # Try to correct the first rejected candidate in the next round
+            ai_response, moderator_feedback = rejected[0]
 
-            
\ No newline at end of file
+        return FALLBACK_RESPONSE
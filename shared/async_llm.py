@@ -0,0 +1,83 @@
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+import httpx
+
+# Maximum number of concurrent LLM requests per provider, shared by every session in the process
+PROVIDER_LIMITS = {"openai": 64, "gemini": 16}
+DEFAULT_LIMIT = 16
+
+# The event loop that runs every async LLM call in the process (in a background thread), so the
+# pooled connections and the concurrency limits are shared by every Streamlit session
+loop = None
+loop_lock = threading.Lock()
+semaphores = {}
+
+# Connection-pooled HTTP client shared by every async LLM client in the process
+http_client = httpx.AsyncClient(limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+                                timeout=httpx.Timeout(60.0, connect=10.0))
+
+def get_event_loop():
+    """Returns the shared event loop, starting its thread on first use."""
+    global loop
+    with loop_lock:
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="async-llm", daemon=True).start()
+    return loop
+
+def run(coroutine, timeout=None):
+    """
+    Runs a coroutine on the shared event loop and waits for its result.
+    Async LLM calls should always be run this way (rather than with `asyncio.run`), since the
+    pooled connections can only be used from the loop that opened them.
+
+    Args:
+        coroutine (coroutine): The coroutine to run.
+        timeout (float, optional): The number of seconds to wait for the result.
+    Returns:
+        Any: The result of the coroutine.
+    """
+    return submit(coroutine).result(timeout)
+
+def submit(coroutine):
+    """Starts a coroutine on the shared event loop without waiting for it, returning a `concurrent.futures.Future`."""
+    return asyncio.run_coroutine_threadsafe(coroutine, get_event_loop())
+
+def iterate(async_generator):
+    """Iterates over an async generator on the shared event loop, e.g. to pass a stream to `st.write_stream`."""
+    try:
+        while True:
+            try:
+                yield run(async_generator.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        # Close the stream if the iteration is stopped early
+        run(async_generator.aclose())
+
+def check_event_loop():
+    """
+    Raises an error if it isn't called from the shared event loop (e.g. from a coroutine run with 
+    `asyncio.run`), where the pooled connections and the concurrency limits can't be used.
+    """
+    try:
+        running_loop = asyncio.get_running_loop()
+    except RuntimeError:
+        running_loop = None
+    if running_loop is None or running_loop is not loop:
+        raise RuntimeError("Async LLM calls must be run on the shared event loop "
+                           "(with async_llm.run, submit or iterate), not with asyncio.run or another event loop.")
+
+def provider(llm):
+    """Returns the name of the LLM's provider (e.g. "openai"), used to look up its concurrency limit."""
+    return type(llm).__name__.lower()
+
+@asynccontextmanager
+async def provider_limit(llm):
+    """Waits for one of the provider's concurrent request slots, which is held until the context exits."""
+    name = provider(llm)
+    if name not in semaphores:
+        semaphores[name] = asyncio.Semaphore(PROVIDER_LIMITS.get(name, DEFAULT_LIMIT))
+    async with semaphores[name]:
+        yield
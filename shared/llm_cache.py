@@ -0,0 +1,257 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from llama_index.core.llms import ChatMessage, ChatResponse
+from async_llm import provider_limit, check_event_loop
+
+def cache_key(llm, messages, **kwargs):
+    """
+    Creates a content-addressed cache key from the model, its parameters and the messages.
+
+    Args:
+        llm (Any LLM with a chat function): The LLM that would be prompted.
+        messages (list): The chat messages sent to the LLM.
+        **kwargs: Any additional keyword arguments passed to the chat call.
+    Returns:
+        str: The SHA-256 hash of the request.
+    """
+    params = {name: getattr(llm, name, None) for name in ("temperature", "max_tokens", "top_p", "additional_kwargs")}
+    request = {"llm": type(llm).__name__,
+               "model": getattr(llm, "model", None),
+               "params": params,
+               "kwargs": kwargs,
+               "messages": [[message.role.value, message.content] for message in messages]}
+    return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode()).hexdigest()
+
+class ResponseCache:
+    """
+    Base class for the LLM response caches. Keeps track of the cache hits and misses.
+
+    Subclasses implement `_get` and `_set`.
+    """
+    def __init__(self, max_entries=1024, ttl=None):
+        """
+        Args:
+            max_entries (int): The maximum number of responses to keep before evicting the least recently used.
+            ttl (float, optional): The number of seconds a response stays valid (None to never expire).
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached response for the key, or None if there is no valid entry."""
+        with self.lock:
+            value = self._get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Stores a response in the cache, evicting old entries if needed."""
+        with self.lock:
+            self._set(key, value)
+
+    def stats(self):
+        """Returns the number of cache hits and misses and the hit rate."""
+        requests = self.hits + self.misses
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0}
+
+class MemoryCache(ResponseCache):
+    """An in-memory LRU cache for LLM responses."""
+    def __init__(self, max_entries=1024, ttl=None):
+        super().__init__(max_entries, ttl)
+        self.entries = OrderedDict()
+
+    def _get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        value, created = entry
+        if self.ttl is not None and time.time() - created > self.ttl:
+            # Expired
+            del self.entries[key]
+            return None
+        # Mark as recently used
+        self.entries.move_to_end(key)
+        return value
+
+    def _set(self, key, value):
+        self.entries[key] = (value, time.time())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            # Evict the least recently used entry
+            self.entries.popitem(last=False)
+
+class SQLiteCache(ResponseCache):
+    """An on-disk LLM response cache stored in a SQLite database, which persists across restarts."""
+    def __init__(self, path="llm_cache.sqlite", max_entries=10000, ttl=None):
+        super().__init__(max_entries, ttl)
+        # The database may be shared by several processes (e.g. Streamlit workers), so wait for their writes
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                                key TEXT PRIMARY KEY,
+                                value TEXT,
+                                created REAL,
+                                accessed REAL)""")
+        self.conn.commit()
+
+    def _get(self, key):
+        row = self.conn.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, created = row
+        if self.ttl is not None and time.time() - created > self.ttl:
+            # Expired
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.conn.commit()
+            return None
+        # Mark as recently used
+        self.conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+        self.conn.commit()
+        return value
+
+    def _set(self, key, value):
+        now = time.time()
+        self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, value, now, now))
+        if self.ttl is not None:
+            self.conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+        # Evict the least recently used entries
+        self.conn.execute("""DELETE FROM responses WHERE key IN (
+                                SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)""",
+                          (self.max_entries,))
+        self.conn.commit()
+
+# Cache shared by every LLM in the process (and therefore by every Streamlit session).
+# Responses expire after an hour, so a cached response isn't served indefinitely.
+default_cache = MemoryCache(ttl=60 * 60)
+
+# On-disk cache shared by every process on the machine and kept across restarts (created on first use)
+disk_cache = None
+disk_cache_lock = threading.Lock()
+
+def get_disk_cache(ttl=24 * 60 * 60):
+    """
+    Returns the on-disk response cache, stored at $LLM_CACHE_PATH (llm_cache.sqlite next to this file by default).
+
+    Args:
+        ttl (float): The number of seconds a response stays valid.
+    Returns:
+        SQLiteCache: The cache shared by the apps' LLMs.
+    """
+    global disk_cache
+    with disk_cache_lock:
+        if disk_cache is None:
+            path = os.environ.get("LLM_CACHE_PATH", os.path.join(os.path.dirname(__file__), "llm_cache.sqlite"))
+            disk_cache = SQLiteCache(path, ttl=ttl)
+        return disk_cache
+
+class CachedLLM:
+    """
+    Wraps an LLM so that chat calls with identical inputs are only sent to the LLM once.
+    Any other attributes are passed through to the wrapped LLM.
+
+    The async methods must be awaited on the shared event loop (see `async_llm.run`).
+
+    Responses served from the cache are marked with `additional_kwargs["cached"]`.
+
+    Calls that sample (temperature > 0) are sent to the LLM every time, since a cached response 
+    would replace the variation the caller asked for, unless `cache_sampled` is set. Deterministic 
+    calls (e.g. moderation) should pass `temperature=0` so that they are cached.
+
+    Attributes:
+        llm (Any LLM with a chat function): The wrapped LLM.
+        cache (ResponseCache): The cache used to store the responses.
+        cache_sampled (bool): Whether to also cache calls with a temperature above 0.
+    """
+    def __init__(self, llm, cache=None, cache_sampled=False):
+        self.llm = llm
+        self.cache = cache if cache is not None else default_cache
+        self.cache_sampled = cache_sampled
+
+    def cacheable(self, **kwargs):
+        """Returns whether a chat call with the given keyword arguments can be served from the cache."""
+        temperature = kwargs.get("temperature", getattr(self.llm, "temperature", None))
+        return self.cache_sampled or not temperature
+
+    def chat(self, messages, **kwargs):
+        if not self.cacheable(**kwargs):
+            return self.llm.chat(messages, **kwargs)
+        key = cache_key(self.llm, messages, **kwargs)
+        content = self.cache.get(key)
+        cached = content is not None
+        if not cached:
+            content = self.llm.chat(messages, **kwargs).message.content
+            self.cache.set(key, content)
+        return ChatResponse(message=ChatMessage(role="assistant", content=content), 
+                            additional_kwargs={"cached": cached})
+
+    def stream_chat(self, messages, **kwargs):
+        if not self.cacheable(**kwargs):
+            yield from self.llm.stream_chat(messages, **kwargs)
+            return
+        key = cache_key(self.llm, messages, **kwargs)
+        content = self.cache.get(key)
+        if content is not None:
+            # Cached responses are returned as a single chunk
+            yield ChatResponse(message=ChatMessage(role="assistant", content=content), delta=content, 
+                               additional_kwargs={"cached": True})
+            return
+        content = ""
+        for chunk in self.llm.stream_chat(messages, **kwargs):
+            content += chunk.delta or ""
+            yield chunk
+        self.cache.set(key, content)
+
+    async def achat(self, messages, **kwargs):
+        """Async version of `chat`, limited to the provider's number of concurrent requests."""
+        check_event_loop()
+        if not self.cacheable(**kwargs):
+            async with provider_limit(self.llm):
+                return await self.llm.achat(messages, **kwargs)
+        key = cache_key(self.llm, messages, **kwargs)
+        content = self.cache.get(key)
+        cached = content is not None
+        if not cached:
+            async with provider_limit(self.llm):
+                content = (await self.llm.achat(messages, **kwargs)).message.content
+            self.cache.set(key, content)
+        return ChatResponse(message=ChatMessage(role="assistant", content=content), 
+                            additional_kwargs={"cached": cached})
+
+    async def astream_chat(self, messages, **kwargs):
+        """Async version of `stream_chat`, which (like the LLM's `astream_chat`) returns an async generator."""
+        check_event_loop()
+        cacheable = self.cacheable(**kwargs)
+        key = cache_key(self.llm, messages, **kwargs)
+        content = self.cache.get(key) if cacheable else None
+
+        async def stream():
+            if content is not None:
+                # Cached responses are returned as a single chunk
+                yield ChatResponse(message=ChatMessage(role="assistant", content=content), delta=content, 
+                                   additional_kwargs={"cached": True})
+                return
+            response = ""
+            # The request slot is held until the stream is complete (or closed)
+            async with provider_limit(self.llm):
+                async for chunk in await self.llm.astream_chat(messages, **kwargs):
+                    response += chunk.delta or ""
+                    yield chunk
+            if cacheable:
+                self.cache.set(key, response)
+
+        return stream()
+
+    def __getattr__(self, name):
+        return getattr(self.llm, name)
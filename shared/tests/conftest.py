@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The apps import the shared modules by path, so the tests do the same
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
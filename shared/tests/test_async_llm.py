@@ -0,0 +1,91 @@
+import asyncio
+import threading
+
+import pytest
+
+import async_llm
+from async_llm import check_event_loop, iterate, provider_limit, run, submit
+
+async def current_thread():
+    return threading.current_thread().name
+
+def test_coroutines_run_on_the_shared_loop():
+    assert run(current_thread()) == "async-llm"
+    loop = async_llm.get_event_loop()
+    assert async_llm.get_event_loop() is loop
+    assert submit(current_thread()).result(timeout=5) == "async-llm"
+
+def test_run_raises_the_coroutine_error():
+    async def fail():
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError, match="bad request"):
+        run(fail(), timeout=5)
+
+def test_iterate_yields_the_stream():
+    async def stream():
+        for chunk in ["Hel", "lo", "!"]:
+            yield chunk
+
+    assert list(iterate(stream())) == ["Hel", "lo", "!"]
+
+def test_iterate_closes_the_stream_when_stopped_early():
+    closed = []
+
+    async def stream():
+        try:
+            for chunk in ["Hel", "lo", "!"]:
+                yield chunk
+        finally:
+            closed.append(True)
+
+    chunks = iterate(stream())
+    assert next(chunks) == "Hel"
+    chunks.close()
+    assert closed == [True]
+
+def test_check_event_loop():
+    async def check():
+        check_event_loop()
+        return True
+
+    assert run(check(), timeout=5)
+    with pytest.raises(RuntimeError, match="shared event loop"):
+        asyncio.run(check())
+    with pytest.raises(RuntimeError):
+        check_event_loop()
+
+class FakeLLM:
+    pass
+
+def peak_concurrency(llm, n_requests=6):
+    """Sends concurrent requests under the provider limit and returns the most that were active at once."""
+    active = []
+    peak = []
+
+    async def request():
+        async with provider_limit(llm):
+            active.append(1)
+            peak.append(len(active))
+            await asyncio.sleep(0.01)
+            active.pop()
+
+    async def requests():
+        await asyncio.gather(*(request() for _ in range(n_requests)))
+
+    run(requests(), timeout=5)
+    return max(peak)
+
+@pytest.fixture(autouse=True)
+def semaphores(monkeypatch):
+    monkeypatch.setattr(async_llm, "semaphores", {})
+    return async_llm.semaphores
+
+def test_provider_limit_caps_the_concurrent_requests(monkeypatch, semaphores):
+    monkeypatch.setattr(async_llm, "PROVIDER_LIMITS", {"fakellm": 2})
+    assert peak_concurrency(FakeLLM()) == 2
+    assert list(semaphores) == ["fakellm"]
+
+def test_unknown_providers_use_the_default_limit(monkeypatch):
+    monkeypatch.setattr(async_llm, "DEFAULT_LIMIT", 3)
+    assert peak_concurrency(FakeLLM()) == 3
@@ -0,0 +1,145 @@
+import asyncio
+import pytest
+from llama_index.core.llms import ChatMessage, ChatResponse
+
+import llm_cache
+from llm_cache import CachedLLM, MemoryCache, SQLiteCache, cache_key
+from async_llm import run, iterate
+
+class FakeLLM:
+    """Answers every call with a numbered reply, so repeated calls can be told apart."""
+    model = "fake-model"
+
+    def __init__(self, temperature=0.0):
+        self.temperature = temperature
+        self.calls = 0
+
+    def reply(self):
+        self.calls += 1
+        return f"reply {self.calls}"
+
+    def chat(self, messages, **kwargs):
+        return ChatResponse(message=ChatMessage(role="assistant", content=self.reply()))
+
+    def stream_chat(self, messages, **kwargs):
+        text = self.reply()
+        for delta in (text[:6], text[6:]):
+            yield ChatResponse(message=ChatMessage(role="assistant", content=delta), delta=delta)
+
+    async def achat(self, messages, **kwargs):
+        return self.chat(messages, **kwargs)
+
+    async def astream_chat(self, messages, **kwargs):
+        async def stream():
+            for chunk in self.stream_chat(messages, **kwargs):
+                yield chunk
+        return stream()
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replaces the cache's clock with one that only moves when the test advances it."""
+    now = [1000.0]
+    monkeypatch.setattr(llm_cache.time, "time", lambda: now[0])
+    return now
+
+def messages(text="Hi"):
+    return [ChatMessage(role="user", content=text)]
+
+def test_cache_key_depends_on_messages_and_parameters():
+    llm = FakeLLM()
+    assert cache_key(llm, messages("a")) == cache_key(llm, messages("a"))
+    assert cache_key(llm, messages("a")) != cache_key(llm, messages("b"))
+    assert cache_key(llm, messages("a")) != cache_key(llm, messages("a"), temperature=0.5)
+    assert cache_key(llm, messages("a")) != cache_key(FakeLLM(temperature=0.3), messages("a"))
+
+def test_deterministic_calls_are_only_sent_once():
+    llm = CachedLLM(FakeLLM(temperature=0), cache=MemoryCache())
+    first = llm.chat(messages())
+    second = llm.chat(messages())
+    assert first.message.content == second.message.content == "reply 1"
+    assert not first.additional_kwargs["cached"]
+    assert second.additional_kwargs["cached"]
+    assert llm.cache.stats() == {"hits": 1, "misses": 1, "hit_rate": 0.5}
+
+def test_sampled_calls_bypass_the_cache():
+    llm = CachedLLM(FakeLLM(temperature=0.4), cache=MemoryCache())
+    assert not llm.cacheable()
+    assert llm.chat(messages()).message.content == "reply 1"
+    assert llm.chat(messages()).message.content == "reply 2"
+    assert llm.cache.stats()["hits"] + llm.cache.stats()["misses"] == 0
+
+def test_temperature_argument_overrides_the_llm_temperature():
+    llm = CachedLLM(FakeLLM(temperature=0.4), cache=MemoryCache())
+    assert llm.cacheable(temperature=0)
+    assert not CachedLLM(FakeLLM(temperature=0)).cacheable(temperature=0.7)
+    llm.chat(messages(), temperature=0)
+    assert llm.chat(messages(), temperature=0).additional_kwargs["cached"]
+    assert llm.llm.calls == 1
+
+def test_sampled_calls_are_cached_when_opted_in():
+    llm = CachedLLM(FakeLLM(temperature=0.4), cache=MemoryCache(), cache_sampled=True)
+    llm.chat(messages())
+    assert llm.chat(messages()).message.content == "reply 1"
+
+def test_streamed_responses_are_cached_as_a_single_chunk():
+    llm = CachedLLM(FakeLLM(), cache=MemoryCache())
+    assert [chunk.delta for chunk in llm.stream_chat(messages())] == ["reply ", "1"]
+    cached = list(llm.stream_chat(messages()))
+    assert [chunk.delta for chunk in cached] == ["reply 1"]
+    assert cached[0].additional_kwargs["cached"]
+
+def test_memory_cache_evicts_the_least_recently_used_entry():
+    cache = MemoryCache(max_entries=2)
+    cache.set("a", "A")
+    cache.set("b", "B")
+    assert cache.get("a") == "A"
+    cache.set("c", "C")
+    assert cache.get("b") is None
+    assert cache.get("a") == "A"
+    assert cache.get("c") == "C"
+
+def test_memory_cache_entries_expire(clock):
+    cache = MemoryCache(ttl=60)
+    cache.set("a", "A")
+    clock[0] += 59
+    assert cache.get("a") == "A"
+    clock[0] += 2
+    assert cache.get("a") is None
+
+def test_sqlite_cache_persists_evicts_and_expires(tmp_path, clock):
+    path = str(tmp_path / "cache.sqlite")
+    cache = SQLiteCache(path, max_entries=2, ttl=60)
+    cache.set("a", "A")
+    clock[0] += 1
+    cache.set("b", "B")
+    clock[0] += 1
+    assert cache.get("a") == "A"
+    clock[0] += 1
+    cache.set("c", "C")
+    # Another connection (e.g. another process) sees the same entries
+    reopened = SQLiteCache(path, max_entries=2, ttl=60)
+    assert reopened.get("b") is None
+    assert reopened.get("a") == "A"
+    assert reopened.get("c") == "C"
+    clock[0] += 61
+    assert reopened.get("c") is None
+
+def test_disk_cache_is_created_once(tmp_path, monkeypatch):
+    monkeypatch.setenv("LLM_CACHE_PATH", str(tmp_path / "llm_cache.sqlite"))
+    monkeypatch.setattr(llm_cache, "disk_cache", None)
+    cache = llm_cache.get_disk_cache()
+    assert isinstance(cache, SQLiteCache)
+    assert llm_cache.get_disk_cache() is cache
+    assert (tmp_path / "llm_cache.sqlite").exists()
+
+def test_async_calls_share_the_cache():
+    llm = CachedLLM(FakeLLM(), cache=MemoryCache())
+    assert run(llm.achat(messages())).message.content == "reply 1"
+    assert run(llm.achat(messages())).additional_kwargs["cached"]
+    assert [chunk.delta for chunk in iterate(run(llm.astream_chat(messages("other"))))] == ["reply ", "2"]
+    assert [chunk.delta for chunk in iterate(run(llm.astream_chat(messages("other"))))] == ["reply 2"]
+
+def test_async_calls_are_rejected_on_another_event_loop():
+    llm = CachedLLM(FakeLLM(), cache=MemoryCache())
+    with pytest.raises(RuntimeError, match="shared event loop"):
+        asyncio.run(llm.achat(messages()))
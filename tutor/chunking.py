@@ -0,0 +1,171 @@
+import re
+import tiktoken
+from langchain.schema import Document
+
+# Markdown headings (e.g. "## Kepler's Laws") and sentence boundaries
+HEADING_PATTERN = re.compile(r"^(#{1,6})\s+(.+)$")
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?])\s+")
+
+class TokenChunker:
+    """
+    Splits course sections into chunks of roughly `chunk_size` tokens.
+
+    Chunks are cut on markdown heading and paragraph boundaries wherever possible. Paragraphs
+    that are too long on their own are split into sentences, and sentences that are still too
+    long are split on token boundaries. Consecutive chunks share up to `chunk_overlap` tokens
+    of trailing paragraphs, and every chunk starts with the headings it falls under so it can
+    be understood on its own. The headings and the paragraph separators count towards the chunk size.
+
+    Attributes:
+        chunk_size (int): The target number of tokens per chunk.
+        chunk_overlap (int): The maximum number of tokens repeated from the end of the previous chunk.
+        tokenizer (tiktoken.Encoding): The tokenizer used to count tokens.
+    """
+    def __init__(self, chunk_size=512, chunk_overlap=64, encoding_name='cl100k_base'):
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.tokenizer = tiktoken.get_encoding(encoding_name)
+
+    def count_tokens(self, text):
+        return len(self.tokenizer.encode(text))
+
+    def split_blocks(self, content):
+        """
+        Splits markdown content into paragraphs and headings.
+
+        Returns:
+            list: (text, headings) pairs, where headings is the list of headings the block falls under
+                  (for a heading block, this includes the heading itself).
+        """
+        blocks = []
+        headings = []
+        for paragraph in re.split(r"\n\s*\n", content):
+            lines = []
+            for line in paragraph.strip().split("\n"):
+                match = HEADING_PATTERN.match(line.strip())
+                if match is None:
+                    lines.append(line)
+                    continue
+                # Headings always start a new block
+                if lines:
+                    blocks.append(("\n".join(lines), list(headings)))
+                    lines = []
+                level = len(match.group(1))
+                headings = [h for h in headings if len(HEADING_PATTERN.match(h).group(1)) < level]
+                headings.append(line.strip())
+                blocks.append((line.strip(), list(headings)))
+            if lines and "\n".join(lines).strip():
+                blocks.append(("\n".join(lines), list(headings)))
+        return blocks
+
+    def split_long_text(self, text, max_tokens):
+        """Splits text that is longer than `max_tokens` into sentences, then into token windows."""
+        pieces = []
+        for sentence in SENTENCE_PATTERN.split(text):
+            tokens = self.tokenizer.encode(sentence)
+            if len(tokens) <= max_tokens:
+                pieces.append(sentence)
+            else:
+                pieces += [self.tokenizer.decode(tokens[i:i + max_tokens])
+                           for i in range(0, len(tokens), max_tokens)]
+        return pieces
+
+    def heading_trail(self, text, headings):
+        """Returns the headings that are prepended to a chunk starting with the given block."""
+        return [h for h in headings if h != text]
+
+    def trail_tokens(self, text, headings):
+        """Returns the number of tokens of the heading trail (and its line break) of a chunk starting with the block."""
+        trail = self.heading_trail(text, headings)
+        return self.count_tokens("\n".join(trail) + "\n") if trail else 0
+
+    def chunk(self, title, content):
+        """
+        Splits a course section into chunks.
+
+        Args:
+            title (str): The section title (e.g. "# 1_1_history.md"), which is kept in each chunk's metadata.
+            content (str): The markdown content of the section.
+
+        Returns:
+            list: The chunks as Documents with "title", "headings", "part" and "tokens" metadata.
+        """
+        # Split into pieces that each fit in a chunk (along with the heading trail of that chunk)
+        pieces = []
+        for text, headings in self.split_blocks(content):
+            n_tokens = self.count_tokens(text)
+            max_tokens = max(1, self.chunk_size - self.trail_tokens(text, headings))
+            if n_tokens <= max_tokens:
+                pieces.append((text, headings, n_tokens))
+            else:
+                pieces += [(piece, headings, self.count_tokens(piece)) 
+                           for piece in self.split_long_text(text, max_tokens)]
+
+        # Greedily pack the pieces into chunks. The size of a chunk includes its heading trail
+        # and a token for each paragraph separator.
+        groups = []
+        current = []
+        current_tokens = 0
+        for piece in pieces:
+            text, headings, n_tokens = piece
+            is_heading = HEADING_PATTERN.match(text) is not None
+            # Prefer to cut before a heading once the chunk is at least half full
+            if current and (current_tokens + 1 + n_tokens > self.chunk_size or
+                            (is_heading and current_tokens >= self.chunk_size // 2)):
+                groups.append(current)
+                # Carry over the trailing paragraphs (not headings) of the previous chunk
+                overlap = []
+                overlap_tokens = 0
+                for prev in reversed(current):
+                    if (HEADING_PATTERN.match(prev[0]) or is_heading or
+                        overlap_tokens + prev[2] > self.chunk_overlap):
+                        break
+                    overlap.insert(0, prev)
+                    overlap_tokens += prev[2]
+                if overlap:
+                    overlap_tokens += self.trail_tokens(overlap[0][0], overlap[0][1]) + len(overlap) - 1
+                if overlap_tokens + 1 + n_tokens > self.chunk_size:
+                    overlap, overlap_tokens = [], 0
+                current, current_tokens = overlap, overlap_tokens
+            if current:
+                current_tokens += 1 + n_tokens
+            else:
+                current_tokens = self.trail_tokens(text, headings) + n_tokens
+            current.append(piece)
+        if current:
+            groups.append(current)
+
+        chunks = []
+        for part, group in enumerate(groups, start=1):
+            headings = group[0][1]
+            body = "\n\n".join(text for text, _, _ in group)
+            # Start each chunk with the headings it falls under
+            trail = self.heading_trail(group[0][0], headings)
+            page_content = "\n".join(trail + [body]) if trail else body
+            chunks.append(Document(page_content=page_content,
+                                   metadata={"title": title,
+                                             "headings": " > ".join(headings),
+                                             "part": part,
+                                             "tokens": self.count_tokens(page_content)}))
+        return chunks
+
+def chunk_stats(token_counts):
+    """
+    Summarises the chunk sizes.
+
+    Args:
+        token_counts (list): The number of tokens in each chunk.
+
+    Returns:
+        dict: The number of chunks and the total, mean, minimum, median, 95th percentile and maximum tokens.
+    """
+    if not token_counts:
+        return {"chunks": 0}
+    counts = sorted(token_counts)
+    return {"chunks": len(counts),
+            "total": sum(counts),
+            "mean": round(sum(counts) / len(counts), 1),
+            "min": counts[0],
+            "median": counts[len(counts) // 2],
+            "p95": counts[min(len(counts) - 1, int(0.95 * len(counts)))],
+            "max": counts[-1]}
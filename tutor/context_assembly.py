@@ -0,0 +1,98 @@
+import re
+import tiktoken
+from langchain.schema import Document
+from langchain_core.runnables import RunnableLambda
+from lexical_retriever import tokenize
+
+def shingles(text, n=3):
+    """Returns the set of n-word sequences in the text, used to find near-duplicate chunks."""
+    words = tokenize(text)
+    return {tuple(words[i:i + n]) for i in range(max(1, len(words) - n + 1))}
+
+def similarity(a, b):
+    """Jaccard similarity between two sets of shingles."""
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+class ContextAssembler:
+    """
+    Assembles the retrieved course content into the context for the tutor's prompt.
+
+    The retrieved documents (in order of relevance) are added to the context until the token budget is
+    used up. Near-duplicates of documents already in the context are dropped, and the document that
+    does not fit is trimmed to its paragraphs that are most relevant to the question. Each document in
+    the context records its token count in its "context_tokens" metadata.
+
+    Attributes:
+        token_budget (int): The maximum number of tokens of retrieved context per turn.
+        duplicate_threshold (float): The shingle similarity above which a document is a near-duplicate.
+        tokenizer (tiktoken.Encoding): The tokenizer used to count tokens.
+    """
+    def __init__(self, token_budget=3000, duplicate_threshold=0.8, min_trimmed_tokens=50, encoding_name='cl100k_base'):
+        self.token_budget = token_budget
+        self.duplicate_threshold = duplicate_threshold
+        self.min_trimmed_tokens = min_trimmed_tokens
+        self.tokenizer = tiktoken.get_encoding(encoding_name)
+
+    def count_tokens(self, text):
+        return len(self.tokenizer.encode(text))
+
+    def trim(self, question, text, budget):
+        """Keeps the paragraphs of the text that share the most words with the question, within the budget."""
+        question_terms = set(tokenize(question))
+        paragraphs = [p for p in re.split(r"\n\s*\n", text) if p.strip()]
+        ranked = sorted(range(len(paragraphs)),
+                        key=lambda i: len(question_terms & set(tokenize(paragraphs[i]))), reverse=True)
+        keep = []
+        used = 0
+        for i in ranked:
+            n_tokens = self.count_tokens(paragraphs[i]) + 1
+            if used + n_tokens <= budget:
+                keep.append(i)
+                used += n_tokens
+        # Keep the paragraphs in their original order
+        return "\n\n".join(paragraphs[i] for i in sorted(keep))
+
+    def assemble(self, question, documents):
+        """
+        Selects and trims the documents to fit in the token budget.
+
+        Args:
+            question (str): The student's question.
+            documents (list): The retrieved Documents, from the most to the least relevant.
+        Returns:
+            list: The Documents to use as context.
+        """
+        context = []
+        kept_shingles = []
+        remaining = self.token_budget
+        for document in documents:
+            document_shingles = shingles(document.page_content)
+            if any(similarity(document_shingles, kept) >= self.duplicate_threshold for kept in kept_shingles):
+                continue
+            page_content = document.page_content
+            # Include the separator between documents
+            n_tokens = self.count_tokens(page_content) + 1
+            if n_tokens > remaining:
+                if remaining < self.min_trimmed_tokens:
+                    break
+                page_content = self.trim(question, page_content, remaining)
+                if not page_content:
+                    continue
+                n_tokens = self.count_tokens(page_content) + 1
+            # Copy the document, since retrieved documents may be shared between sessions
+            context.append(Document(page_content=page_content,
+                                    metadata={**document.metadata, "context_tokens": n_tokens}))
+            kept_shingles.append(document_shingles)
+            remaining -= n_tokens
+        return context
+
+    def as_runnable(self, retriever):
+        """
+        Returns a runnable that retrieves documents for the chain inputs and assembles them into the context,
+        to be used as the retriever of `create_retrieval_chain`.
+        """
+        return RunnableLambda(lambda inputs: self.assemble(inputs["input"], retriever.invoke(inputs)))
+
+def context_tokens(documents):
+    """Returns the number of prompt tokens used by the assembled context."""
+    return sum(document.metadata.get("context_tokens", 0) for document in documents)
@@ -0,0 +1,118 @@
+import re
+import json
+import hashlib
+import threading
+from collections import OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableLambda
+
+# Words that refer back to something earlier in the conversation
+REFERENCE_PATTERN = re.compile(r"\b(it|its|this|that|these|those|they|them|their|he|she|him|her|"
+                               r"one|ones|above|previous|earlier|again|same|else|another|other|last)\b",
+                               re.IGNORECASE)
+# Openings of follow-up questions (e.g. "And for Mars?", "What about the Moon?")
+FOLLOW_UP_PATTERN = re.compile(r"^\s*(and|but|so|also|then|what about|how about|why not|what if)\b", re.IGNORECASE)
+
+# Rewrites (and the stats) are shared by every session in the process
+rewrite_cache = OrderedDict()
+rewrite_stats = Counter()
+rewrite_cache_lock = threading.Lock()
+rewrite_stats_lock = threading.Lock()
+executor = ThreadPoolExecutor(max_workers=8)
+
+def count(outcome):
+    """Counts a question's outcome in `rewrite_stats`, which is updated from several threads."""
+    with rewrite_stats_lock:
+        rewrite_stats[outcome] += 1
+
+def needs_rewrite(question, chat_history):
+    """
+    Checks whether the question needs the chat history to be understood.
+
+    Args:
+        question (str): The student's latest question.
+        chat_history (list): The previous messages of the conversation.
+    Returns:
+        bool: False if there is no history or the question has no unresolved references.
+    """
+    if not chat_history:
+        return False
+    return (len(question.split()) <= 3 or
+            bool(FOLLOW_UP_PATTERN.search(question)) or
+            bool(REFERENCE_PATTERN.search(question)))
+
+class QuestionContextualizer:
+    """
+    Finds the course content for a question in the context of the conversation.
+
+    The question is only rewritten into a standalone question (an LLM call) when it has unresolved
+    references to the conversation. Rewrites are cached, and while the rewrite is running the content
+    for the raw question is retrieved concurrently. The raw question's content is kept if the rewrite
+    leaves the question unchanged, fails or takes longer than `rewrite_timeout` seconds.
+
+    The number of questions that bypassed the rewrite ("bypassed"), used a cached rewrite ("cached"),
+    were rewritten ("rewritten") or kept the raw question's content ("kept_raw") are counted in `rewrite_stats`.
+
+    Attributes:
+        rewrite_chain (Runnable): Rewrites the question given the chat history.
+        retriever (Runnable): Retrieves the course content for a question.
+    """
+    def __init__(self, llm, retriever, prompt, rewrite_timeout=5, max_cache_entries=1024):
+        self.rewrite_chain = prompt | llm | StrOutputParser()
+        self.model = getattr(llm, "model_name", None)
+        self.retriever = retriever
+        self.rewrite_timeout = rewrite_timeout
+        self.max_cache_entries = max_cache_entries
+
+    def rewrite_key(self, question, chat_history):
+        messages = [[message.type, message.content] for message in chat_history]
+        return hashlib.sha256(json.dumps([self.model, messages, question]).encode()).hexdigest()
+
+    def rewrite(self, question, chat_history):
+        """Returns the standalone version of the question, from the cache if it has been rewritten before."""
+        key = self.rewrite_key(question, chat_history)
+        with rewrite_cache_lock:
+            if key in rewrite_cache:
+                rewrite_cache.move_to_end(key)
+                count("cached")
+                return rewrite_cache[key]
+        standalone_question = self.rewrite_chain.invoke({"input": question, "chat_history": chat_history})
+        with rewrite_cache_lock:
+            rewrite_cache[key] = standalone_question
+            while len(rewrite_cache) > self.max_cache_entries:
+                rewrite_cache.popitem(last=False)
+        count("rewritten")
+        return standalone_question
+
+    def retrieve(self, inputs):
+        """
+        Retrieves the course content for the latest question.
+
+        Args:
+            inputs (dict): The chain inputs, with the question ("input") and "chat_history".
+        Returns:
+            list: The retrieved Documents.
+        """
+        question = inputs["input"]
+        chat_history = inputs.get("chat_history", [])
+        if not needs_rewrite(question, chat_history):
+            count("bypassed")
+            return self.retriever.invoke(question)
+
+        # Rewrite the question while retrieving the content for the raw question
+        rewrite = executor.submit(self.rewrite, question, chat_history)
+        raw_documents = executor.submit(self.retriever.invoke, question)
+        try:
+            standalone_question = rewrite.result(timeout=self.rewrite_timeout)
+        except Exception:
+            # Includes the rewrite timing out
+            standalone_question = question
+        if standalone_question.strip().lower() == question.strip().lower():
+            count("kept_raw")
+            return raw_documents.result()
+        return self.retriever.invoke(standalone_question)
+
+    def as_runnable(self):
+        """Returns the contextualiser as a runnable that can be used as the retriever of `create_retrieval_chain`."""
+        return RunnableLambda(self.retrieve)
@@ -0,0 +1,271 @@
+import os
+import re
+import json
+import fcntl
+import shutil
+import hashlib
+import tempfile
+from contextlib import contextmanager
+from langchain.vectorstores import Chroma
+
+import sys
+sys.path.append(os.path.dirname(__file__))
+from chunking import TokenChunker, chunk_stats
+from embedding_service import get_embedding_service
+
+# Location of the course content and the persisted vector stores
+cur_dir = os.path.dirname(__file__)
+course_content_path = os.path.join(cur_dir, 'course_content.txt')
+vector_store_root = os.path.join(cur_dir, 'vector_store')
+
+def load_text_file(file_path):
+    return open(file_path, 'r').read()
+
+### Structuring the Content
+
+def split_sections(content):
+    """Splits the course content into its file sections (README, lesson and assignment files)."""
+    # Define patterns for splitting based on README, lesson files, and assignments
+    readme_pattern = r"# Unit\d+_README\.md"
+    lesson_pattern = r"# \d+_\d+_[\w_]+\.md"
+    assignment_pattern = r"# Unit \d+ Assignment"
+
+    # Combine all patterns
+    combined_pattern = f"({readme_pattern}|{lesson_pattern}|{assignment_pattern})"
+
+    # Find all matches (file sections) and split the content
+    matches = re.split(combined_pattern, content)
+    return [(matches[i].strip(), matches[i + 1].strip()) for i in range(1, len(matches), 2)]
+
+### Linking to the Course Website
+
+base_url = "https://teaghan.github.io/astronomy-12/"
+
+def section_link(title):
+    """
+    Returns the markdown link to the course page of a section (README, lesson or assignment), 
+    or None if the section has no page.
+    """
+    # Handle README files
+    readme_match = re.search(r"# Unit(\d+)_README\.md", title)
+    if readme_match:
+        unit_number = readme_match.group(1)
+        return f"- [Unit {unit_number}]({base_url}md_files/Unit{unit_number}_README.html)"
+
+    # Handle lesson files
+    lesson_parts = re.search(r"# (\d+)_(\d+)_(\w+)\.md", title)
+    if lesson_parts:
+        unit, lesson, name = lesson_parts.groups()
+        name_formatted = name.replace('_', ' ')  # Assuming names are using underscores instead of spaces
+        link_text = f"Lesson {unit}.{lesson} {name_formatted}"
+        return f"- [{link_text}]({base_url}md_files/{unit}_{lesson}_{name}.html)"
+
+    # Handle assignments
+    assignment_match = re.search(r"# Unit (\d+) Assignment", title)
+    if assignment_match:
+        assignment_number = assignment_match.group(1)
+        return f"- [Unit {assignment_number} Assignment]({base_url}Unit{assignment_number}/Unit{assignment_number}_Assignment.pdf)"
+    return None
+
+def load_section_links():
+    """Returns a map from each section title in the course content to the link to its course page."""
+    return {title: section_link(title) for title, _ in split_sections(load_text_file(course_content_path))}
+
+def chunk_section(title, content, chunker):
+    """Splits a section into chunks, storing the link to the section's course page on each chunk."""
+    link = section_link(title)
+    chunks = chunker.chunk(title, content)
+    for chunk in chunks:
+        if link:
+            chunk.metadata["link"] = link
+    return chunks
+
+def split_by_files(content, chunker):
+    # Collect file content
+    chunks = []
+    for chunk_title, chunk_content in split_sections(content):
+        chunks += chunk_section(chunk_title, chunk_content, chunker)
+    return chunks
+
+### Persisting the Vector Store
+
+def fingerprint(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def chunk_id(chunk):
+    """Content-addressed id of a chunk, so unchanged chunks keep the same id (and vector)."""
+    return fingerprint(f"{chunk.metadata['title']}\n{chunk.page_content}")[:32]
+
+def get_index_dir(embedding, chunker):
+    """
+    Returns the directory of the vector stores for the given embedding model and chunking settings.
+    Changing either of these requires every chunk to be re-embedded, so they get a new directory.
+
+    Each build of the store is kept in its own directory under "builds", and the "current" file 
+    names the build that is served. Builds are never modified once they are current.
+    """
+    settings = f"{chunker.chunk_size}-{chunker.chunk_overlap}-{chunker.tokenizer.name}"
+    return os.path.join(vector_store_root, f"{embedding}-{fingerprint(settings)[:8]}")
+
+def current_build_dir(index_dir):
+    """Returns the directory of the current build of the store, or None if it has not been built."""
+    pointer_path = os.path.join(index_dir, 'current')
+    if not os.path.isfile(pointer_path):
+        return None
+    with open(pointer_path) as f:
+        return os.path.join(index_dir, 'builds', f.read().strip())
+
+def set_current_build(index_dir, build_name):
+    # Write to a temporary file first so the pointer is swapped atomically
+    pointer_path = os.path.join(index_dir, 'current')
+    with open(pointer_path + '.tmp', 'w') as f:
+        f.write(build_name)
+    os.replace(pointer_path + '.tmp', pointer_path)
+
+def load_manifest(build_dir):
+    """Loads the manifest of the indexed sections and chunks (empty if the store has not been built)."""
+    manifest_path = os.path.join(build_dir, 'manifest.json') if build_dir else None
+    if manifest_path is None or not os.path.isfile(manifest_path):
+        return {"content_hash": None, "sections": {}}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+def save_manifest(build_dir, manifest):
+    # Write to a temporary file first so the manifest is never partially written
+    manifest_path = os.path.join(build_dir, 'manifest.json')
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+@contextmanager
+def build_lock(index_dir):
+    """Holds an exclusive lock on the store's directory, so only one process updates it at a time."""
+    os.makedirs(index_dir, exist_ok=True)
+    with open(os.path.join(index_dir, '.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def update_index(content, embedding='text-embedding-3-small', chunker=None, keep_builds=2):
+    """
+    Builds a new version of the persisted vector store that matches the course content.
+
+    The current build is copied into a fresh directory, which is updated and then made current 
+    by atomically swapping the "current" pointer, so the build being served is never modified. 
+    Only one process updates the store at a time.
+
+    Each section (README, lesson, assignment) is fingerprinted, and only the sections that have 
+    changed are re-chunked. Each chunk is identified by a hash of its content. The new and changed 
+    chunks are reconciled against the ids that are actually in the store (not just the manifest), 
+    so only the chunks that are missing from the store are embedded, and any vectors that are not 
+    chunks of the current content are deleted. The manifest records the fingerprint and chunk ids 
+    of every indexed section.
+
+    Returns:
+        dict: The number of chunks that were added, deleted and left unchanged.
+    """
+    chunker = chunker or TokenChunker()
+    index_dir = get_index_dir(embedding, chunker)
+    stats = {"added": 0, "deleted": 0, "unchanged": 0}
+    content_hash = fingerprint(content)
+    with build_lock(index_dir):
+        current_dir = current_build_dir(index_dir)
+        manifest = load_manifest(current_dir)
+        if manifest["content_hash"] == content_hash:
+            stats["unchanged"] = sum(len(section["chunks"]) for section in manifest["sections"].values())
+            return stats
+
+        # Update a copy of the current build
+        builds_dir = os.path.join(index_dir, 'builds')
+        os.makedirs(builds_dir, exist_ok=True)
+        build_dir = tempfile.mkdtemp(dir=builds_dir, prefix='.tmp-')
+        if current_dir is not None and os.path.isdir(current_dir):
+            shutil.copytree(current_dir, build_dir, dirs_exist_ok=True)
+
+        # Find the chunks of every section, re-using the chunk ids of unchanged sections
+        contents = dict(split_sections(content))
+        sections = {}
+        new_chunks = {}
+        for section_title, section_content in contents.items():
+            section_hash = fingerprint(section_content)
+            indexed_section = manifest["sections"].get(section_title)
+            if indexed_section is not None and indexed_section["hash"] == section_hash:
+                sections[section_title] = indexed_section
+                continue
+            chunks = chunk_section(section_title, section_content, chunker)
+            sections[section_title] = {"hash": section_hash, 
+                                       "chunks": [chunk_id(chunk) for chunk in chunks],
+                                       "tokens": [chunk.metadata["tokens"] for chunk in chunks]}
+            new_chunks.update({chunk_id(chunk): chunk for chunk in chunks})
+
+        # Reconcile against the ids that are in the store
+        vecs = Chroma(persist_directory=build_dir, embedding_function=get_embedding_service(embedding))
+        stored_ids = set(vecs._collection.get(include=[])["ids"])
+        current_ids = {i for section in sections.values() for i in section["chunks"]}
+        added_ids = sorted(current_ids - stored_ids)
+        stale_ids = sorted(stored_ids - current_ids)
+        for section_title, section in sections.items():
+            # Re-chunk unchanged sections whose chunks are missing from the store
+            if any(i not in stored_ids and i not in new_chunks for i in section["chunks"]):
+                new_chunks.update({chunk_id(chunk): chunk 
+                                   for chunk in chunk_section(section_title, contents[section_title], chunker)})
+
+        # Only embed the missing chunks and delete the stale vectors
+        if stale_ids:
+            vecs.delete(ids=stale_ids)
+        if added_ids:
+            vecs.add_documents([new_chunks[i] for i in added_ids], ids=added_ids)
+        vecs.persist()
+        save_manifest(build_dir, {"content_hash": content_hash, "embedding": embedding, "sections": sections})
+
+        # Swap the new build in and remove the older builds (keeping the previous one for workers still using it)
+        build_name = content_hash[:16]
+        final_dir = os.path.join(builds_dir, build_name)
+        if os.path.isdir(final_dir):
+            shutil.rmtree(final_dir)
+        os.rename(build_dir, final_dir)
+        set_current_build(index_dir, build_name)
+        builds = sorted((os.path.join(builds_dir, name) for name in os.listdir(builds_dir)), 
+                        key=os.path.getmtime, reverse=True)
+        for old_dir in builds[keep_builds:]:
+            shutil.rmtree(old_dir, ignore_errors=True)
+
+    stats.update({"added": len(added_ids), 
+                  "deleted": len(stale_ids), 
+                  "unchanged": len(current_ids) - len(added_ids)})
+    return stats
+
+def index_chunk_stats(embedding='text-embedding-3-small', chunker=None):
+    """Returns the chunk-size statistics (see `chunk_stats`) of the persisted vector store."""
+    manifest = load_manifest(current_build_dir(get_index_dir(embedding, chunker or TokenChunker())))
+    return chunk_stats([n for section in manifest["sections"].values() for n in section["tokens"]])
+
+def load_chunks(chunker=None):
+    """Returns the chunks of the current course content (the same chunks that are in the vector store)."""
+    return split_by_files(load_text_file(course_content_path), chunker or TokenChunker())
+
+def load_index(embedding='text-embedding-3-small', chunker=None):
+    """
+    Loads the current build of the persisted vector store, which is only read from, so it can be 
+    shared by every worker process. Changes to the course content are applied by the offline build 
+    step (`python tutor/course_index.py`); the store is only built here if it does not exist yet.
+    """
+    chunker = chunker or TokenChunker()
+    index_dir = get_index_dir(embedding, chunker)
+    build_dir = current_build_dir(index_dir)
+    if build_dir is None:
+        update_index(load_text_file(course_content_path), embedding, chunker)
+        build_dir = current_build_dir(index_dir)
+    elif load_manifest(build_dir)["content_hash"] != fingerprint(load_text_file(course_content_path)):
+        print("The course content has changed since the vector store was built. "
+              "Run `python tutor/course_index.py` to update it.")
+    return Chroma(persist_directory=build_dir, embedding_function=get_embedding_service(embedding))
+
+if __name__ == "__main__":
+    # Offline build step: python tutor/course_index.py
+    stats = update_index(load_text_file(course_content_path))
+    print(f"Course content index updated: {stats['added']} chunks embedded, "
+          f"{stats['deleted']} deleted and {stats['unchanged']} unchanged.")
+    print(f"Chunk sizes (tokens): {index_chunk_stats()}")
@@ -0,0 +1,246 @@
+import os
+import time
+import random
+import asyncio
+import sqlite3
+import hashlib
+import threading
+from array import array
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import tiktoken
+import openai
+
+# Errors worth retrying: rate limits, timeouts and server errors
+RETRY_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError)
+
+def text_hash(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+class TokenRateLimiter:
+    """
+    Limits the number of tokens sent per minute, using a sliding one-minute window.
+    """
+    def __init__(self, tokens_per_minute=1000000):
+        self.tokens_per_minute = tokens_per_minute
+        self.window = deque()
+        self.lock = threading.Lock()
+
+    def reserve(self, n_tokens):
+        """Reserves `n_tokens` if they can be sent now, or returns the number of seconds to wait before trying again."""
+        with self.lock:
+            now = time.time()
+            while self.window and now - self.window[0][0] >= 60:
+                self.window.popleft()
+            used = sum(tokens for _, tokens in self.window)
+            # A request larger than the limit is let through once the window is empty
+            if used + n_tokens <= self.tokens_per_minute or not self.window:
+                self.window.append((now, n_tokens))
+                return 0
+            return 60 - (now - self.window[0][0])
+
+    def acquire(self, n_tokens):
+        """Blocks until `n_tokens` can be sent without exceeding the limit."""
+        while (wait := self.reserve(n_tokens)) > 0:
+            time.sleep(wait)
+
+    async def aacquire(self, n_tokens):
+        """Async version of `acquire`, which waits without blocking the event loop."""
+        while (wait := self.reserve(n_tokens)) > 0:
+            await asyncio.sleep(wait)
+
+class EmbeddingCache:
+    """An on-disk cache of embedding vectors keyed by (model, text hash), stored in a SQLite database."""
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS embeddings (
+                                model TEXT,
+                                text_hash TEXT,
+                                vector BLOB,
+                                PRIMARY KEY (model, text_hash))""")
+        self.conn.commit()
+        self.lock = threading.Lock()
+
+    def get_many(self, model, hashes):
+        """Returns a dict of the cached vectors for the given text hashes."""
+        vectors = {}
+        with self.lock:
+            # Query in groups to stay under SQLite's limit on the number of parameters
+            for i in range(0, len(hashes), 500):
+                group = hashes[i:i + 500]
+                rows = self.conn.execute(f"SELECT text_hash, vector FROM embeddings WHERE model = ? "
+                                         f"AND text_hash IN ({','.join('?' * len(group))})", [model] + group)
+                vectors.update({h: array('f', vector).tolist() for h, vector in rows})
+        return vectors
+
+    def set_many(self, model, vectors):
+        """Stores a dict of vectors keyed by text hash."""
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                                  [(model, h, array('f', vector).tobytes()) for h, vector in vectors.items()])
+            self.conn.commit()
+
+class EmbeddingService:
+    """
+    Embeds texts with the OpenAI embeddings API, re-using previously computed vectors.
+
+    Texts that are not in the cache are de-duplicated and grouped into batches that stay within the
+    API's limits on the number of inputs and tokens per request. The batches are embedded concurrently
+    under a tokens-per-minute rate limit, and failed requests are retried with exponential backoff.
+    Rebuilding an index with the same texts and model only reads from the cache.
+
+    The on-disk cache is reserved for documents. Query embeddings (which are rarely repeated 
+    across processes) are kept in a bounded in-memory LRU cache, so queries don't grow the database.
+
+    Implements `embed_documents` and `embed_query`, so it can be used as a langchain embedding function.
+    Queries can also be embedded from an event loop with `aembed_query`.
+
+    Attributes:
+        model (str): The embedding model.
+        cache (EmbeddingCache): The on-disk vector cache of the documents.
+        query_cache (OrderedDict): The in-memory LRU cache of the query vectors.
+        rate_limiter (TokenRateLimiter): Limits the tokens sent per minute.
+        stats (dict): The number of texts read from the cache and embedded by the API.
+    """
+    def __init__(self, model='text-embedding-3-small', cache_path=None, max_batch_size=2048,
+                 max_batch_tokens=300000, tokens_per_minute=1000000, max_workers=4, max_retries=6,
+                 query_cache_size=1024):
+        """
+        Args:
+            model (str): The embedding model.
+            cache_path (str, optional): The path of the SQLite cache (defaults to embedding_cache.sqlite next to this file).
+            max_batch_size (int): The maximum number of texts per request.
+            max_batch_tokens (int): The maximum number of tokens per request.
+            tokens_per_minute (int): The token-per-minute limit of the API key.
+            max_workers (int): The maximum number of concurrent requests.
+            max_retries (int): The number of times a failed request is retried.
+            query_cache_size (int): The maximum number of query vectors kept in memory.
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        cache_path = cache_path or os.path.join(os.path.dirname(__file__), 'embedding_cache.sqlite')
+        self.cache = EmbeddingCache(cache_path)
+        self.query_cache = OrderedDict()
+        self.query_cache_size = query_cache_size
+        self.query_lock = threading.Lock()
+        self.rate_limiter = TokenRateLimiter(tokens_per_minute)
+        self.tokenizer = tiktoken.get_encoding('cl100k_base')
+        # Retries are handled here so they respect the rate limiter
+        self.client = openai.OpenAI(max_retries=0)
+        self.aclient = openai.AsyncOpenAI(max_retries=0)
+        self.stats = {"cached": 0, "embedded": 0}
+
+    def make_batches(self, texts):
+        """Groups texts into batches within the request size and token limits."""
+        batches = []
+        batch, batch_tokens = [], 0
+        for text in texts:
+            n_tokens = len(self.tokenizer.encode(text))
+            if batch and (len(batch) >= self.max_batch_size or batch_tokens + n_tokens > self.max_batch_tokens):
+                batches.append((batch, batch_tokens))
+                batch, batch_tokens = [], 0
+            batch.append(text)
+            batch_tokens += n_tokens
+        if batch:
+            batches.append((batch, batch_tokens))
+        return batches
+
+    def embed_batch(self, batch, n_tokens):
+        """Embeds a single batch, retrying with exponential backoff."""
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire(n_tokens)
+            try:
+                response = self.client.embeddings.create(model=self.model, input=batch)
+                return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+            except RETRY_ERRORS:
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(min(60, 2 ** attempt) * (0.5 + random.random()))
+
+    async def aembed_batch(self, batch, n_tokens):
+        """Async version of `embed_batch`."""
+        for attempt in range(self.max_retries + 1):
+            await self.rate_limiter.aacquire(n_tokens)
+            try:
+                response = await self.aclient.embeddings.create(model=self.model, input=batch)
+                return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+            except RETRY_ERRORS:
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(min(60, 2 ** attempt) * (0.5 + random.random()))
+
+    def embed_documents(self, texts):
+        """
+        Embeds a list of texts.
+
+        Args:
+            texts (list): The texts to embed.
+        Returns:
+            list: The embedding vector of each text.
+        """
+        hashes = [text_hash(text) for text in texts]
+        vectors = self.cache.get_many(self.model, list(set(hashes)))
+        missing = {h: text for h, text in zip(hashes, texts) if h not in vectors}
+        self.stats["cached"] += sum(h in vectors for h in hashes)
+
+        if missing:
+            batches = self.make_batches(list(missing.values()))
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                results = list(executor.map(lambda batch: self.embed_batch(*batch), batches))
+            new_vectors = {}
+            for (batch, _), batch_vectors in zip(batches, results):
+                new_vectors.update({text_hash(text): vector for text, vector in zip(batch, batch_vectors)})
+            self.cache.set_many(self.model, new_vectors)
+            vectors.update(new_vectors)
+            self.stats["embedded"] += len(missing)
+
+        return [vectors[h] for h in hashes]
+
+    def embed_query(self, text):
+        """Embeds a single query, caching its vector in memory only (see `embed_documents` for documents)."""
+        h = text_hash(text)
+        vector = self.cached_query(h)
+        if vector is None:
+            vector = self.embed_batch([text], len(self.tokenizer.encode(text)))[0]
+            self.cache_query(h, vector)
+        return vector
+
+    async def aembed_query(self, text):
+        """Async version of `embed_query`."""
+        h = text_hash(text)
+        vector = self.cached_query(h)
+        if vector is None:
+            vector = (await self.aembed_batch([text], len(self.tokenizer.encode(text))))[0]
+            self.cache_query(h, vector)
+        return vector
+
+    def cached_query(self, h):
+        """Returns the cached vector of a query (by text hash), or None."""
+        with self.query_lock:
+            vector = self.query_cache.get(h)
+            if vector is not None:
+                self.query_cache.move_to_end(h)
+                self.stats["cached"] += 1
+            return vector
+
+    def cache_query(self, h, vector):
+        """Stores the vector of a newly embedded query, evicting the least recently used queries."""
+        with self.query_lock:
+            self.query_cache[h] = vector
+            while len(self.query_cache) > self.query_cache_size:
+                self.query_cache.popitem(last=False)
+            self.stats["embedded"] += 1
+
+# Services are shared by every index in the process
+services = {}
+services_lock = threading.Lock()
+
+def get_embedding_service(model='text-embedding-3-small'):
+    """Returns the shared embedding service for the given model."""
+    with services_lock:
+        if model not in services:
+            services[model] = EmbeddingService(model)
+        return services[model]
@@ -0,0 +1,215 @@
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import tiktoken
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import SystemMessage, HumanMessage, messages_to_dict, messages_from_dict
+
+### Storage Backends
+
+class MemoryBackend:
+    """
+    Keeps the session histories in memory. Sessions that have been idle for longer than `idle_timeout`
+    seconds are evicted, as are the least recently used sessions beyond `max_sessions`.
+    """
+    def __init__(self, max_sessions=1000, idle_timeout=6 * 3600):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def load(self, session_id):
+        """Returns the (summary, messages) of the session, or None if it is not stored."""
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                return None
+            self.sessions.move_to_end(session_id)
+            return session["summary"], list(session["messages"])
+
+    def save(self, session_id, messages):
+        with self.lock:
+            session = self.sessions.setdefault(session_id, {"summary": ""})
+            session.update({"messages": list(messages), "updated": time.time()})
+            self.sessions.move_to_end(session_id)
+            self.evict()
+
+    def save_summary(self, session_id, summary):
+        with self.lock:
+            if session_id in self.sessions:
+                self.sessions[session_id]["summary"] = summary
+
+    def delete(self, session_id):
+        with self.lock:
+            self.sessions.pop(session_id, None)
+
+    def evict(self):
+        # Loading a session moves it to the end without updating it, so idle sessions may be 
+        # anywhere in the order and every session is checked
+        now = time.time()
+        for session_id in [session_id for session_id, session in self.sessions.items() 
+                           if now - session["updated"] > self.idle_timeout]:
+            del self.sessions[session_id]
+        # Sessions are ordered from the least to the most recently used
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+
+class SQLiteBackend:
+    """
+    Keeps the session histories in a SQLite database, so they do not use memory per session and
+    persist across restarts. Sessions that have been idle for longer than `idle_timeout` seconds are evicted.
+    """
+    def __init__(self, path="chat_history.sqlite", idle_timeout=7 * 24 * 3600):
+        self.idle_timeout = idle_timeout
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS sessions (
+                                session_id TEXT PRIMARY KEY,
+                                summary TEXT,
+                                messages TEXT,
+                                updated REAL)""")
+        self.conn.commit()
+        self.lock = threading.Lock()
+
+    def load(self, session_id):
+        with self.lock:
+            row = self.conn.execute("SELECT summary, messages FROM sessions WHERE session_id = ?",
+                                    (session_id,)).fetchone()
+        if row is None:
+            return None
+        summary, messages = row
+        return summary, messages_from_dict(json.loads(messages))
+
+    def save(self, session_id, messages):
+        now = time.time()
+        with self.lock:
+            self.conn.execute("""INSERT INTO sessions VALUES (?, '', ?, ?) ON CONFLICT(session_id)
+                                 DO UPDATE SET messages = excluded.messages, updated = excluded.updated""",
+                              (session_id, json.dumps(messages_to_dict(messages)), now))
+            self.conn.execute("DELETE FROM sessions WHERE updated < ?", (now - self.idle_timeout,))
+            self.conn.commit()
+
+    def save_summary(self, session_id, summary):
+        with self.lock:
+            self.conn.execute("UPDATE sessions SET summary = ? WHERE session_id = ?", (summary, session_id))
+            self.conn.commit()
+
+    def delete(self, session_id):
+        with self.lock:
+            self.conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            self.conn.commit()
+
+### Summarising Older Turns
+
+summary_instructions = (
+    "You maintain a running summary of a conversation between a student and an astronomy tutor. "
+    "Update the summary with the new messages, keeping the topics discussed, the student's progress "
+    "and anything the tutor has promised to follow up on. Keep it under 150 words. "
+    "Return only the updated summary."
+)
+
+class LLMSummarizer:
+    """Folds messages that fall out of the history window into a rolling summary using an LLM."""
+    def __init__(self, llm):
+        self.llm = llm
+
+    def __call__(self, summary, messages):
+        new_lines = "\n".join(f"{message.type}: {message.content}" for message in messages)
+        prompt = [SystemMessage(content=summary_instructions),
+                  HumanMessage(content=f"Current summary:\n{summary or '(none)'}\n\nNew messages:\n{new_lines}")]
+        return self.llm.invoke(prompt).content
+
+### Session Histories
+
+tokenizer = tiktoken.get_encoding('cl100k_base')
+# Summaries are updated in the background so they do not delay the response
+summary_executor = ThreadPoolExecutor(max_workers=4)
+
+class WindowedChatMessageHistory(BaseChatMessageHistory):
+    """
+    The history of a single session, which keeps the last `max_turns` turns verbatim within a cap of
+    `max_tokens` tokens. Older messages are folded into a rolling summary (if a summarizer is given),
+    which is included at the start of the history as a system message.
+
+    Attributes:
+        session_id (str): The session id.
+        store (HistoryStore): The store holding the session.
+        recent (list): The messages kept verbatim.
+        summary (str): The summary of the earlier messages.
+    """
+    def __init__(self, session_id, store):
+        self.session_id = session_id
+        self.store = store
+        state = store.backend.load(session_id)
+        self.summary, self.recent = state if state is not None else ("", [])
+
+    @property
+    def messages(self):
+        if self.summary:
+            return [SystemMessage(content=f"Summary of the earlier conversation:\n{self.summary}")] + self.recent
+        return list(self.recent)
+
+    def count_tokens(self, messages):
+        return sum(len(tokenizer.encode(message.content)) for message in messages)
+
+    def add_messages(self, messages):
+        self.recent += list(messages)
+        # Move the oldest messages out of the window, always keeping the latest turn
+        evicted = []
+        while len(self.recent) > 2 and (len(self.recent) > 2 * self.store.max_turns or
+                                        self.count_tokens(self.recent) > self.store.max_tokens):
+            evicted.append(self.recent.pop(0))
+        self.store.backend.save(self.session_id, self.recent)
+        if evicted and self.store.summarizer is not None:
+            self.store.queue_summary(self.session_id, evicted)
+
+    def clear(self):
+        self.summary, self.recent = "", []
+        self.store.backend.delete(self.session_id)
+
+class HistoryStore:
+    """
+    Creates the bounded histories of the sessions, shared by every session in the process.
+
+    Attributes:
+        backend (MemoryBackend or SQLiteBackend): Where the session histories are kept.
+        summarizer (callable, optional): Takes the current summary and the evicted messages and returns the new summary.
+        max_turns (int): The number of turns (student and tutor messages) kept verbatim.
+        max_tokens (int): The maximum number of tokens kept verbatim per session.
+    """
+    def __init__(self, backend=None, summarizer=None, max_turns=6, max_tokens=3000):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.summarizer = summarizer
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        # A fixed pool of locks, so the number of locks does not grow with the number of sessions
+        self.summary_locks = [threading.Lock() for _ in range(64)]
+        # The evicted messages of each session that have not been summarised yet, in order
+        self.pending_summaries = {}
+        self.pending_lock = threading.Lock()
+
+    def get(self, session_id):
+        """Returns the history of the session (the function used by `RunnableWithMessageHistory`)."""
+        return WindowedChatMessageHistory(session_id, self)
+
+    def queue_summary(self, session_id, evicted):
+        """Queues evicted messages to be folded into the session's summary in the background."""
+        with self.pending_lock:
+            self.pending_summaries.setdefault(session_id, []).extend(evicted)
+        summary_executor.submit(self.update_summary, session_id)
+
+    def update_summary(self, session_id):
+        # Summaries of the same session are updated one at a time, each starting from the latest summary.
+        # Each update takes every message queued so far (in the order they were evicted), so an update 
+        # that runs late finds nothing left to do instead of overwriting a newer summary.
+        with self.summary_locks[hash(session_id) % len(self.summary_locks)]:
+            with self.pending_lock:
+                evicted = self.pending_summaries.pop(session_id, [])
+            if not evicted:
+                return
+            state = self.backend.load(session_id)
+            if state is None:
+                return
+            self.backend.save_summary(session_id, self.summarizer(state[0], evicted))
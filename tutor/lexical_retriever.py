@@ -0,0 +1,109 @@
+import re
+import math
+from typing import Any, List
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.retrievers import BaseRetriever
+from langchain.schema import Document
+
+# Common words that carry no information about which chunk is relevant
+STOPWORDS = set("""a an and are as at be but by can do does for from how i if in into is it its me my
+of on or so that the their them then there these this to was we what when where which who why will
+with you your""".split())
+
+def tokenize(text):
+    """Lower-cases the text and splits it into words and numbers, without stopwords."""
+    return [token for token in re.findall(r"[a-z0-9]+", text.lower()) if token not in STOPWORDS]
+
+class BM25Index:
+    """
+    An in-memory inverted index that scores documents against a query with BM25.
+
+    Attributes:
+        documents (list): The indexed Documents.
+        postings (dict): Maps each term to a list of (document number, term frequency) pairs.
+        idf (dict): The inverse document frequency of each term.
+    """
+    def __init__(self, documents, k1=1.5, b=0.75):
+        self.documents = documents
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(list)
+        self.doc_lengths = []
+        for i, document in enumerate(documents):
+            # Include the section title so questions naming a lesson or unit match its chunks
+            tokens = tokenize(f"{document.metadata.get('title', '')}\n{document.page_content}")
+            self.doc_lengths.append(len(tokens))
+            for term, frequency in Counter(tokens).items():
+                self.postings[term].append((i, frequency))
+        self.avg_length = sum(self.doc_lengths) / len(documents) if documents else 0
+        n_docs = len(documents)
+        self.idf = {term: math.log(1 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+                    for term, docs in self.postings.items()}
+
+    def search(self, query, k=4):
+        """
+        Finds the documents that best match the query.
+
+        Args:
+            query (str): The search query.
+            k (int): The maximum number of documents to return.
+        Returns:
+            list: (Document, score) pairs, from the highest to the lowest score.
+        """
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            # Only the documents containing the term are scored
+            for i, frequency in self.postings[term]:
+                length_norm = 1 - self.b + self.b * self.doc_lengths[i] / self.avg_length
+                scores[i] += idf * frequency * (self.k1 + 1) / (frequency + self.k1 * length_norm)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(self.documents[i], score) for i, score in ranked]
+
+class BM25Retriever(BaseRetriever):
+    """Retrieves documents from a BM25Index without any network calls."""
+    index: Any
+    k: int = 4
+
+    def _get_relevant_documents(self, query: str, *, run_manager=None) -> List[Document]:
+        return [document for document, _ in self.index.search(query, self.k)]
+
+def document_key(document):
+    return (document.metadata.get('title'), document.page_content)
+
+class HybridRetriever(BaseRetriever):
+    """
+    Runs several retrievers concurrently and merges their results with reciprocal-rank fusion (RRF),
+    where each document scores the sum of 1 / (rrf_k + rank) over the retrievers that returned it.
+
+    If a retriever fails (e.g. the embedding API cannot be reached), the results of the others are used.
+    """
+    retrievers: List[Any]
+    k: int = 4
+    rrf_k: int = 60
+
+    def _get_relevant_documents(self, query: str, *, run_manager=None) -> List[Document]:
+        def retrieve(retriever):
+            try:
+                return retriever.invoke(query)
+            except Exception as error:
+                return error
+
+        with ThreadPoolExecutor(max_workers=len(self.retrievers)) as executor:
+            results = list(executor.map(retrieve, self.retrievers))
+        successful = [documents for documents in results if not isinstance(documents, Exception)]
+        if not successful:
+            raise results[0]
+
+        scores = defaultdict(float)
+        documents = {}
+        for ranked_documents in successful:
+            for rank, document in enumerate(ranked_documents, start=1):
+                key = document_key(document)
+                scores[key] += 1 / (self.rrf_k + rank)
+                documents.setdefault(key, document)
+        ranked = sorted(scores, key=scores.get, reverse=True)[:self.k]
+        return [documents[key] for key in ranked]
@@ -1,23 +1,26 @@
 import streamlit as st
 
 import os
-import re
 import random
+import uuid
 from langchain_openai import ChatOpenAI
-from langchain.vectorstores import Chroma
-from langchain_openai import OpenAIEmbeddings
 from langchain.schema import Document
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_community.chat_message_histories import ChatMessageHistory
-from langchain.chains import create_history_aware_retriever, create_retrieval_chain
+from langchain.chains import create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain_core.runnables.history import RunnableWithMessageHistory
 
 import sys
 cur_dir = os.path.dirname(__file__)
 sys.path.append(cur_dir)
-from save_to_html import convert_messages_to_markdown, markdown_to_html, is_valid_file_name
+from save_to_html import TranscriptExporter, is_valid_file_name
 from drop_file import increment_file_uploader_key, extract_text_from_different_file_types, change_to_prompt_text
+from course_index import load_text_file, load_index, load_chunks, load_section_links
+from chunking import TokenChunker
+from lexical_retriever import BM25Index, BM25Retriever, HybridRetriever
+from contextualize import QuestionContextualizer
+from context_assembly import ContextAssembler, context_tokens
+from history_store import HistoryStore, MemoryBackend, SQLiteBackend, LLMSummarizer
 
 ### Secure API Key Management
 
@@ -33,96 +36,60 @@ os.environ['USER_AGENT'] = 'myagent'
 
 ## Integrating Course Content
 
-def load_text_file(file_path):
-    return open(file_path, 'r').read()
+@st.cache_resource
+def load_course_vectors(embedding, chunk_size=512, chunk_overlap=64):
+    # The persisted course content vectors are loaded once per process and shared by every session
+    return load_index(embedding, TokenChunker(chunk_size, chunk_overlap))
 
-### Structuring the Content
+@st.cache_resource
+def load_lexical_index(chunk_size=512, chunk_overlap=64):
+    # The BM25 index over the same chunks is built in memory once per process
+    return BM25Index(load_chunks(TokenChunker(chunk_size, chunk_overlap)))
 
-def split_by_files(content, context_window):
-    # Define patterns for splitting based on README, lesson files, and assignments
-    readme_pattern = r"# Unit\d+_README\.md"
-    lesson_pattern = r"# \d+_\d+_[\w_]+\.md"
-    assignment_pattern = r"# Unit \d+ Assignment"
-
-    # Combine all patterns
-    combined_pattern = f"({readme_pattern}|{lesson_pattern}|{assignment_pattern})"
-    
-    # Find all matches (file sections) and split the content
-    matches = re.split(combined_pattern, content)
-
-    # Collect file content
-    chunks = []
-    for i in range(1, len(matches), 2):
-        chunk_title = matches[i].strip()
-        chunk_content = matches[i + 1].strip()
-
-        # Check the length of the chunk_content and split if necessary
-        if chunk_content:
-            content_length = len(chunk_content)
-            if content_length <= context_window:
-                chunks.append(Document(page_content=chunk_content, metadata={"title": chunk_title}))
-            else:
-                # Split the content into smaller chunks if it exceeds the context window
-                part_number = 0
-                for start in range(0, content_length, context_window):
-                    end = start + context_window
-                    part_number += 1
-                    subtitle = f"{chunk_title} ({part_number})"
-                    # Ensure the split does not cut off mid-word
-                    if end < content_length and not chunk_content[end].isspace():
-                        # Find the nearest space to avoid splitting words
-                        end = chunk_content.rfind(' ', start, end)
-                    sub_content = chunk_content[start:end].strip()
-                    if sub_content:
-                        chunks.append(Document(page_content=sub_content, metadata={"title": subtitle}))
-
-    return chunks
+@st.cache_resource
+def load_links():
+    # Map of section titles to course page links, built once per process
+    return load_section_links()
 
 def generate_links(context_list):
-    base_url = "https://teaghan.github.io/astronomy-12/"
     links = []
-
+    section_links = load_links()
     for context in context_list:
-        title = context.metadata['title']
-        content = context.page_content
-
-        # Handle README files
-        if "_README.md" in title:
-            unit_number = re.search(r"# Unit(\d+)_README\.md", title).group(1)
-            links.append(f"- [Unit {unit_number}]({base_url}md_files/Unit{unit_number}_README.html)")
-
-        # Handle lesson files
-        elif ".md" in title and "_" in title:
-            # Extract lesson title from content
-            lesson_title_match = re.search(r'# (.*?)\n', content)
-            lesson_title = lesson_title_match.group(1) if lesson_title_match else "Lesson"
-
-            lesson_parts = re.search(r"# (\d+)_(\d+)_(\w+)\.md", title)
-            if lesson_parts:
-                unit, lesson, name = lesson_parts.groups()
-                name_formatted = name.replace('_', ' ')  # Assuming names are using underscores instead of spaces
-                link_text = f"Lesson {unit}.{lesson} {name_formatted}"
-                links.append(f"- [{link_text}]({base_url}md_files/{unit}_{lesson}_{name}.html)")
-
-        # Handle assignments
-        elif "Assignment" in title:
-            assignment_number = re.search(r"# Unit (\d+) Assignment", title).group(1)
-            links.append(f"- [Unit {assignment_number} Assignment]({base_url}Unit{assignment_number}/Unit{assignment_number}_Assignment.pdf)")
+        # Links are stored on each chunk when it is indexed (older chunks fall back to the title map)
+        link = context.metadata.get('link') or section_links.get(context.metadata['title'])
+        if link and link not in links:
+            links.append(link)
 
     return f"\n".join(links)
 
 # Managing Conversation History
-def get_session_history(session_id: str):
-    if "store" not in st.session_state:
-        st.session_state.store = {}
-    return st.session_state.store.setdefault(session_id, ChatMessageHistory())
+@st.cache_resource
+def get_history_store():
+    # Bounded histories shared by every session in the process: the last few turns are kept verbatim
+    # and older turns are summarised. Set TUTOR_HISTORY_DB to keep the histories in a SQLite database.
+    history_db = os.environ.get("TUTOR_HISTORY_DB")
+    backend = SQLiteBackend(history_db) if history_db else MemoryBackend()
+    return HistoryStore(backend, summarizer=LLMSummarizer(ChatOpenAI(model="gpt-4o-mini")))
 
-def build_chatbot(model="gpt-4o-mini", embedding='text-embedding-3-small', pirate_mode=False):
+def get_session_history(session_id: str):
+    return get_history_store().get(session_id)
+
+def build_chatbot(model="gpt-4o-mini", embedding='text-embedding-3-small', pirate_mode=False, retrieval_mode='hybrid',
+                  n_retrieved=8, context_budget=3000):
+    """
+    Builds the conversational RAG chain.
+
+    Args:
+        retrieval_mode (str): How course content is retrieved: 'vector' (embedding similarity), 
+                              'lexical' (BM25, with no network calls) or 'hybrid' (both, merged with 
+                              reciprocal-rank fusion).
+        n_retrieved (int): The number of chunks retrieved per question, before assembling the context.
+        context_budget (int): The maximum number of prompt tokens used for retrieved context per turn.
+    """
     
     ## Building the Chatbot
     
     ### Initializing AI Models for Embedding and Interaction
-    embedding_model = OpenAIEmbeddings(model=embedding)
     llm = ChatOpenAI(model=model)
     
     # Determine max context window for model used
@@ -151,15 +118,17 @@ def build_chatbot(model="gpt-4o-mini", embedding='text-embedding-3-small', pirat
     ### Embed Content Documents
 
     tutor_instructions = load_text_file('tutor/Tutor_Instructions.txt')
-    course_content = load_text_file('tutor/course_content.txt')
-
-    course_content = split_by_files(course_content, context_window)
     tutor_instructions = Document(page_content=tutor_instructions, metadata={"title": "Tutor Instructions"})
     
-    # Initialize Session State for Course Content Vectors
-    if "course_content_vecs" not in st.session_state:
-        st.session_state.course_content_vecs = Chroma.from_documents(course_content, embedding=embedding_model)
-    course_content_vecs = st.session_state.course_content_vecs
+    ### Retrieving Course Content
+
+    retrievers = []
+    if retrieval_mode in ('vector', 'hybrid'):
+        # Load the persisted Course Content Vectors (built by `python tutor/course_index.py`)
+        retrievers.append(load_course_vectors(embedding).as_retriever(search_kwargs={"k": n_retrieved}))
+    if retrieval_mode in ('lexical', 'hybrid'):
+        retrievers.append(BM25Retriever(index=load_lexical_index(), k=n_retrieved))
+    course_content_retriever = HybridRetriever(retrievers=retrievers, k=n_retrieved) if len(retrievers) > 1 else retrievers[0]
     
     ### Setting Up the Chatbot Interaction
     contextualize_q_system_prompt = (
@@ -175,7 +144,8 @@ def build_chatbot(model="gpt-4o-mini", embedding='text-embedding-3-small', pirat
             ("human", "{input}"),
     ])
     
-    history_aware_retriever = create_history_aware_retriever(llm, course_content_vecs.as_retriever(), contextualize_q_prompt)
+    # Only rewrites the question (an extra LLM call) when it refers back to the conversation
+    history_aware_retriever = QuestionContextualizer(llm, course_content_retriever, contextualize_q_prompt).as_runnable()
     
     ### Integrating Document-Based Responses
     
@@ -197,7 +167,9 @@ def build_chatbot(model="gpt-4o-mini", embedding='text-embedding-3-small', pirat
     
     ### Implementing the Retrieval-Augmented Generation Chain
     
-    rag_chain = create_retrieval_chain(history_aware_retriever, question_answer_chain)
+    # Fit the most relevant, non-duplicate chunks into the context budget
+    context_assembler = ContextAssembler(token_budget=min(context_budget, context_window // 4))
+    rag_chain = create_retrieval_chain(context_assembler.as_runnable(history_aware_retriever), question_answer_chain)
     conversational_rag_chain = RunnableWithMessageHistory(
         rag_chain,
         get_session_history,
@@ -274,8 +246,9 @@ with st.sidebar:
 # Initialize Session State for Chat History
 if "messages" not in st.session_state:
     st.session_state["messages"] = [{"role": "assistant", "content": "I'm here to help you navigate your astronomy course, making tricky concepts clearer and guiding you through challenging problems. While I won’t do the work for you, I'll show you how to solve problems on your own, helping you gain confidence as you move forward.\n\nHow can I help you today?"}]
-if "store" not in st.session_state:
-    st.session_state.store = {}
+if "session_id" not in st.session_state:
+    # Identifies this browser session's history in the shared history store
+    st.session_state.session_id = uuid.uuid4().hex
 
 # Display chat messages
 if pirate_mode:
@@ -290,8 +263,10 @@ for msg in st.session_state.messages:
 
 # The following code is for saving the messages to a html file.
 col1, col2, col3 = st.columns(3)
-session_md = convert_messages_to_markdown(st.session_state.messages)
-session_html = markdown_to_html(session_md)
+# Only the messages added since the last rerun are rendered
+if "transcript_exporter" not in st.session_state:
+    st.session_state.transcript_exporter = TranscriptExporter()
+session_html = st.session_state.transcript_exporter.to_html(st.session_state.messages)
 file_name = f"astro_ai_tutor_{''.join(str(random.randint(0, 9)) for _ in range(5))}.html"
 download_chat_session = col3.download_button(
     label="Save chat",
@@ -353,8 +328,10 @@ if prompt := st.chat_input():
     # Use a spinner to indicate processing and display the assistant's response after processing
     with st.spinner('Thinking...'):
 
-        response = conversational_rag_chain.invoke({"input": prompt_full}, config={"configurable": {"session_id": "abc123"}})
+        response = conversational_rag_chain.invoke({"input": prompt_full}, config={"configurable": {"session_id": st.session_state.session_id}})
         msg = response["answer"]
+        # Keep track of the prompt tokens used for retrieved context on each turn
+        st.session_state.setdefault("context_token_counts", []).append(context_tokens(response['context']))
 
 
         # Conditional inclusion of content links
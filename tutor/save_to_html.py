@@ -1,7 +1,8 @@
 # from https://github.com/tonypeng1/Personal-ChatGPT/blob/main/personal-chatgpt
 
 import re
-from typing import List, Dict
+from functools import lru_cache
+from typing import List, Dict, Tuple
 import markdown
 from pygments.formatters import HtmlFormatter
 import streamlit as st
@@ -81,6 +82,27 @@ def markdown_to_html(md_content: str) -> str:
     """
 
     # Convert markdown to HTML with syntax highlighting
+    html_content = _markdown_body_to_html(md_content)
+
+    # Insert MathJax
+    html_content = process_html_with_mathjax(f"<style>{highlight_css()}</style>{html_content}")
+
+    return html_content
+
+
+@lru_cache(maxsize=None)
+def highlight_css(style: str = 'tango') -> str:
+    """
+    Returns the CSS for syntax highlighting from Pygments, which is only generated once per style.
+    """
+    return HtmlFormatter(style=style).get_style_defs('.codehilite')
+
+
+def _markdown_body_to_html(md_content: str) -> str:
+    """
+    Helper function to convert markdown to HTML with syntax highlighting and custom styling
+    for the <code> and <h3> elements (without the CSS or MathJax).
+    """
     html_content = markdown.markdown(md_content, extensions=['fenced_code', 'codehilite'])
 
     html_content = re.sub(
@@ -92,15 +114,78 @@ def markdown_to_html(md_content: str) -> str:
         r'<h3>', 
         '<h3 style="color: blue;">', 
         html_content)
-    
-    # Get CSS for syntax highlighting from Pygments
-    css = HtmlFormatter(style='tango').get_style_defs('.codehilite')
-
-    # Insert MathJax
-    html_content = process_html_with_mathjax(f"<style>{css}</style>{html_content}")
 
     return html_content
 
+
+@lru_cache(maxsize=4096)
+def message_to_html(role: str, content: str) -> str:
+    """
+    Converts a single message to HTML, with its inline math preprocessed for MathJax.
+
+    Rendered messages are memoized, so each message is only rendered once.
+
+    Args:
+        role (str): The sender's role.
+        content (str): The content of the message.
+
+    Returns:
+        The HTML of the message.
+    """
+    md_content = convert_messages_to_markdown([{'role': role, 'content': content}])
+    return preprocess_inline_math(_markdown_body_to_html(md_content))
+
+
+class TranscriptExporter:
+    """
+    Builds the HTML transcript of a chat session incrementally.
+
+    Only messages that were added (or changed) since the last export are rendered, and the 
+    full HTML document is only rebuilt when the messages have changed.
+
+    Attributes:
+        rendered (List[Tuple[str, str, str]]): The (role, content, html) of each exported message.
+        html (str): The last exported HTML document.
+    """
+    def __init__(self):
+        self.rendered: List[Tuple[str, str, str]] = []
+        self.html = None
+
+    def to_html(self, messages: List[Dict[str, str]]) -> str:
+        """
+        Returns the HTML transcript of the messages.
+
+        Each message is rendered on its own, as `markdown_to_html(convert_messages_to_markdown([message]))`
+        would render it, and the messages are joined under a single style tag and MathJax script.
+        This is not identical to rendering the whole transcript at once: markdown can't span messages
+        (e.g. an unclosed code fence only affects its own message) and the whitespace between
+        messages may differ.
+
+        Args:
+            messages (List[Dict[str, str]]): A list of message dictionaries with 'role' and 'content' keys.
+
+        Returns:
+            The HTML transcript, including the syntax highlighting CSS and MathJax.
+        """
+        # Find the messages that have already been rendered
+        n_unchanged = 0
+        for (role, content, _), message in zip(self.rendered, messages):
+            if (role, content) != (message['role'], message['content']):
+                break
+            n_unchanged += 1
+        if self.html is not None and n_unchanged == len(self.rendered) == len(messages):
+            return self.html
+
+        # Render the new messages and append them to the cached ones
+        self.rendered = self.rendered[:n_unchanged]
+        for message in messages[n_unchanged:]:
+            html = message_to_html(message['role'], message['content'])
+            self.rendered.append((message['role'], message['content'], html))
+
+        body = '\n'.join(html for _, _, html in self.rendered)
+        self.html = insert_mathjax(f"<style>{highlight_css()}</style>{body}")
+        return self.html
+
 def preprocess_inline_math(html_content: str) -> str:
     """
     Preprocess the HTML content to ensure that inline math expressions are correctly formatted
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The app's modules are imported by path, like the app does when it is run from its directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
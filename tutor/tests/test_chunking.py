@@ -0,0 +1,63 @@
+from chunking import TokenChunker, chunk_stats
+
+def paragraph(i, n_words=20):
+    """Returns a paragraph of `n_words` words that is numbered so it can be told apart."""
+    return " ".join([f"p{i}"] + ["word"] * (n_words - 1)) + "."
+
+def test_short_sections_are_a_single_chunk():
+    chunker = TokenChunker()
+    chunks = chunker.chunk("# 1_1_Stars.md", "## Stars\n\nStars are hot balls of gas.")
+    assert len(chunks) == 1
+    assert chunks[0].page_content == "## Stars\n\nStars are hot balls of gas."
+    assert chunks[0].metadata["title"] == "# 1_1_Stars.md"
+    assert chunks[0].metadata["part"] == 1
+
+def test_chunks_fit_in_the_chunk_size():
+    chunker = TokenChunker(chunk_size=60, chunk_overlap=0)
+    content = "## Stars\n\n" + "\n\n".join(paragraph(i) for i in range(10))
+    chunks = chunker.chunk("# 1_1_Stars.md", content)
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert chunk.metadata["tokens"] == chunker.count_tokens(chunk.page_content)
+        assert chunk.metadata["tokens"] <= 60
+    assert [chunk.metadata["part"] for chunk in chunks] == list(range(1, len(chunks) + 1))
+
+def test_every_chunk_starts_with_its_headings():
+    chunker = TokenChunker(chunk_size=60, chunk_overlap=0)
+    content = "## Stars\n\n### Colour\n\n" + "\n\n".join(paragraph(i) for i in range(6))
+    chunks = chunker.chunk("# 1_1_Stars.md", content)
+    assert len(chunks) > 1
+    for chunk in chunks[1:]:
+        assert chunk.page_content.startswith("## Stars\n### Colour\n")
+        assert chunk.metadata["headings"] == "## Stars > ### Colour"
+
+def test_consecutive_chunks_overlap():
+    chunker = TokenChunker(chunk_size=60, chunk_overlap=20)
+    content = "\n\n".join(paragraph(i, 8) for i in range(8))
+    chunks = chunker.chunk("# 1_1_Stars.md", content)
+    assert len(chunks) > 1
+    for previous, chunk in zip(chunks, chunks[1:]):
+        last_paragraph = previous.page_content.split("\n\n")[-1]
+        assert chunk.page_content.startswith(last_paragraph)
+    for chunk in chunks:
+        assert chunk.metadata["tokens"] <= 60
+
+def test_no_overlap_without_a_budget():
+    chunker = TokenChunker(chunk_size=60, chunk_overlap=0)
+    content = "\n\n".join(paragraph(i) for i in range(6))
+    chunks = chunker.chunk("# 1_1_Stars.md", content)
+    paragraphs = [p for chunk in chunks for p in chunk.page_content.split("\n\n")]
+    assert paragraphs == [paragraph(i) for i in range(6)]
+
+def test_long_paragraphs_are_split():
+    chunker = TokenChunker(chunk_size=30, chunk_overlap=0)
+    content = " ".join(paragraph(i, 10) for i in range(8))
+    chunks = chunker.chunk("# 1_1_Stars.md", content)
+    assert len(chunks) > 1
+    assert all(chunk.metadata["tokens"] <= 30 for chunk in chunks)
+    assert " ".join(chunk.page_content for chunk in chunks) == content
+
+def test_chunk_stats():
+    assert chunk_stats([]) == {"chunks": 0}
+    assert chunk_stats([30, 10, 20]) == {"chunks": 3, "total": 60, "mean": 20.0,
+                                         "min": 10, "median": 20, "p95": 30, "max": 30}
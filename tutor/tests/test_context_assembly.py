@@ -0,0 +1,59 @@
+from langchain.schema import Document
+
+from context_assembly import ContextAssembler, context_tokens, shingles, similarity
+
+def document(text, title="# 1_1_Stars.md"):
+    return Document(text, {"title": title})
+
+STARS = document("Stars form in clouds of gas and dust that collapse under gravity.")
+COLOUR = document("The colour of a star depends on its temperature.", "# 2_2_Colour.md")
+
+def test_similarity_of_shingles():
+    assert similarity(shingles("stars form in clouds of gas"), shingles("Stars form in clouds of gas!")) == 1.0
+    assert similarity(shingles("stars form in clouds"), shingles("planets orbit the sun")) == 0.0
+    assert similarity(set(), set()) == 0.0
+
+def test_documents_within_the_budget_are_kept():
+    assembler = ContextAssembler()
+    context = assembler.assemble("How do stars form?", [STARS, COLOUR])
+    assert [d.page_content for d in context] == [STARS.page_content, COLOUR.page_content]
+    assert context[0].metadata == {"title": "# 1_1_Stars.md",
+                                   "context_tokens": assembler.count_tokens(STARS.page_content) + 1}
+    assert context_tokens(context) == sum(assembler.count_tokens(d.page_content) + 1 for d in [STARS, COLOUR])
+
+def test_the_retrieved_documents_are_not_modified():
+    ContextAssembler().assemble("How do stars form?", [STARS])
+    assert STARS.metadata == {"title": "# 1_1_Stars.md"}
+
+def test_near_duplicates_are_dropped():
+    duplicate = document(STARS.page_content.replace("Stars", "stars"), "# Unit2_README.md")
+    context = ContextAssembler().assemble("How do stars form?", [STARS, duplicate, COLOUR])
+    assert [d.metadata["title"] for d in context] == ["# 1_1_Stars.md", "# 2_2_Colour.md"]
+
+def test_the_document_that_does_not_fit_is_trimmed_to_the_relevant_paragraphs():
+    assembler = ContextAssembler(min_trimmed_tokens=5)
+    long_document = document("Planets orbit the Sun.\n\nHot stars are blue.\n\nComets have tails.")
+    assembler.token_budget = assembler.count_tokens(COLOUR.page_content) + 1 + 12
+    context = assembler.assemble("Why are hot stars blue?", [COLOUR, long_document])
+    assert [d.page_content for d in context] == [COLOUR.page_content, "Hot stars are blue."]
+    assert context_tokens(context) <= assembler.token_budget
+
+def test_trimming_keeps_the_original_order():
+    assembler = ContextAssembler()
+    text = "Blue stars are hotter than red stars.\n\nPlanets are cold.\n\nStars are hot."
+    # "Stars are hot." is the most relevant paragraph, and there is only room for two paragraphs
+    assert assembler.trim("Which stars are hot?", text, 22) == "Blue stars are hotter than red stars.\n\nStars are hot."
+
+def test_assembly_stops_when_the_budget_is_used_up():
+    assembler = ContextAssembler(token_budget=30, min_trimmed_tokens=10)
+    context = assembler.assemble("How do stars form?", [STARS, COLOUR])
+    assert [d.page_content for d in context] == [STARS.page_content]
+    assert context_tokens(context) <= 30
+
+def test_as_runnable_assembles_the_retrieved_documents():
+    class Retriever:
+        def invoke(self, inputs):
+            return [STARS, STARS]
+
+    runnable = ContextAssembler().as_runnable(Retriever())
+    assert [d.page_content for d in runnable.invoke({"input": "How do stars form?"})] == [STARS.page_content]
@@ -0,0 +1,123 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, Counter
+
+import pytest
+from langchain_core.messages import HumanMessage, AIMessage
+
+import contextualize
+from contextualize import QuestionContextualizer, needs_rewrite
+
+HISTORY = [HumanMessage("What is Mars made of?"), AIMessage("Mostly rock and iron.")]
+
+class FakePrompt:
+    """Stands in for the prompt, so that `prompt | llm | parser` is the fake rewriter."""
+    def __or__(self, llm):
+        return llm
+
+class FakeRewriter:
+    """Rewrites questions from a dict, after an optional delay, and records the questions it was given."""
+    model_name = "fake-model"
+
+    def __init__(self, rewrites, delay=0, error=None):
+        self.rewrites = rewrites
+        self.delay = delay
+        self.error = error
+        self.questions = []
+
+    def __or__(self, parser):
+        return self
+
+    def invoke(self, inputs):
+        self.questions.append(inputs["input"])
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return self.rewrites.get(inputs["input"], inputs["input"])
+
+class FakeRetriever:
+    """Returns the question as its only document, and records the questions it was given."""
+    def __init__(self):
+        self.questions = []
+
+    def invoke(self, question):
+        self.questions.append(question)
+        return [question]
+
+@pytest.fixture(autouse=True)
+def stats(monkeypatch):
+    """Gives each test an empty rewrite cache and stats."""
+    monkeypatch.setattr(contextualize, "rewrite_cache", OrderedDict())
+    monkeypatch.setattr(contextualize, "rewrite_stats", Counter())
+    return contextualize.rewrite_stats
+
+def make_contextualizer(rewriter, **kwargs):
+    return QuestionContextualizer(rewriter, FakeRetriever(), FakePrompt(), **kwargs)
+
+@pytest.mark.parametrize("question, chat_history, expected", [
+    ("What is Mars made of?", [], False),
+    ("Why?", HISTORY, True),
+    ("And Venus?", HISTORY, True),
+    ("What about the atmosphere of Venus?", HISTORY, True),
+    ("Why is it red?", HISTORY, True),
+    ("How hot is the surface of Venus?", HISTORY, False),
+])
+def test_needs_rewrite(question, chat_history, expected):
+    assert needs_rewrite(question, chat_history) == expected
+
+def test_standalone_questions_bypass_the_rewrite(stats):
+    rewriter = FakeRewriter({})
+    contextualizer = make_contextualizer(rewriter)
+    assert contextualizer.retrieve({"input": "How hot is the surface of Venus?", "chat_history": HISTORY}) == \
+        ["How hot is the surface of Venus?"]
+    assert rewriter.questions == []
+    assert stats == {"bypassed": 1}
+
+def test_follow_up_questions_are_rewritten_and_cached(stats):
+    rewriter = FakeRewriter({"Why is it red?": "Why is Mars red?"})
+    contextualizer = make_contextualizer(rewriter)
+    inputs = {"input": "Why is it red?", "chat_history": HISTORY}
+    assert contextualizer.retrieve(inputs) == ["Why is Mars red?"]
+    assert contextualizer.retrieve(inputs) == ["Why is Mars red?"]
+    assert rewriter.questions == ["Why is it red?"]
+    assert stats == {"rewritten": 1, "cached": 1}
+    # The raw question's content is retrieved while the question is being rewritten
+    assert contextualizer.retriever.questions.count("Why is it red?") == 2
+
+def test_the_cache_depends_on_the_history(stats):
+    rewriter = FakeRewriter({"Why is it red?": "Why is Mars red?"})
+    contextualizer = make_contextualizer(rewriter)
+    contextualizer.retrieve({"input": "Why is it red?", "chat_history": HISTORY})
+    contextualizer.retrieve({"input": "Why is it red?", "chat_history": HISTORY[:1]})
+    assert rewriter.questions == ["Why is it red?", "Why is it red?"]
+
+def test_the_cache_is_bounded():
+    rewriter = FakeRewriter({})
+    contextualizer = make_contextualizer(rewriter, max_cache_entries=2)
+    for question in ["Why?", "How?", "When?"]:
+        contextualizer.rewrite(question, HISTORY)
+    assert len(contextualize.rewrite_cache) == 2
+    contextualizer.rewrite("Why?", HISTORY)
+    assert rewriter.questions == ["Why?", "How?", "When?", "Why?"]
+
+def test_unchanged_rewrites_keep_the_raw_content(stats):
+    contextualizer = make_contextualizer(FakeRewriter({}))
+    assert contextualizer.retrieve({"input": "Why?", "chat_history": HISTORY}) == ["Why?"]
+    assert contextualizer.retriever.questions == ["Why?"]
+    assert stats == {"rewritten": 1, "kept_raw": 1}
+
+def test_failed_rewrites_keep_the_raw_content(stats):
+    contextualizer = make_contextualizer(FakeRewriter({}, error=ConnectionError()))
+    assert contextualizer.retrieve({"input": "Why?", "chat_history": HISTORY}) == ["Why?"]
+    assert stats == {"kept_raw": 1}
+
+def test_slow_rewrites_keep_the_raw_content(stats, monkeypatch):
+    executor = ThreadPoolExecutor(max_workers=2)
+    monkeypatch.setattr(contextualize, "executor", executor)
+    rewriter = FakeRewriter({"Why?": "Why is Mars red?"}, delay=0.5)
+    contextualizer = make_contextualizer(rewriter, rewrite_timeout=0.05)
+    assert contextualizer.retrieve({"input": "Why?", "chat_history": HISTORY}) == ["Why?"]
+    assert stats["kept_raw"] == 1
+    # The rewrite still finishes (and is cached) in the background
+    executor.shutdown(wait=True)
+    assert stats["rewritten"] == 1
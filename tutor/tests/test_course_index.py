@@ -0,0 +1,154 @@
+import os
+import json
+
+import pytest
+
+import course_index
+from course_index import (chunk_section, get_index_dir, load_index, load_section_links, section_link,
+                          split_by_files, update_index)
+from chunking import TokenChunker
+
+CONTENT = """
+# Unit1_README.md
+Unit 1 covers the night sky.
+
+# 1_1_Constellations.md
+Constellations are patterns of stars.
+
+# 1_2_Stellar_Motion.md
+Stars appear to move because the Earth rotates.
+"""
+
+class FakeChroma:
+    """A vector store that keeps its chunks in a JSON file in the persist directory, and records what is embedded."""
+    embedded = []
+
+    def __init__(self, persist_directory, embedding_function):
+        self.path = os.path.join(persist_directory, "chunks.json")
+        self.chunks = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                self.chunks = json.load(f)
+        self._collection = self
+
+    def get(self, include=None):
+        return {"ids": list(self.chunks)}
+
+    def delete(self, ids):
+        for i in ids:
+            del self.chunks[i]
+
+    def add_documents(self, documents, ids):
+        FakeChroma.embedded += ids
+        self.chunks.update({i: document.page_content for i, document in zip(ids, documents)})
+
+    def persist(self):
+        with open(self.path, "w") as f:
+            json.dump(self.chunks, f)
+
+@pytest.fixture(autouse=True)
+def vector_store(tmp_path, monkeypatch):
+    """Builds the stores in a temporary directory, with the fake vector store."""
+    monkeypatch.setattr(course_index, "vector_store_root", str(tmp_path / "vector_store"))
+    monkeypatch.setattr(course_index, "Chroma", FakeChroma)
+    monkeypatch.setattr(course_index, "get_embedding_service", lambda embedding: None)
+    monkeypatch.setattr(FakeChroma, "embedded", [])
+    return tmp_path / "vector_store"
+
+def test_the_store_is_only_built_once():
+    stats = update_index(CONTENT)
+    assert stats["added"] == 3 and stats["deleted"] == 0
+    assert update_index(CONTENT) == {"added": 0, "deleted": 0, "unchanged": 3}
+    assert len(FakeChroma.embedded) == 3
+
+def test_load_index_builds_a_missing_store_and_then_reuses_it(monkeypatch, tmp_path):
+    content_path = tmp_path / "course_content.txt"
+    content_path.write_text(CONTENT)
+    monkeypatch.setattr(course_index, "course_content_path", str(content_path))
+    assert len(load_index().chunks) == 3
+    assert len(load_index().chunks) == 3
+    assert len(FakeChroma.embedded) == 3
+
+def test_embedding_and_chunking_settings_get_their_own_store():
+    chunker = TokenChunker()
+    assert get_index_dir("text-embedding-3-small", chunker) != get_index_dir("text-embedding-3-large", chunker)
+    other_chunker = TokenChunker(chunk_size=chunker.chunk_size * 2)
+    assert get_index_dir("text-embedding-3-small", chunker) != get_index_dir("text-embedding-3-small", other_chunker)
+
+def stored_chunks():
+    """Returns the chunks in the current build of the store."""
+    build_dir = course_index.current_build_dir(get_index_dir("text-embedding-3-small", TokenChunker()))
+    with open(os.path.join(build_dir, "chunks.json")) as f:
+        return json.load(f)
+
+def test_only_the_changed_section_is_re_embedded():
+    update_index(CONTENT)
+    old_chunks = stored_chunks()
+    FakeChroma.embedded.clear()
+    changed = CONTENT.replace("patterns of stars", "named patterns of stars")
+    assert update_index(changed) == {"added": 1, "deleted": 1, "unchanged": 2}
+    assert len(FakeChroma.embedded) == 1
+    new_chunks = stored_chunks()
+    assert "Constellations are named patterns of stars." in new_chunks[FakeChroma.embedded[0]]
+    assert set(new_chunks) - set(old_chunks) == set(FakeChroma.embedded)
+
+def test_the_served_build_is_never_modified():
+    update_index(CONTENT)
+    index_dir = get_index_dir("text-embedding-3-small", TokenChunker())
+    old_dir = course_index.current_build_dir(index_dir)
+    old_chunks = stored_chunks()
+    update_index(CONTENT + "\n# 1_3_Planets.md\nPlanets wander across the sky.\n")
+    assert course_index.current_build_dir(index_dir) != old_dir
+    with open(os.path.join(old_dir, "chunks.json")) as f:
+        assert json.load(f) == old_chunks
+    assert len(stored_chunks()) == 4
+
+def test_removed_sections_are_deleted_from_the_store():
+    update_index(CONTENT)
+    removed = CONTENT.split("# 1_2_Stellar_Motion.md")[0]
+    assert update_index(removed) == {"added": 0, "deleted": 1, "unchanged": 2}
+    assert not any("Earth rotates" in chunk for chunk in stored_chunks().values())
+
+def test_vectors_missing_from_the_store_are_re_embedded():
+    update_index(CONTENT)
+    build_dir = course_index.current_build_dir(get_index_dir("text-embedding-3-small", TokenChunker()))
+    chunks = stored_chunks()
+    missing_id = next(iter(chunks))
+    del chunks[missing_id]
+    with open(os.path.join(build_dir, "chunks.json"), "w") as f:
+        json.dump(chunks, f)
+    FakeChroma.embedded.clear()
+    stats = update_index(CONTENT + "\n# Unit 1 Assignment\nDraw a constellation.\n")
+    assert stats["added"] == 2 and stats["deleted"] == 0
+    assert missing_id in FakeChroma.embedded
+
+def test_old_builds_are_pruned():
+    for i in range(4):
+        update_index(CONTENT + f"\n# 1_3_Planets.md\nThere are {i + 5} planets.\n", keep_builds=2)
+    builds_dir = os.path.join(get_index_dir("text-embedding-3-small", TokenChunker()), "builds")
+    builds = os.listdir(builds_dir)
+    assert len(builds) == 2
+    assert os.path.basename(course_index.current_build_dir(os.path.dirname(builds_dir))) in builds
+
+def test_section_links():
+    base_url = course_index.base_url
+    assert section_link("# Unit1_README.md") == f"- [Unit 1]({base_url}md_files/Unit1_README.html)"
+    assert section_link("# 1_2_Stellar_Motion.md") == \
+        f"- [Lesson 1.2 Stellar Motion]({base_url}md_files/1_2_Stellar_Motion.html)"
+    assert section_link("# Unit 3 Assignment") == \
+        f"- [Unit 3 Assignment]({base_url}Unit3/Unit3_Assignment.pdf)"
+    assert section_link("# Notes") is None
+
+def test_chunks_store_their_section_link():
+    chunks = split_by_files(CONTENT, TokenChunker())
+    assert [chunk.metadata["link"] for chunk in chunks] == \
+        [section_link(title) for title in ["# Unit1_README.md", "# 1_1_Constellations.md", "# 1_2_Stellar_Motion.md"]]
+    assert "link" not in chunk_section("# Notes", "Some notes.", TokenChunker())[0].metadata
+
+def test_load_section_links(monkeypatch, tmp_path):
+    content_path = tmp_path / "course_content.txt"
+    content_path.write_text(CONTENT)
+    monkeypatch.setattr(course_index, "course_content_path", str(content_path))
+    assert load_section_links() == {"# Unit1_README.md": section_link("# Unit1_README.md"),
+                                    "# 1_1_Constellations.md": section_link("# 1_1_Constellations.md"),
+                                    "# 1_2_Stellar_Motion.md": section_link("# 1_2_Stellar_Motion.md")}
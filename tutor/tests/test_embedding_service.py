@@ -0,0 +1,148 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import embedding_service
+from embedding_service import EmbeddingService, TokenRateLimiter
+
+class RetryableError(Exception):
+    pass
+
+class FakeEmbeddings:
+    """Embeds each text as [its length, 0.5], after failing the given number of requests."""
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.requests = []
+
+    def create(self, model, input):
+        self.requests.append(list(input))
+        if self.failures:
+            self.failures -= 1
+            raise RetryableError()
+        # The API does not guarantee the order of the vectors
+        return SimpleNamespace(data=[SimpleNamespace(index=i, embedding=[float(len(text)), 0.5]) 
+                                     for i, text in reversed(list(enumerate(input)))])
+
+class FakeAsyncEmbeddings(FakeEmbeddings):
+    async def create(self, model, input):
+        return super().create(model, input)
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Records the waits (for backoff or the rate limit) instead of sleeping."""
+    waits = []
+
+    async def async_sleep(seconds):
+        waits.append(seconds)
+
+    monkeypatch.setattr(embedding_service, "RETRY_ERRORS", (RetryableError,))
+    monkeypatch.setattr(embedding_service.time, "sleep", waits.append)
+    monkeypatch.setattr(embedding_service.asyncio, "sleep", async_sleep)
+    return waits
+
+@pytest.fixture
+def service(tmp_path, sleeps):
+    service = EmbeddingService(cache_path=str(tmp_path / "embeddings.sqlite"))
+    service.client = SimpleNamespace(embeddings=FakeEmbeddings())
+    service.aclient = SimpleNamespace(embeddings=FakeAsyncEmbeddings())
+    return service
+
+def test_async_queries_are_embedded_once(service):
+    assert asyncio.run(service.aembed_query("What is a force?")) == [16.0, 0.5]
+    assert asyncio.run(service.aembed_query("What is a force?")) == [16.0, 0.5]
+    # The sync and async paths share the query cache
+    assert service.embed_query("What is a force?") == [16.0, 0.5]
+    assert service.aclient.embeddings.requests == [["What is a force?"]]
+    assert service.client.embeddings.requests == []
+    assert service.stats == {"cached": 2, "embedded": 1}
+
+def test_async_queries_are_retried(service, sleeps):
+    service.aclient.embeddings.failures = 2
+    assert asyncio.run(service.aembed_query("Hi")) == [2.0, 0.5]
+    assert len(service.aclient.embeddings.requests) == 3
+    assert len(sleeps) == 2
+
+def test_rate_limiter_waits_for_the_window(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(embedding_service.time, "time", lambda: now[0])
+    limiter = TokenRateLimiter(tokens_per_minute=100)
+    assert limiter.reserve(60) == 0
+    now[0] += 10
+    assert limiter.reserve(60) == 50
+    now[0] += 50
+    assert limiter.reserve(60) == 0
+
+def test_async_rate_limiter_does_not_block(monkeypatch):
+    now = [1000.0]
+    waits = []
+
+    async def async_sleep(seconds):
+        waits.append(seconds)
+        now[0] += seconds
+
+    monkeypatch.setattr(embedding_service.time, "time", lambda: now[0])
+    monkeypatch.setattr(embedding_service.asyncio, "sleep", async_sleep)
+    monkeypatch.setattr(embedding_service.time, "sleep", lambda seconds: pytest.fail("The event loop was blocked"))
+    limiter = TokenRateLimiter(tokens_per_minute=100)
+    asyncio.run(limiter.aacquire(60))
+    asyncio.run(limiter.aacquire(60))
+    assert waits == [60]
+
+def test_documents_are_embedded_once(service, tmp_path):
+    texts = ["Stars", "Planets", "Stars"]
+    assert service.embed_documents(texts) == [[5.0, 0.5], [7.0, 0.5], [5.0, 0.5]]
+    # Duplicate texts are only sent once
+    assert service.client.embeddings.requests == [["Stars", "Planets"]]
+    assert service.embed_documents(texts) == [[5.0, 0.5], [7.0, 0.5], [5.0, 0.5]]
+    assert len(service.client.embeddings.requests) == 1
+    assert service.stats == {"cached": 3, "embedded": 2}
+
+def test_the_document_cache_is_persisted(service, tmp_path):
+    service.embed_documents(["Stars", "Planets"])
+    reopened = EmbeddingService(cache_path=str(tmp_path / "embeddings.sqlite"))
+    reopened.client = SimpleNamespace(embeddings=FakeEmbeddings())
+    assert reopened.embed_documents(["Planets", "Moons"]) == [[7.0, 0.5], [5.0, 0.5]]
+    assert reopened.client.embeddings.requests == [["Moons"]]
+
+def test_the_document_cache_is_per_model(service, tmp_path):
+    service.embed_documents(["Stars"])
+    other = EmbeddingService(model="text-embedding-3-large", cache_path=str(tmp_path / "embeddings.sqlite"))
+    other.client = SimpleNamespace(embeddings=FakeEmbeddings())
+    other.embed_documents(["Stars"])
+    assert other.client.embeddings.requests == [["Stars"]]
+
+def test_batches_stay_within_the_limits(service):
+    service.max_batch_size = 2
+    service.max_batch_tokens = 5
+    batches = service.make_batches(["a b", "c", "d", "e f g h"])
+    assert batches == [(["a b", "c"], 4), (["d"], 1), (["e f g h"], 7)]
+
+def test_documents_are_embedded_in_batches(service):
+    service.max_batch_size = 2
+    texts = [f"text {i}" for i in range(5)]
+    assert service.embed_documents(texts) == [[6.0, 0.5]] * 5
+    assert sorted(map(len, service.client.embeddings.requests)) == [1, 2, 2]
+
+def test_failed_requests_are_retried_with_backoff(service, sleeps):
+    service.client.embeddings.failures = 3
+    assert service.embed_documents(["Stars"]) == [[5.0, 0.5]]
+    assert len(service.client.embeddings.requests) == 4
+    # The backoff grows exponentially (with jitter)
+    assert [0.5 <= wait / 2 ** attempt < 1.5 for attempt, wait in enumerate(sleeps)] == [True] * 3
+
+def test_requests_fail_after_the_last_retry(service):
+    service.max_retries = 2
+    service.client.embeddings.failures = 3
+    with pytest.raises(RetryableError):
+        service.embed_documents(["Stars"])
+    assert len(service.client.embeddings.requests) == 3
+
+def test_the_query_cache_is_bounded(service):
+    service.query_cache_size = 2
+    for query in ["a", "bb", "a", "ccc"]:
+        service.embed_query(query)
+    # "bb" was the least recently used query
+    service.embed_query("bb")
+    assert service.client.embeddings.requests == [["a"], ["bb"], ["ccc"], ["bb"]]
+    assert len(service.query_cache) == 2
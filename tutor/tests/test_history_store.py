@@ -0,0 +1,95 @@
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+
+import history_store
+from history_store import HistoryStore, MemoryBackend, SQLiteBackend
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(history_store.time, "time", lambda: now[0])
+    return now
+
+def turn(i):
+    return [HumanMessage(content=f"Question {i}"), AIMessage(content=f"Answer {i}")]
+
+def contents(messages):
+    return [message.content for message in messages]
+
+class RecordingSummarizer:
+    """Summarises by appending the contents of the evicted messages to the summary."""
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, summary, messages):
+        self.calls.append(contents(messages))
+        return " | ".join(filter(None, [summary] + contents(messages)))
+
+@pytest.fixture(autouse=True)
+def inline_summaries(monkeypatch):
+    """Runs the summary updates as soon as they are queued."""
+    class InlineExecutor:
+        def submit(self, function, *args):
+            function(*args)
+    monkeypatch.setattr(history_store, "summary_executor", InlineExecutor())
+
+def test_idle_sessions_are_evicted_wherever_they_are(clock):
+    backend = MemoryBackend(idle_timeout=60)
+    backend.save("idle", turn(1))
+    clock[0] += 30
+    backend.save("active", turn(1))
+    # Loading the idle session makes it the most recently used, without updating it
+    assert backend.load("idle") is not None
+    clock[0] += 40
+    backend.save("new", turn(1))
+    assert backend.load("idle") is None
+    assert backend.load("active") is not None
+
+def test_least_recently_used_sessions_are_evicted(clock):
+    backend = MemoryBackend(max_sessions=2)
+    backend.save("a", turn(1))
+    backend.save("b", turn(1))
+    backend.load("a")
+    backend.save("c", turn(1))
+    assert backend.load("b") is None
+    assert backend.load("a") is not None
+    assert backend.load("c") is not None
+
+@pytest.mark.parametrize("backend_type", ["memory", "sqlite"])
+def test_the_window_keeps_the_latest_turns(tmp_path, backend_type):
+    backend = MemoryBackend() if backend_type == "memory" else SQLiteBackend(str(tmp_path / "history.sqlite"))
+    summarizer = RecordingSummarizer()
+    store = HistoryStore(backend, summarizer=summarizer, max_turns=2)
+    history = store.get("session")
+    for i in range(1, 5):
+        history.add_messages(turn(i))
+    # A new history object reads the same session back from the backend
+    history = store.get("session")
+    assert contents(history.messages) == ["Summary of the earlier conversation:\n"
+                                          "Question 1 | Answer 1 | Question 2 | Answer 2",
+                                          "Question 3", "Answer 3", "Question 4", "Answer 4"]
+    # The summaries were folded in the order the messages were evicted
+    assert summarizer.calls == [["Question 1", "Answer 1"], ["Question 2", "Answer 2"]]
+
+def test_the_window_is_capped_by_tokens():
+    store = HistoryStore(max_turns=10, max_tokens=12)
+    history = store.get("session")
+    for i in range(1, 4):
+        history.add_messages(turn(i))
+    assert history.count_tokens(history.recent) <= 12
+    assert contents(history.messages)[-2:] == ["Question 3", "Answer 3"]
+    assert "Question 1" not in contents(history.messages)
+
+def test_the_latest_turn_is_always_kept():
+    store = HistoryStore(max_turns=1, max_tokens=1)
+    history = store.get("session")
+    history.add_messages(turn(1))
+    history.add_messages([HumanMessage(content="A very long question " * 10), AIMessage(content="A long answer " * 10)])
+    assert len(history.messages) == 2
+
+def test_clear_deletes_the_session():
+    store = HistoryStore()
+    history = store.get("session")
+    history.add_messages(turn(1))
+    history.clear()
+    assert store.get("session").messages == []
@@ -0,0 +1,77 @@
+import pytest
+from langchain.schema import Document
+
+from lexical_retriever import BM25Index, BM25Retriever, HybridRetriever, tokenize
+
+DOCUMENTS = [
+    Document("Kepler's laws describe the orbits of planets.", {"title": "# 1_1_Kepler.md"}),
+    Document("Newton's law of gravity explains why planets orbit the Sun.", {"title": "# 1_2_Gravity.md"}),
+    Document("Stars form in clouds of gas and dust.", {"title": "# 2_1_Stars.md"}),
+    Document("The colour of a star depends on its temperature. Hot stars are blue, cool stars are red.",
+             {"title": "# 2_2_Colour.md"}),
+]
+
+class StaticRetriever:
+    """Returns the same ranked documents for every query, or raises the given error."""
+    def __init__(self, documents=None, error=None):
+        self.documents = documents
+        self.error = error
+
+    def invoke(self, query):
+        if self.error is not None:
+            raise self.error
+        return self.documents
+
+def test_tokenize_drops_stopwords_and_punctuation():
+    assert tokenize("What is the colour of a Star?") == ["colour", "star"]
+
+def test_search_ranks_the_matching_documents():
+    index = BM25Index(DOCUMENTS)
+    results = index.search("Why are hot stars blue?", k=4)
+    assert results[0][0] is DOCUMENTS[3]
+    # Only the documents that contain a query term are returned
+    assert [document for document, _ in results] == [DOCUMENTS[3], DOCUMENTS[2]]
+    assert results[0][1] > 0
+
+def test_rare_terms_score_higher():
+    index = BM25Index(DOCUMENTS)
+    assert index.idf["kepler"] > index.idf["planets"]
+    results = index.search("Kepler planets")
+    assert [document for document, _ in results] == [DOCUMENTS[0], DOCUMENTS[1]]
+
+def test_section_titles_are_indexed():
+    index = BM25Index(DOCUMENTS)
+    assert index.search("gravity lesson")[0][0] is DOCUMENTS[1]
+
+def test_search_returns_at_most_k_documents():
+    index = BM25Index(DOCUMENTS)
+    assert len(index.search("planets stars", k=2)) == 2
+    assert index.search("quasar") == []
+    assert BM25Index([]).search("stars") == []
+
+def test_bm25_retriever():
+    retriever = BM25Retriever(index=BM25Index(DOCUMENTS), k=1)
+    assert retriever.invoke("How do stars form?") == [DOCUMENTS[2]]
+
+def test_hybrid_retriever_fuses_the_rankings():
+    a, b, c, d = DOCUMENTS
+    retriever = HybridRetriever(retrievers=[StaticRetriever([a, b, c]), StaticRetriever([c, a, d])], k=3)
+    # a scores 1/61 + 1/62, c scores 1/63 + 1/61, b scores 1/62 and d scores 1/63
+    assert retriever.invoke("query") == [a, c, b]
+
+def test_hybrid_retriever_merges_duplicate_documents():
+    copy = Document(DOCUMENTS[0].page_content, dict(DOCUMENTS[0].metadata))
+    retriever = HybridRetriever(retrievers=[StaticRetriever([DOCUMENTS[1], DOCUMENTS[0]]),
+                                            StaticRetriever([copy])], k=4)
+    assert retriever.invoke("query") == [DOCUMENTS[0], DOCUMENTS[1]]
+
+def test_hybrid_retriever_survives_a_failed_retriever():
+    retriever = HybridRetriever(retrievers=[StaticRetriever(error=ConnectionError()),
+                                            StaticRetriever(DOCUMENTS[:2])], k=4)
+    assert retriever.invoke("query") == DOCUMENTS[:2]
+
+def test_hybrid_retriever_fails_if_every_retriever_fails():
+    retriever = HybridRetriever(retrievers=[StaticRetriever(error=ConnectionError()),
+                                            StaticRetriever(error=TimeoutError())])
+    with pytest.raises(ConnectionError):
+        retriever.invoke("query")
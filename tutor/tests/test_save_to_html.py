@@ -0,0 +1,53 @@
+import pytest
+
+import save_to_html
+from save_to_html import TranscriptExporter, convert_messages_to_markdown, markdown_to_html, message_to_html
+
+MESSAGES = [{"role": "user", "content": "What is $E = mc^2$?"},
+            {"role": "assistant", "content": "It relates **energy** and mass:\n```python\nE = m * c ** 2\n```"}]
+
+@pytest.fixture
+def renders(monkeypatch):
+    """Records the messages that are rendered (rather than read from the memoized renders)."""
+    rendered = []
+
+    def render(role, content):
+        rendered.append(content)
+        return message_to_html.__wrapped__(role, content)
+
+    monkeypatch.setattr(save_to_html, "message_to_html", render)
+    return rendered
+
+def test_each_message_is_rendered_as_markdown_would_render_it():
+    html = TranscriptExporter().to_html(MESSAGES)
+    for message in MESSAGES:
+        message_html = markdown_to_html(convert_messages_to_markdown([message]))
+        body = message_html.split("</style>", 1)[1]
+        assert body in html
+    assert html.count("<style>") == 1
+    assert html.count("MathJax.Hub.Config") == 1
+    assert r"\(E = mc^2\)" in html
+
+def test_unchanged_transcripts_are_not_re_rendered(renders):
+    exporter = TranscriptExporter()
+    html = exporter.to_html(MESSAGES)
+    assert exporter.to_html([dict(message) for message in MESSAGES]) is html
+    assert len(renders) == 2
+
+def test_only_new_messages_are_rendered(renders):
+    exporter = TranscriptExporter()
+    exporter.to_html(MESSAGES)
+    new_message = {"role": "user", "content": "Thanks!"}
+    html = exporter.to_html(MESSAGES + [new_message])
+    assert renders == [message["content"] for message in MESSAGES] + ["Thanks!"]
+    assert html == TranscriptExporter().to_html(MESSAGES + [new_message])
+
+def test_changed_messages_are_re_rendered(renders):
+    exporter = TranscriptExporter()
+    exporter.to_html(MESSAGES)
+    edited = [MESSAGES[0], {"role": "assistant", "content": "It relates energy and mass."}]
+    html = exporter.to_html(edited)
+    assert renders[2:] == ["It relates energy and mass."]
+    assert "It relates energy and mass." in html and "<strong>energy</strong>" not in html
+    # Removed messages are dropped from the transcript
+    assert exporter.to_html(MESSAGES[:1]) == TranscriptExporter().to_html(MESSAGES[:1])